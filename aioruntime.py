@@ -0,0 +1,97 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Bot
+from config import ASYNC_BLOCKING_WORKERS
+from aiotelegram import AsyncTelegram
+from httppool import http_pool
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRuntime:
+    """
+    Event loop on a dedicated thread that runs conversations as coroutines.
+
+    A conversation waiting on Telegram or on synthesis is a suspended
+    coroutine rather than a parked thread, so thousands of them cost a few
+    kilobytes each. Telegram calls are made with the asynchronous client from
+    ``telegram(bot)``; the calls that still block (the speech engines and the
+    database are synchronous) go to a bounded ``blocking`` pool.
+    """
+
+    def __init__(self, blocking_workers: int = ASYNC_BLOCKING_WORKERS):
+        self._blocking = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix='blocking')
+        self._lock = threading.Lock()
+        self._loop = None
+        self._tasks = 0
+        self._clients = {}  # bot token -> AsyncTelegram
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The runtime's event loop, started on first use."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='asyncio', daemon=True).start()
+                logger.info("Started asyncio runtime")
+            return self._loop
+
+    def telegram(self, bot: Bot) -> AsyncTelegram:
+        """Return the asynchronous Bot API client for ``bot``, shared by every conversation."""
+        client = self._clients.get(bot.token)
+        if client is None:
+            client = self._clients[bot.token] = AsyncTelegram(bot, stats=http_pool.telegram_async_stats)
+        return client
+
+    def blocking(self, fn, *args, **kwargs) -> asyncio.Future:
+        """Await ``fn(*args, **kwargs)`` run on the pool for synthesis and database calls. Call from the loop."""
+        # Carry the task's context over, so the call logs with the task's request id
+        context = contextvars.copy_context()
+        return self.loop.run_in_executor(self._blocking, functools.partial(context.run, fn, *args, **kwargs))
+
+    def spawn(self, coro_fn, *args) -> None:
+        """Start ``coro_fn(*args)`` as a task on the loop. Safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self._spawn, coro_fn, args)
+
+    def _spawn(self, coro_fn, args: tuple) -> None:
+        self._tasks += 1
+        task = self._loop.create_task(coro_fn(*args))
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks -= 1
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Asyncio task failed: %s", task.exception())
+
+    def tasks(self) -> int:
+        """Return the number of tasks started with ``spawn`` that have not finished."""
+        return self._tasks
+
+    async def _close_clients(self) -> None:
+        for client in list(self._clients.values()):
+            await client.close()
+
+    def stop(self) -> None:
+        """Stop the loop and let the blocking pool's threads exit once their current calls return."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            closing = asyncio.run_coroutine_threadsafe(self._close_clients(), loop)
+            try:
+                closing.result(timeout=5)
+            except Exception as e:
+                logger.warning("Failed to close the Telegram clients: %s", e)
+            loop.call_soon_threadsafe(loop.stop)
+        self._blocking.shutdown(wait=False)
+
+
+# Shared runtime, started when RUNTIME is 'asyncio'
+runtime = AsyncRuntime()
+
+Gauge('asyncio_tasks', 'Conversations currently running as coroutines on the asyncio runtime.',
+      lambda: runtime.tasks())
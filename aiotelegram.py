@@ -0,0 +1,150 @@
+from typing import Optional, Union
+import httpx
+from telegram import Bot, Chat, InputFile, Message
+from telegram.error import BadRequest, Conflict, InvalidToken, NetworkError, TimedOut, Unauthorized
+from telegram.utils.request import Request, USER_AGENT
+from config import ASYNC_TELEGRAM_CONNECTIONS, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, TELEGRAM_PROXY_URL
+from httppool import PoolStats
+
+
+class AsyncTelegram:
+    """
+    Asyncio client for the Bot API calls on the text-to-speech path.
+
+    python-telegram-bot 13 only makes blocking HTTP calls, so the asyncio
+    runtime sends chat actions, text replies and voice replies itself with an
+    httpx AsyncClient: a call waiting on Telegram costs a socket and a
+    suspended coroutine instead of a thread. At most ``connections`` calls
+    are in flight; the others wait for a free connection. Requests go through
+    ``proxy`` when one is set, like PTB's. Failures raise the same
+    telegram.error exceptions as PTB, and sent messages are returned as PTB
+    Message objects bound to ``bot``.
+    """
+
+    def __init__(self, bot: Bot, connections: int = ASYNC_TELEGRAM_CONNECTIONS,
+                 connect_timeout: float = HTTP_CONNECT_TIMEOUT, read_timeout: float = HTTP_READ_TIMEOUT,
+                 proxy: Optional[str] = TELEGRAM_PROXY_URL, stats: Optional[PoolStats] = None):
+        self.bot = bot
+        self.connections = connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.proxy = proxy
+        self.stats = stats or PoolStats()
+        self._in_flight = 0
+        self._client = None  # created on the loop
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The underlying httpx client, created on first use."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.bot.base_url + '/',
+                headers={'User-Agent': USER_AGENT},
+                # Waiting for a free connection is bounded by the caller, not by a pool timeout
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout, pool=None),
+                limits=httpx.Limits(max_connections=self.connections, max_keepalive_connections=self.connections),
+                proxy=self.proxy,
+            )
+        return self._client
+
+    async def reply_text(self, message: Message, text: str) -> Message:
+        """Async counterpart of ``message.reply_text(text)``."""
+        return await self.call('sendMessage', self._reply_data(message, text=text))
+
+    async def reply_voice(self, message: Message, voice: Union[bytes, str], caption: str = None,
+                          duration: int = None, filename: str = None) -> Message:
+        """Async counterpart of ``message.reply_voice(...)`` for audio bytes or a file_id."""
+        data = self._reply_data(message)
+        if caption is not None:
+            data['caption'] = caption
+        if duration is not None:
+            data['duration'] = duration
+        files = None
+        if isinstance(voice, bytes):
+            upload = InputFile(voice, filename=filename)
+            files = {'voice': (upload.filename, upload.input_file_content, upload.mimetype)}
+        else:
+            data['voice'] = voice
+        return await self.call('sendVoice', data, files)
+
+    async def send_chat_action(self, chat_id: int, action: str) -> bool:
+        """Async counterpart of ``bot.send_chat_action``."""
+        return await self.call('sendChatAction', {'chat_id': chat_id, 'action': action})
+
+    @staticmethod
+    def _reply_data(message: Message, **data) -> dict:
+        # Quote the message outside private chats, like Message.reply_* does by default
+        data['chat_id'] = message.chat_id
+        if message.chat.type != Chat.PRIVATE:
+            data['reply_to_message_id'] = message.message_id
+        return data
+
+    async def call(self, method: str, data: dict, files: dict = None):
+        """
+        Make one Bot API call.
+
+        Args:
+            method (str): Bot API method, e.g. 'sendVoice'
+            data (dict): Parameters of the call
+            files (dict): Optional uploads as name -> (filename, content, mimetype)
+
+        Returns:
+            Message for calls that send one, otherwise the call's raw result
+        """
+        if files:
+            request = {'data': {name: str(value) for name, value in data.items()}, 'files': files}
+        else:
+            request = {'json': data}
+
+        self.stats.add('requests')
+        if self._in_flight >= self.connections:
+            self.stats.add('saturated')
+        self._in_flight += 1
+        try:
+            response = await self.client.post(method, extensions={'trace': self._trace}, **request)
+        except httpx.TimeoutException as e:
+            raise TimedOut() from e
+        except httpx.HTTPError as e:
+            raise NetworkError(f"Bot API connection failed: {e}") from e
+        finally:
+            self._in_flight -= 1
+
+        result = self._result(response.status_code, response.content)
+        if isinstance(result, dict) and 'message_id' in result:
+            return Message.de_json(result, self.bot)
+        return result
+
+    async def _trace(self, event: str, info: dict) -> None:
+        # httpcore reports each new connection, so reuse can be told apart from new connections
+        if event == 'connection.connect_tcp.complete':
+            self.stats.add('opened')
+
+    @staticmethod
+    def _result(status: int, payload: bytes):
+        # Same outcome as PTB's Request for the same response
+        if 200 <= status <= 299:
+            return Request._parse(payload)
+        try:
+            message = str(Request._parse(payload))
+        except ValueError:
+            message = 'Unknown HTTPError'
+        if status in (401, 403):
+            raise Unauthorized(message)
+        if status == 400:
+            raise BadRequest(message)
+        if status == 404:
+            raise InvalidToken()
+        if status == 409:
+            raise Conflict(message)
+        if status == 413:
+            raise NetworkError('File too large. Check telegram api limits '
+                               'https://core.telegram.org/bots/api#senddocument')
+        if status == 502:
+            raise NetworkError('Bad Gateway')
+        raise NetworkError(f'{message} ({status})')
+
+    async def close(self) -> None:
+        """Close the client's connections."""
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
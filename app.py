@@ -1,12 +1,7 @@
 import os
-from flask import Flask, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
+import threading
+from flask import Flask, Response, jsonify, request, abort
 
-class Base(DeclarativeBase):
-    pass
-
-db = SQLAlchemy(model_class=Base)
 # create the app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
@@ -17,28 +12,236 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
-# initialize the app with the extension, flask-sqlalchemy >= 3.0.x
-db.init_app(app)
+
+_db = None
+_db_lock = threading.Lock()
+_schema_ready = False
+
+def get_db():
+    """
+    Return the Flask-SQLAlchemy extension, creating it on first use.
+
+    SQLAlchemy is imported here rather than at module level, so importing
+    the app stays cheap for code that only needs the configuration. It has
+    to be created before the app serves its first request.
+    """
+    global _db
+    with _db_lock:
+        if _db is None:
+            from flask_sqlalchemy import SQLAlchemy
+            from sqlalchemy.orm import DeclarativeBase
+
+            class Base(DeclarativeBase):
+                pass
+
+            db = SQLAlchemy(model_class=Base)
+            # initialize the app with the extension, flask-sqlalchemy >= 3.0.x
+            db.init_app(app)
+            _db = db
+        return _db
+
+def __getattr__(name):
+    # Keeps ``from app import db`` working while the extension is created lazily
+    if name == 'db':
+        return get_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def init_db() -> None:
+    """Create any missing tables. Called once by the processes that use the database, not at import."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with app.app_context():
+        # Make sure to import the models here or their tables won't be created
+        import models  # noqa: F401
+        db = get_db()
+        db.create_all()
+        if db.engine.dialect.name == 'postgresql':
+            # create_all does not alter existing tables; tts_jobs.owner was created as VARCHAR(64)
+            with db.engine.begin() as connection:
+                connection.execute(db.text("ALTER TABLE tts_jobs ALTER COLUMN owner TYPE VARCHAR(128)"))
+    _schema_ready = True
 
 @app.route('/health')
 def health_check():
-    """Health check endpoint for Uptime Robot."""
-    from bot import _last_health_check
+    """
+    Health check endpoint for Uptime Robot.
+
+    Reads the heartbeat row published by the bot process, which may be a
+    separate worker, with a single primary-key lookup.
+    """
+    from datetime import datetime
     import time
+    from config import BOT_MODE, HEARTBEAT_STALE_SECONDS, SHARD_WORKERS
+    from models import Heartbeat
 
-    # Check if the bot's last health check was within the last 10 minutes
+    db = get_db()
     current_time = time.time()
-    bot_healthy = (current_time - _last_health_check) < 600  # 10 minutes
+    try:
+        beat = db.session.get(Heartbeat, BOT_MODE)
+    except Exception as e:
+        return jsonify({'status': 'unhealthy', 'timestamp': current_time, 'reason': str(e)}), 503
+    if beat is None:
+        return jsonify({'status': 'unhealthy', 'timestamp': current_time, 'reason': 'no heartbeat yet'}), 503
+
+    def age(moment):
+        return None if moment is None else (datetime.utcnow() - moment).total_seconds()
+
+    heartbeat_age = age(beat.updated_at)
+    poll_age = age(beat.last_poll_at)
+    # The process must be alive, and in polling mode its getUpdates loop must be moving too
+    bot_healthy = heartbeat_age < HEARTBEAT_STALE_SECONDS and (
+        BOT_MODE != 'polling' or (poll_age is not None and poll_age < HEARTBEAT_STALE_SECONDS)
+    )
+
+    workers = None
+    if SHARD_WORKERS:
+        # With sharding, every worker process publishes its own row and all must be fresh
+        names = [f'shard-{index}' for index in range(SHARD_WORKERS)]
+        rows = {row.mode: row for row in db.session.query(Heartbeat).filter(Heartbeat.mode.in_(names))}
+        workers = []
+        for name in names:
+            row = rows.get(name)
+            worker_age = age(row.updated_at) if row else None
+            workers.append({
+                'name': name,
+                'healthy': worker_age is not None and worker_age < HEARTBEAT_STALE_SECONDS,
+                'heartbeat_age_seconds': worker_age,
+                'queue_depth': row.queue_depth if row else None,
+                'in_flight': row.in_flight if row else None,
+            })
+        bot_healthy = bot_healthy and all(worker['healthy'] for worker in workers)
 
     status = {
         'status': 'healthy' if bot_healthy else 'unhealthy',
         'timestamp': current_time,
-        'last_health_check': _last_health_check
+        'last_health_check': current_time - heartbeat_age,
+        'mode': beat.mode,
+        'heartbeat_age_seconds': heartbeat_age,
+        'poll_age_seconds': poll_age,
+        'last_update_id': beat.last_update_id,
+        'last_update_age_seconds': age(beat.last_update_at),
+        'update_lag_seconds': beat.update_lag_seconds,
+        'queue_depth': beat.queue_depth,
+        'in_flight': beat.in_flight
     }
+    if workers is not None:
+        status['workers'] = workers
 
     return jsonify(status), 200 if bot_healthy else 503
 
-with app.app_context():
-    # Make sure to import the models here or their tables won't be created
-    import models  # noqa: F401
-    db.create_all()
\ No newline at end of file
+# Most points returned by /status/history; a day of minute rows fits
+_HISTORY_LIMIT = 1500
+
+def _parse_time(value: str):
+    """Parse a Unix timestamp or an ISO 8601 time into a naive UTC datetime."""
+    from datetime import datetime, timezone
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except ValueError:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        return moment
+
+@app.route('/status/history')
+def status_history():
+    """
+    Uptime and synthesis latency history recorded by the bot, for a time range.
+
+    Query parameters ``start`` and ``end`` are Unix timestamps or ISO 8601
+    times (default: the last 24 hours). ``resolution`` is 'minute', 'hour' or
+    'day', by default the finest one still kept for ``start``. Rows are read
+    through the (resolution, timestamp) index.
+    """
+    from datetime import datetime, timedelta
+    from config import STATUS_MINUTE_RETENTION_HOURS, STATUS_HOUR_RETENTION_DAYS
+    from models import BotStatus
+
+    now = datetime.utcnow()
+    try:
+        start = _parse_time(request.args['start']) if request.args.get('start') else now - timedelta(days=1)
+        end = _parse_time(request.args['end']) if request.args.get('end') else now
+    except (ValueError, OverflowError, OSError):
+        return jsonify({'error': 'start and end must be Unix timestamps or ISO 8601 times'}), 400
+    resolution = request.args.get('resolution')
+    if resolution is None:
+        # Rollups move whole hours and days, so rows are kept back to the start of one
+        if start >= (now - timedelta(hours=STATUS_MINUTE_RETENTION_HOURS)).replace(minute=0, second=0, microsecond=0):
+            resolution = 'minute'
+        elif start >= (now - timedelta(days=STATUS_HOUR_RETENTION_DAYS)).replace(hour=0, minute=0, second=0,
+                                                                                microsecond=0):
+            resolution = 'hour'
+        else:
+            resolution = 'day'
+    if resolution not in ('minute', 'hour', 'day'):
+        return jsonify({'error': "resolution must be 'minute', 'hour' or 'day'"}), 400
+
+    db = get_db()
+    rows = db.session.query(BotStatus).filter(
+        BotStatus.resolution == resolution, BotStatus.timestamp >= start, BotStatus.timestamp < end
+    ).order_by(BotStatus.timestamp).limit(_HISTORY_LIMIT + 1).all()
+    truncated = len(rows) > _HISTORY_LIMIT
+    rows = rows[:_HISTORY_LIMIT]
+    samples = sum(row.samples for row in rows)
+    return jsonify({
+        'start': start.isoformat() + 'Z',
+        'end': end.isoformat() + 'Z',
+        'resolution': resolution,
+        'uptime': sum(row.healthy_samples for row in rows) / samples if samples else None,
+        'truncated': truncated,
+        'points': [{
+            'timestamp': row.timestamp.isoformat() + 'Z',
+            'status': row.status,
+            'uptime': row.healthy_samples / row.samples,
+            'updates_per_second': row.updates_per_second,
+            'synthesis_p50': row.synthesis_p50,
+            'synthesis_p95': row.synthesis_p95,
+            'synthesis_p99': row.synthesis_p99,
+            'queue_depth': row.queue_depth,
+        } for row in rows],
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Expose counters and latency histograms in the Prometheus text format.
+
+    Besides this process's own metrics, serves the snapshots that bot
+    processes publish with their heartbeat, so a separate worker's (or
+    another gunicorn worker's) metrics show up here too, labelled with
+    ``process``. Snapshots older than HEARTBEAT_STALE_SECONDS are left out.
+    """
+    from datetime import datetime, timedelta
+    import json
+    from config import HEARTBEAT_STALE_SECONDS
+    from metrics import process_name, render
+    from models import MetricsSnapshot
+
+    try:
+        rows = get_db().session.query(MetricsSnapshot).filter(
+            MetricsSnapshot.updated_at >= datetime.utcnow() - timedelta(seconds=HEARTBEAT_STALE_SECONDS),
+            MetricsSnapshot.process != process_name()
+        ).all()
+        snapshots = {row.process: json.loads(row.payload) for row in rows}
+    except Exception as e:
+        app.logger.error("Failed to read published metrics: %s", e)
+        snapshots = {}
+    return Response(render(snapshots), mimetype='text/plain; version=0.0.4')
+
+@app.route('/webhook/<secret>', methods=['POST'])
+def telegram_webhook(secret):
+    """Receive updates pushed by Telegram when running in webhook mode."""
+    from config import BOT_MODE
+    if BOT_MODE != 'webhook':
+        abort(404)
+    if request.content_length is not None and request.content_length > 1024 * 1024:
+        abort(413)
+
+    from webhook import accept_update
+    status = accept_update(
+        secret,
+        request.headers.get('X-Telegram-Bot-Api-Secret-Token'),
+        request.get_json(silent=True)
+    )
+    return '', status
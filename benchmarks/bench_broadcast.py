@@ -0,0 +1,75 @@
+"""
+Measure broadcast throughput against the local fake Bot API.
+
+Runs a real broadcast job (database-backed, paced, concurrent) to a
+synthetic audience and reports achieved sends per second, flood-control
+hits and the pacer's final rate.
+
+Usage:
+    python benchmarks/bench_broadcast.py [--recipients 100000] [--max-rate 1000]
+                                         [--concurrency 16] [--server-limit 800]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--recipients', type=int, default=100000)
+    parser.add_argument('--max-rate', type=float, default=1000, help='BROADCAST_MAX_RATE')
+    parser.add_argument('--concurrency', type=int, default=16, help='BROADCAST_CONCURRENCY')
+    parser.add_argument('--server-limit', type=float, default=None,
+                        help='Fake API flood-control limit in sends per second')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp(prefix='bench_broadcast_')
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(db_dir, 'bench.db')}"
+    os.environ['BROADCAST_MAX_RATE'] = str(args.max_rate)
+    os.environ['BROADCAST_CONCURRENCY'] = str(args.concurrency)
+    os.environ['BROADCAST_PROGRESS_INTERVAL'] = '3600'
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    from telegram import Bot
+    from telegram.utils.request import Request
+    from fake_bot_api import FakeBotAPI
+    from app import init_db
+    import broadcast
+    from userstore import user_store
+
+    api = FakeBotAPI(rate_limit=args.server_limit).start()
+    bot = Bot(os.environ['TELEGRAM_TOKEN'], base_url=api.base_url,
+              request=Request(con_pool_size=args.concurrency + 2))
+
+    init_db()
+    for user_id in range(1000, 1000 + args.recipients):
+        user_store.touch(user_id)
+    user_store.flush()
+
+    start = time.monotonic()
+    job_id = broadcast.start_broadcast(bot, 1, 'benchmark broadcast')
+    while True:
+        with broadcast._active_jobs_lock:
+            if job_id not in broadcast._active_jobs:
+                break
+        time.sleep(0.1)
+    elapsed = time.monotonic() - start
+    api.stop()
+
+    delivered = sum(1 for _, method, chat_id, _ in api.sent if method == 'sendMessage' and chat_id != 1)
+    print(f"recipients:      {args.recipients}")
+    print(f"delivered:       {delivered}")
+    print(f"elapsed:         {elapsed:.1f}s")
+    print(f"sends/sec:       {delivered / elapsed:.1f}")
+    print(f"flood 429s:      {api.flood_hits}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Compare the file-backed and in-memory synthesis paths.
+
+The TTS engine is replaced by an offline stand-in that writes a fixed-size clip in
+gTTS-sized parts, so the numbers isolate buffering and filesystem cost.
+
+Usage:
+    python benchmarks/bench_buffers.py [--messages 2000] [--clip-bytes 60000]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+import utils  # noqa: E402
+from engines import TTSEngine, set_engine  # noqa: E402
+
+_fs_events = {'open': 0, 'os.remove': 0, 'os.unlink': 0}
+
+
+def _audit(event, args):
+    if event in _fs_events:
+        _fs_events[event] += 1
+
+
+class FakeEngine(TTSEngine):
+    """Offline engine producing ``clip_bytes`` of audio in 4 KiB parts."""
+
+    name = 'fake'
+    clip_bytes = 60000
+
+    def stream(self, text, lang):
+        part = b'\xff' * 4096
+        remaining = self.clip_bytes
+        while remaining > 0:
+            yield part[:remaining]
+            remaining -= len(part)
+
+
+def run(mode: str, messages: int) -> dict:
+    utils.AUDIO_BUFFER_MODE = mode
+    for key in _fs_events:
+        _fs_events[key] = 0
+    latencies = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        success, audio = utils.synthesize('benchmark text', 'en')
+        assert success, audio
+        with audio:
+            audio.read()  # what reply_voice does with the upload
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        'mode': mode,
+        'p50_us': statistics.median(latencies) * 1e6,
+        'p99_us': latencies[int(len(latencies) * 0.99) - 1] * 1e6,
+        'opens_per_msg': _fs_events['open'] / messages,
+        'unlinks_per_msg': (_fs_events['os.remove'] + _fs_events['os.unlink']) / messages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--clip-bytes', type=int, default=60000)
+    args = parser.parse_args()
+
+    FakeEngine.clip_bytes = args.clip_bytes
+    set_engine(FakeEngine())
+    sys.addaudithook(_audit)
+
+    print(f"{'mode':<8} {'p50 us':>10} {'p99 us':>10} {'opens/msg':>10} {'unlinks/msg':>12}")
+    for mode in ('file', 'memory'):
+        r = run(mode, args.messages)
+        print(f"{r['mode']:<8} {r['p50_us']:>10.1f} {r['p99_us']:>10.1f} "
+              f"{r['opens_per_msg']:>10.2f} {r['unlinks_per_msg']:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Compare uploading raw MP3 with Opus-encoded voice: bytes per second of speech and reply latency.
+
+Speech comes from the default engine chain (gTTS wrapped in its resilience
+layer, with the segment cache on) pointed at a local gTTS stand-in
+(benchmarks/fake_tts.py) that answers each request after ``--part-delay``
+seconds with MP3 sized like real speech. Each reply's sentences are new to
+the segment cache, so every reply is synthesized. Replies are made with
+utils.synthesize (encoded to Opus by ffmpeg as the sentences arrive, or not
+at all) and sent with sendVoice to the fake Bot API. Reply latency is the
+measured synthesis, encoding and send time plus the time the clip takes to
+upload at ``--uplink-kbps``. For Opus, ``first ms`` is when the encoder got
+its first audio; well below ``synth ms`` means encoding overlaps synthesis.
+Requires ffmpeg with libopus.
+
+Usage:
+    python benchmarks/bench_encoding.py [--replies 5] [--bitrate 24k] [--part-delay 0.15]
+                                        [--uplink-kbps 2000] [--ffmpeg /usr/bin/ffmpeg]
+"""
+import argparse
+import itertools
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+# TEMP_DIR, and the segment cache in it, are relative to the working directory outside Render
+os.chdir(tempfile.mkdtemp())
+
+import logging  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+from fake_tts import FakeTTS, silent_mp3  # noqa: E402
+
+# The stand-in must be up before the engine chain reads GTTS_ENDPOINT
+tts = FakeTTS().start()
+os.environ['GTTS_ENDPOINT'] = tts.url
+
+import utils  # noqa: E402
+from telegram import Bot  # noqa: E402
+from encoding import OpusEncoder, audio_format, set_encoder, voice_duration  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+SENTENCES = [
+    "Your order has shipped and should arrive within three to five business days.",
+    "You can follow the parcel from the orders page at any time.",
+    "If anything is missing or damaged, reply to this message and we will sort it out.",
+    "Our support team is available every day from eight in the morning until ten at night.",
+    "Thank you for shopping with us, and we hope to see you again soon!",
+]
+SIZES = {'short': 1, 'medium': 8, 'long': 24}  # sentences per text
+_replies = itertools.count()
+
+
+class TimedEncoder:
+    """Encoder wrapper noting when the first audio of each reply reaches ffmpeg."""
+
+    def __init__(self, encoder: OpusEncoder):
+        self.encoder = encoder
+        self.format = encoder.format
+        self.first_write = None
+
+    def open(self, fp):
+        sink = self.encoder.open(fp)
+        write = sink.write
+
+        def timed_write(data):
+            if self.first_write is None:
+                self.first_write = time.perf_counter()
+            return write(data)
+
+        sink.write = timed_write
+        return sink
+
+
+def reply_text(count: int) -> str:
+    """Return ``count`` sentences, each tagged with a new reply number so none is in the segment cache."""
+    number = next(_replies)
+    return ' '.join(f"{sentence[:-1]}, reference {number}-{index}{sentence[-1]}"
+                    for index, sentence in enumerate(itertools.islice(itertools.cycle(SENTENCES), count)))
+
+
+def speech_seconds(text: str) -> float:
+    # The stand-in's MP3 is 32 kbit/s, 4000 bytes per second
+    return len(silent_mp3(text)) / 4000
+
+
+def run(count: int, replies: int, bot: Bot, uplink_kbps: float, encoder) -> dict:
+    sizes, produce, first, send, total, seconds = [], [], [], [], [], []
+    for _ in range(replies):
+        text = reply_text(count)
+        seconds.append(speech_seconds(text))
+        if encoder is not None:
+            encoder.first_write = None
+        start = time.perf_counter()
+        success, result = utils.synthesize(text, 'en')
+        assert success, result
+        audio = result.getvalue()
+        result.close()
+        produced = time.perf_counter()
+        bot.send_voice(1, voice=audio, duration=voice_duration(audio), filename=f"voice.{audio_format(audio)}")
+        sent = time.perf_counter()
+        upload = len(audio) * 8 / (uplink_kbps * 1000)
+        sizes.append(len(audio))
+        produce.append(produced - start)
+        if encoder is not None:
+            first.append(encoder.first_write - start)
+        send.append(sent - produced)
+        total.append(sent - start + upload)
+    return {
+        'bytes': statistics.mean(sizes),
+        'seconds': statistics.mean(seconds),
+        'produce_ms': statistics.median(produce) * 1000,
+        'first_ms': statistics.median(first) * 1000 if first else None,
+        'send_ms': statistics.median(send) * 1000,
+        'upload_ms': statistics.mean(sizes) * 8 / uplink_kbps,
+        'total_ms': statistics.median(total) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--replies', type=int, default=5)
+    parser.add_argument('--bitrate', default='24k')
+    parser.add_argument('--part-delay', type=float, default=0.15)
+    parser.add_argument('--uplink-kbps', type=float, default=2000)
+    parser.add_argument('--ffmpeg', default=shutil.which('ffmpeg'))
+    args = parser.parse_args()
+    if not args.ffmpeg:
+        sys.exit("ffmpeg is not installed; it is needed for Opus encoding")
+
+    tts.latency = args.part_delay
+    api = FakeBotAPI().start()
+    bot = Bot('123456:benchmark', base_url=api.base_url)
+    print(f"{args.part_delay * 1000:.0f} ms per gTTS request, {args.uplink_kbps:.0f} kbit/s uplink")
+    print(f"{'text':<7} {'audio':<9} {'speech s':>8} {'bytes':>9} {'B/s speech':>10} {'synth ms':>8} "
+          f"{'first ms':>8} {'send ms':>7} {'upload ms':>9} {'reply ms':>8}")
+    results = {}
+    for size, count in SIZES.items():
+        for name, encoder in (('raw mp3', None), (f"opus {args.bitrate}",
+                                                  TimedEncoder(OpusEncoder(args.bitrate, args.ffmpeg)))):
+            set_encoder(encoder)
+            r = results[size, name] = run(count, args.replies, bot, args.uplink_kbps, encoder)
+            first = '' if r['first_ms'] is None else f"{r['first_ms']:.0f}"
+            print(f"{size:<7} {name:<9} {r['seconds']:>8.1f} {r['bytes']:>9.0f} {r['bytes'] / r['seconds']:>10.0f} "
+                  f"{r['produce_ms']:>8.0f} {first:>8} {r['send_ms']:>7.0f} {r['upload_ms']:>9.0f} "
+                  f"{r['total_ms']:>8.0f}")
+    api.stop()
+    tts.stop()
+
+    for size in SIZES:
+        raw, opus = results[size, 'raw mp3'], results[size, f"opus {args.bitrate}"]
+        print(f"{size}: Opus is {opus['bytes'] / raw['bytes'] * 100:.0f}% of the MP3 bytes, "
+              f"reply latency {opus['total_ms'] - raw['total_ms']:+.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Measure throughput and latency of each TTS engine across the supported languages.
+
+Every selected engine synthesizes a sample sentence in each language of
+SUPPORTED_LANGUAGES, ``--requests`` times per language from ``--concurrency``
+threads. Engines that are not available here (espeak-ng not installed) are
+skipped. gTTS needs internet access, so it only runs when listed in
+``--engines``.
+
+Usage:
+    python benchmarks/bench_engines.py [--engines tone,espeak] [--requests 20] [--concurrency 4]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+from config import SUPPORTED_LANGUAGES  # noqa: E402
+from engines import ENGINES  # noqa: E402
+
+SAMPLES = {
+    'en': 'The quick brown fox jumps over the lazy dog while the bot reads this sentence aloud.',
+    'es': 'El veloz zorro marrón salta sobre el perro perezoso mientras el bot lee esta frase.',
+    'fr': 'Le renard brun rapide saute par-dessus le chien paresseux pendant que le bot lit cette phrase.',
+    'de': 'Der schnelle braune Fuchs springt über den faulen Hund, während der Bot diesen Satz vorliest.',
+    'it': 'La veloce volpe marrone salta sopra il cane pigro mentre il bot legge questa frase.',
+    'pt': 'A rápida raposa marrom pula sobre o cão preguiçoso enquanto o bot lê esta frase.',
+    'ru': 'Быстрая бурая лиса прыгает через ленивую собаку, пока бот читает это предложение.',
+    'hi': 'तेज़ भूरी लोमड़ी आलसी कुत्ते के ऊपर कूदती है जबकि बॉट यह वाक्य पढ़ता है।',
+    'ja': '素早い茶色の狐が怠け者の犬を飛び越える間、ボットはこの文を読み上げます。',
+    'ko': '봇이 이 문장을 읽는 동안 빠른 갈색 여우가 게으른 개를 뛰어넘습니다.',
+    'ml': 'ബോട്ട് ഈ വാചകം വായിക്കുമ്പോൾ വേഗതയുള്ള തവിട്ട് കുറുക്കൻ മടിയനായ നായയുടെ മുകളിലൂടെ ചാടുന്നു.',
+}
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(engine, lang: str, requests: int, concurrency: int) -> dict:
+    text = SAMPLES[lang]
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            size = len(engine.synthesize(text, lang))
+        except Exception:
+            size = None
+        return time.perf_counter() - start, size
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, size in results if size is not None]
+    sizes = [size for _, size in results if size is not None]
+    return {
+        'ok': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else float('nan'),
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else float('nan'),
+        'avg_kb': sum(sizes) / len(sizes) / 1024 if sizes else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engines', default='tone,espeak', help='Comma-separated: ' + ', '.join(ENGINES))
+    parser.add_argument('--langs', default=','.join(SUPPORTED_LANGUAGES))
+    parser.add_argument('--requests', type=int, default=20, help='Requests per engine and language')
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{'engine':<8} {'lang':<5} {'ok':>5} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'avg KiB':>8}")
+    for name in args.engines.split(','):
+        engine = ENGINES[name]()
+        if not engine.available():
+            print(f"{name:<8} not available, skipped")
+            continue
+        for lang in args.langs.split(','):
+            if not engine.supports(lang):
+                print(f"{name:<8} {lang:<5} unsupported")
+                continue
+            r = run(engine, lang, args.requests, args.concurrency)
+            print(f"{name:<8} {lang:<5} {r['ok']:>5} {r['throughput']:>8.1f} "
+                  f"{r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['avg_kb']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
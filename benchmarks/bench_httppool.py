@@ -0,0 +1,148 @@
+"""
+Compare TTS HTTP calls over fresh sessions against the shared keep-alive pool.
+
+A local HTTPS stub answers every POST with a gTTS-style response carrying
+a small audio payload. In 'fresh' mode each call opens its own
+requests.Session, as gTTS does per request; in 'pooled' mode all calls go
+through httppool.build_session. ``--rtt`` adds a simulated network round
+trip to every new connection, to approximate the TCP and TLS handshakes
+against a remote endpoint. Needs the openssl command line tool for the
+stub's self-signed certificate.
+
+Usage:
+    python benchmarks/bench_httppool.py [--requests 400] [--concurrency 8] [--rtt 20]
+"""
+import argparse
+import base64
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+import requests  # noqa: E402
+from engines import read_gtts_audio  # noqa: E402
+from httppool import PoolStats, build_session  # noqa: E402
+
+AUDIO = base64.b64encode(b'\xff\xf3' * 4000).decode('ascii')
+BODY = (")]}'\n\n" + f'[["wrb.fr","jQ1olc","[\\"{AUDIO}\\"]",null,null,null,"generic"]]\n').encode('ascii')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    rtt = 0.0
+
+    def __init__(self, context: ssl.SSLContext):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        # Handshakes happen on the connection's thread instead of in accept()
+        self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def process_request_thread(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        # TCP handshake plus a TLS 1.3 handshake take about two round trips
+        time.sleep(2 * self.rtt)
+        super().process_request_thread(request, client_address)
+
+
+def make_certificate(directory: str) -> tuple:
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+         '-days', '1', '-subj', '/CN=localhost', '-addext', 'subjectAltName=IP:127.0.0.1'],
+        check=True, capture_output=True
+    )
+    return cert, key
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(mode: str, url: str, cert: str, requests_count: int, concurrency: int, server: StubServer) -> dict:
+    stats = PoolStats()
+    pooled = build_session(concurrency, stats) if mode == 'pooled' else None
+    prepared = requests.Request('POST', url, data='f.req=benchmark').prepare()
+
+    def call(_):
+        start = time.perf_counter()
+        if pooled is not None:
+            with pooled.send(prepared, stream=True, verify=cert, timeout=(5, 30)) as response:
+                audio = b''.join(read_gtts_audio(response))
+        else:
+            with requests.Session() as session:
+                response = session.send(prepared, verify=cert, timeout=(5, 30))
+                audio = b''.join(read_gtts_audio(response))
+        assert audio
+        return time.perf_counter() - start
+
+    server.connections = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(call, range(requests_count)))
+    elapsed = time.perf_counter() - start
+    return {
+        'mode': mode,
+        'rps': requests_count / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'connections': server.connections,
+        'saturated': stats.stats()['saturated'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rtt', type=float, default=20, help='Simulated round trip in ms per new connection')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    cert, key = make_certificate(directory)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server = StubServer(context)
+    server.rtt = args.rtt / 1000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"https://127.0.0.1:{server.server_address[1]}/_/TranslateWebserverUi/data/batchexecute"
+
+    print(f"{'mode':<8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'connections':>12} {'saturated':>10}")
+    for mode in ('fresh', 'pooled'):
+        r = run(mode, url, cert, args.requests, args.concurrency, server)
+        print(f"{r['mode']:<8} {r['rps']:>8.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+              f"{r['connections']:>12} {r['saturated']:>10}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Compare update-to-reply latency between polling and webhook ingestion.
+
+Each mode runs in its own process against the local fake Bot API. Updates
+are /start commands from distinct users sent at a fixed rate: in polling
+mode they are queued for getUpdates, in webhook mode they are POSTed to the
+Flask app served by a local threaded server. Latency is measured from
+handing the update over to the fake API receiving the bot's reply.
+
+In webhook mode the database also starts with an update stored by a process
+that died before handling it; the web process must take it over and answer
+it, and every handled update must be deleted from the store.
+
+Usage:
+    python benchmarks/bench_ingestion.py [--updates 500] [--rate 50]
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+# User whose update a crashed process left stored
+ORPHAN_USER = 9999
+
+
+def start_update(update_id: int, user_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load'},
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def drive(api: FakeBotAPI, mode: str, updates: int, rate: float, send, report=None) -> None:
+    """Feed updates at a fixed rate, wait for every reply, print a JSON result (plus ``report()``) and exit."""
+    while api.calls['getUpdates'] == 0 and api.calls['setWebhook'] == 0:
+        time.sleep(0.05)
+    time.sleep(0.5)
+
+    sent_at = {}
+    start = time.monotonic()
+    for i in range(updates):
+        user_id = 10000 + i
+        target = start + i / rate
+        delay = target - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        sent_at[user_id] = time.monotonic()
+        send(i + 1, user_id)
+
+    deadline = time.monotonic() + 30
+    replied = {}
+    while time.monotonic() < deadline and len(replied) < updates:
+        time.sleep(0.05)
+        for at, method, chat_id, _ in list(api.sent):
+            if method == 'sendMessage' and chat_id in sent_at:
+                replied.setdefault(chat_id, at)
+    latencies = [replied[c] - sent_at[c] for c in replied]
+    result = {
+        'mode': mode,
+        'replied': len(replied),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+    if report:
+        result.update(report())
+    print(json.dumps(result), flush=True)
+    os._exit(0)
+
+
+def child(mode: str, updates: int, rate: float) -> None:
+    api = FakeBotAPI().start()
+    os.environ['TELEGRAM_API_URL'] = api.base_url
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    if mode == 'polling':
+        import bot
+
+        def send(update_id, user_id):
+            api.push_update(start_update(update_id, user_id))
+
+        threading.Thread(target=drive, args=(api, mode, updates, rate, send), daemon=True).start()
+        bot.run_bot()
+    else:
+        port = free_port()
+        os.environ['BOT_MODE'] = 'webhook'
+        os.environ['WEBHOOK_URL'] = f"http://127.0.0.1:{port}"
+        from werkzeug.serving import make_server
+        from app import app, db, init_db
+        from models import WebhookUpdate
+
+        init_db()
+        with app.app_context():
+            db.session.add(WebhookUpdate(update_id=updates + 1, payload=json.dumps(start_update(updates + 1, ORPHAN_USER)),
+                                         owner='crashed:1', lease_until=datetime(2000, 1, 1)))
+            db.session.commit()
+        # Importing the entry point starts the bot, which takes the stored update over
+        import web
+        from config import WEBHOOK_SECRET
+
+        def report():
+            # Stored copies are deleted just after the handlers return
+            deadline = time.monotonic() + 5
+            while True:
+                with app.app_context():
+                    stored = db.session.query(WebhookUpdate).count()
+                if not stored or time.monotonic() > deadline:
+                    break
+                time.sleep(0.05)
+            answered = any(method == 'sendMessage' and chat_id == ORPHAN_USER for _, method, chat_id, _ in api.sent)
+            return {'orphan_answered': answered, 'left_stored': stored}
+
+        server = make_server('127.0.0.1', port, web.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        local = threading.local()
+
+        def send(update_id, user_id):
+            if not hasattr(local, 'conn'):
+                local.conn = http.client.HTTPConnection('127.0.0.1', port)
+            local.conn.request('POST', f"/webhook/{WEBHOOK_SECRET}",
+                               body=json.dumps(start_update(update_id, user_id)),
+                               headers={'Content-Type': 'application/json',
+                                        'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET})
+            local.conn.getresponse().read()
+
+        drive(api, mode, updates, rate, send, report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=50, help='Updates per second')
+    parser.add_argument('--child', choices=('polling', 'webhook'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.updates, args.rate)
+        return
+
+    print(f"{'mode':<8} {'replied':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for mode in ('polling', 'webhook'):
+        out = subprocess.run(
+            [sys.executable, __file__, '--child', mode, '--updates', str(args.updates), '--rate', str(args.rate)],
+            capture_output=True, text=True, cwd=tempfile.mkdtemp()
+        )
+        lines = [line for line in out.stdout.splitlines() if line.startswith('{')]
+        if not lines:
+            print(f"{mode:<8} failed:\n{out.stderr[-2000:]}")
+            continue
+        r = json.loads(lines[-1])
+        print(f"{r['mode']:<8} {r['replied']:>8} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+        if 'left_stored' in r:
+            print(f"         update left by a crashed process answered: {r['orphan_answered']}, "
+                  f"updates still stored: {r['left_stored']}")
+            assert r['orphan_answered'] and r['left_stored'] == 0, r
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+End-to-end load test: the real polling bot against a local Bot API and TTS endpoint.
+
+The bot runs ``bot.run_bot`` unchanged in a child process, with gTTS pointed
+at the fake TTS endpoint (fake_tts.py, ``--tts-latency``, ``--tts-error-rate``)
+and the Bot API at fake_bot_api.py. Nothing leaves the machine.
+
+``--users`` simulated users each send ``--updates`` updates in a closed loop:
+a user's next update is queued as soon as the bot has answered the previous
+one. A user starts with /start, then sends text messages, with /help and
+/lang followed by a tap on a language button mixed in. An admin user starts
+``--broadcasts`` broadcasts spread over the run. With ``--replay FILE`` the
+updates come from a JSONL file instead: lines holding a Telegram update
+(``message`` or ``callback_query``) are replayed per chat in file order, and
+any other line is sent as a text message taken from its ``text``, ``body`` or
+``title`` field, dealt to the simulated users in turn (e.g. requests.jsonl).
+
+An update counts as answered at the bot's last reply to it: the voice
+message (or the last part of a long text), the message for a command, or the
+edited menu for a button. The report gives throughput, reply latency
+percentiles by kind of update, broadcast delivery and the bot process's
+peak RSS and thread count.
+
+Usage:
+    python benchmarks/bench_load.py [--users 50] [--updates 20] [--broadcasts 1]
+                                    [--tts-latency 0.3] [--tts-error-rate 0.01]
+                                    [--api-latency 0.05] [--runtime threads] [--replay FILE]
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from fake_tts import FakeTTS  # noqa: E402
+
+ADMIN_ID = 1
+TEXTS = [
+    "Hi! Your appointment is confirmed for Tuesday at {n} in the afternoon.",
+    "Please remember to bring your ticket number {n} to the front desk.",
+    "The weather today is mild, with light rain expected later in the evening.",
+    "Chapter {n}. The train left the station just as the sun came up over the hills.",
+    "Can you read this message aloud for me? I am testing voice number {n}.",
+]
+LANGUAGES = ['en', 'es', 'fr', 'de', 'it', 'pt']
+_REPLIES = {'sendMessage', 'sendVoice', 'editMessageText'}
+
+
+def message(user_id: int, text: str) -> dict:
+    update = {'message': {
+        'message_id': random.randrange(1, 2 ** 31),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load'},
+        'text': text,
+    }}
+    if text.startswith('/'):
+        command = text.split()[0]
+        update['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return update
+
+
+def button(user_id: int, data: str) -> dict:
+    return {'callback_query': {
+        'id': f"{user_id}-{random.randrange(2 ** 31)}",
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load'},
+        'chat_instance': str(user_id),
+        'data': data,
+        'message': {
+            'message_id': random.randrange(1, 2 ** 31),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'text': 'Please select your preferred language:',
+        },
+    }}
+
+
+def kind(update: dict) -> str:
+    if 'callback_query' in update:
+        return 'button'
+    return 'command' if update['message'].get('text', '').startswith('/') else 'text'
+
+
+def synthetic_scripts(users: int, updates: int, rng: random.Random) -> dict:
+    scripts = {}
+    for user_id in range(1000, 1000 + users):
+        script = [message(user_id, '/start')]
+        while len(script) < updates:
+            roll = rng.random()
+            if roll < 0.05:
+                script.append(message(user_id, '/help'))
+            elif roll < 0.15:
+                script.append(message(user_id, '/lang'))
+                script.append(button(user_id, f"lang_{rng.choice(LANGUAGES)}"))
+            else:
+                script.append(message(user_id, rng.choice(TEXTS).format(n=rng.randrange(1, 13))))
+        scripts[user_id] = script[:updates]
+    return scripts
+
+
+def replay_scripts(path: str, users: int) -> dict:
+    scripts = defaultdict(list)
+    user_ids = itertools.cycle(range(1000, 1000 + users))
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'message' in record or 'callback_query' in record:
+                record.pop('update_id', None)
+                body = record.get('message') or record['callback_query'].get('message') or {}
+                scripts[body.get('chat', {}).get('id', 0)].append(record)
+            else:
+                user_id = next(user_ids)
+                text = record.get('text') or record.get('body') or record.get('title')
+                if text:
+                    scripts[user_id].append(message(user_id, text))
+    return dict(scripts)
+
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+class LoadBotAPI(FakeBotAPI):
+    """
+    Fake Bot API that feeds each user's script one update at a time and times the replies.
+
+    Args:
+        scripts (dict): Updates to send, by chat id
+        broadcasts (int): Number of broadcasts the admin starts, spread over the run
+        latency (float): Seconds to wait before answering each call but getUpdates
+    """
+
+    def __init__(self, scripts: dict, broadcasts: int, latency: float):
+        super().__init__()
+        self.call_latency = latency
+        self.scripts = {chat_id: deque(script) for chat_id, script in scripts.items()}
+        self.total = sum(len(script) for script in scripts.values())
+        self.latencies = defaultdict(list)  # kind -> seconds
+        self.voice_replies = 0
+        self.failed_texts = 0
+        self.answered = 0
+        self.done = threading.Event()
+        self.first_sent = self.last_answered = None
+        self.broadcast_text = "Load test broadcast {}"
+        self.broadcast_at = [self.total * (i + 1) // (broadcasts + 1) for i in range(broadcasts)]
+        self.broadcasts_started = []  # monotonic time each broadcast was requested
+        self.deliveries = defaultdict(list)  # broadcast number -> delivery times
+        self._pending = {}  # chat id -> (sent at, kind)
+
+    def begin(self) -> None:
+        self.first_sent = time.monotonic()
+        for chat_id in list(self.scripts):
+            self._next(chat_id)
+
+    def _next(self, chat_id: int) -> None:
+        script = self.scripts[chat_id]
+        if not script:
+            return
+        update = script.popleft()
+        self._pending[chat_id] = (time.monotonic(), kind(update))
+        self.push_update(update)
+
+    def dispatch(self, method: str, params: dict):
+        if method != 'getUpdates':
+            time.sleep(self.call_latency)
+        if method in _REPLIES:
+            self._record(method, params)
+        return super().dispatch(method, params)
+
+    def _record(self, method: str, params: dict) -> None:
+        now = time.monotonic()
+        chat_id = int(params.get('chat_id') or 0)
+        text = params.get('text', '')
+        with self._lock:
+            if text.startswith("Load test broadcast "):
+                self.deliveries[int(text.rsplit(' ', 1)[1])].append(now)
+                return
+            caption = params.get('caption') or ''
+            if method == 'sendVoice' and '/' in caption and caption.split('/')[0] != caption.split('/')[1]:
+                return  # An earlier part of a long text; the update is answered by the last one
+            if chat_id not in self._pending:
+                return  # e.g. broadcast progress edits for the admin
+            sent, update_kind = self._pending.pop(chat_id)
+            if chat_id == ADMIN_ID:
+                return
+            self.latencies[update_kind].append(now - sent)
+            if update_kind == 'text':
+                if method == 'sendVoice':
+                    self.voice_replies += 1
+                else:
+                    self.failed_texts += 1
+            self.answered += 1
+            self.last_answered = now
+            if self.broadcast_at and self.answered >= self.broadcast_at[0]:
+                self.broadcast_at.pop(0)
+                number = len(self.broadcasts_started)
+                self.broadcasts_started.append(now)
+                self._pending[ADMIN_ID] = (now, 'command')
+                self.push_update(message(ADMIN_ID, f"/broadcast {self.broadcast_text.format(number)}"))
+            self._next(chat_id)
+            if self.answered >= self.total:
+                self.done.set()
+
+
+def proc_status(pid: int) -> tuple:
+    """Return (RSS in KiB, thread count) of a process."""
+    fields = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            fields[name] = value.split()[0] if value.split() else ''
+    return int(fields['VmRSS']), int(fields['Threads'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--updates', type=int, default=20, help='updates per simulated user')
+    parser.add_argument('--broadcasts', type=int, default=1)
+    parser.add_argument('--tts-latency', type=float, default=0.3)
+    parser.add_argument('--tts-error-rate', type=float, default=0.01)
+    parser.add_argument('--api-latency', type=float, default=0.05)
+    parser.add_argument('--runtime', default='threads', choices=('threads', 'asyncio'))
+    parser.add_argument('--replay', help='JSONL file of updates or texts to send instead of the synthetic mix')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.replay:
+        scripts = replay_scripts(args.replay, args.users)
+    else:
+        scripts = synthetic_scripts(args.users, args.updates, random.Random(args.seed))
+    tts = FakeTTS(args.tts_latency, args.tts_error_rate, args.seed).start()
+    api = LoadBotAPI(scripts, args.broadcasts, args.api_latency).start()
+
+    workdir = tempfile.mkdtemp()
+    env = dict(
+        os.environ, PYTHONPATH=ROOT, TELEGRAM_TOKEN='123456:load', TELEGRAM_API_URL=api.base_url,
+        GTTS_ENDPOINT=tts.url, TTS_ENGINES='gtts', RUNTIME=args.runtime, ADMIN_IDS=str(ADMIN_ID),
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'load.db')}", LOG_LEVEL='WARNING',
+        RATE_LIMIT_CAPACITY=str(10 ** 9), MAX_QUEUED_UPDATES=str(10 ** 6),
+    )
+    bot = subprocess.Popen([sys.executable, '-c', 'import bot; bot.run_bot()'], env=env, cwd=workdir,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    peak_rss = peak_threads = 0
+    try:
+        # The bot is up once it starts polling; users start sending then
+        while not api.calls['getUpdates']:
+            if bot.poll() is not None:
+                sys.exit(f"the bot exited:\n{bot.stderr.read().decode()[-2000:]}")
+            time.sleep(0.01)
+        start_rss, start_threads = proc_status(bot.pid)
+        api.begin()
+        deadline = time.monotonic() + args.timeout
+        while not api.done.wait(0.05) and time.monotonic() < deadline and bot.poll() is None:
+            rss, threads = proc_status(bot.pid)
+            peak_rss, peak_threads = max(peak_rss, rss), max(peak_threads, threads)
+        # Give broadcasts still going a moment to finish before reading the results
+        end = time.monotonic() + 30
+        while (api.broadcasts_started and time.monotonic() < end
+               and len(api.deliveries) < len(api.broadcasts_started)):
+            time.sleep(0.1)
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        api.stop()
+        tts.stop()
+
+    elapsed = (api.last_answered or time.monotonic()) - api.first_sent
+    print(f"{len(scripts)} users, {api.total} updates, {args.runtime} runtime, TTS {args.tts_latency * 1000:.0f} ms "
+          f"with {args.tts_error_rate:.0%} errors, Bot API {args.api_latency * 1000:.0f} ms")
+    print(f"answered {api.answered}/{api.total} in {elapsed:.1f} s: {api.answered / elapsed:.1f} updates/s")
+    print(f"{'kind':<8} {'count':>6} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+    for update_kind in ('text', 'command', 'button'):
+        values = api.latencies.get(update_kind)
+        if values:
+            print(f"{update_kind:<8} {len(values):>6} {percentile(values, 0.5) * 1000:>7.0f} "
+                  f"{percentile(values, 0.95) * 1000:>7.0f} {percentile(values, 0.99) * 1000:>7.0f} "
+                  f"{max(values) * 1000:>7.0f}")
+    texts = api.voice_replies + api.failed_texts
+    if texts:
+        print(f"text messages answered with voice: {api.voice_replies}/{texts}; TTS requests {dict(tts.calls)}")
+    for number, started in enumerate(api.broadcasts_started):
+        times = api.deliveries.get(number, [])
+        span = f", last after {times[-1] - started:.1f} s" if times else ""
+        print(f"broadcast {number}: delivered to {len(times)} users{span}")
+    print(f"bot process: peak RSS {peak_rss / 1024:.1f} MB (+{(peak_rss - start_rss) / 1024:.1f} under load), "
+          f"peak threads {peak_threads} (+{peak_threads - start_threads})")
+    if api.answered < api.total:
+        sys.exit(f"{api.total - api.answered} updates were not answered:\n{bot.stderr.read().decode()[-2000:]}")
+
+
+if __name__ == '__main__':
+    main()
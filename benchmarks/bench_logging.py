@@ -0,0 +1,130 @@
+"""
+Measure the logging cost of handling one text message, before and after the queued JSON pipeline.
+
+'before' reproduces the original setup: the root logger at DEBUG writing
+synchronously to stdout, with the handler's eagerly formatted f-string lines
+(including a slice of the user's text) and python-telegram-bot's DEBUG
+lines for its two API calls. 'after' uses the log lines as they are now,
+through logs.configure_logging at the default INFO level, with and without
+the per-call-site rate limit. Output goes to a file in place of stdout.
+
+'caller us/msg' is the time spent in the handling threads, which is what
+delays replies; 'total us/msg' also includes writing out every queued record.
+
+Usage:
+    python benchmarks/bench_logging.py [--messages 20000] [--threads 1]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logs  # noqa: E402
+
+TEXT = "Please read this message aloud for me, it is a fairly typical request of a few sentences. " * 3
+
+
+def message_before(user_id: int, text: str) -> None:
+    # The hot-path lines of handle_text, synthesis and send_voice as they were
+    logger = logging.getLogger('config')
+    ptb = logging.getLogger('telegram.bot')
+    logger.info(f"Processing text message from user {user_id}: {text[:50]}...")
+    ptb.debug('Entering: %s', 'send_chat_action')
+    ptb.debug(True)
+    ptb.debug('Exiting: %s', 'send_chat_action')
+    logger.info(f"Generating speech for user {user_id} in {'English'}")
+    logger.info("Initializing TTS engine with text length: %d", len(text))
+    logger.info(f"Speech synthesized into {'memory'} buffer")
+    logger.info(f"Speech generated successfully for user {user_id}, sending voice message")
+    ptb.debug('Entering: %s', 'send_voice')
+    ptb.debug({'message_id': user_id, 'voice': {'file_id': 'voice-1', 'duration': 3}})
+    ptb.debug('Exiting: %s', 'send_voice')
+    logger.info(f"Voice message sent for user {user_id}")
+
+
+def message_after(user_id: int, text: str) -> None:
+    # The same path's lines as they are now, on per-module loggers
+    handlers = logging.getLogger('handlers')
+    utils = logging.getLogger('utils')
+    ptb = logging.getLogger('telegram.bot')
+    logs.bind_update(SimpleNamespace(update_id=user_id))
+    handlers.info("Processing text message from user %s (%d characters)", user_id, len(text))
+    ptb.debug('Entering: %s', 'send_chat_action')
+    ptb.debug(True)
+    ptb.debug('Exiting: %s', 'send_chat_action')
+    handlers.debug("Generating speech for user %s in %s", user_id, 'en')
+    utils.debug("Initializing TTS engine with text length: %d", len(text))
+    utils.debug("Speech synthesized into %s buffer", 'memory')
+    handlers.debug("Speech generated for user %s, sending voice message", user_id)
+    ptb.debug('Entering: %s', 'send_voice')
+    ptb.debug({'message_id': user_id, 'voice': {'file_id': 'voice-1', 'duration': 3}})
+    ptb.debug('Exiting: %s', 'send_voice')
+    handlers.info("Voice message sent for user %s", user_id)
+
+
+def configure_before(stream) -> None:
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+
+
+def run(name: str, setup, emit, messages: int, threads: int) -> None:
+    path = os.path.join(tempfile.mkdtemp(), 'log.txt')
+    stream = open(path, 'w')
+    stdout, sys.stdout = sys.stdout, stream
+    try:
+        setup(stream)
+        per_thread = messages // threads
+        caller = []
+
+        def worker(index):
+            start = time.perf_counter()
+            for i in range(per_thread):
+                emit(index * per_thread + i, TEXT)
+            caller.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        logs.stop_logging()
+        stream.flush()
+        total = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+        stream.close()
+    with open(path) as f:
+        lines = sum(1 for _ in f)
+    count = per_thread * threads
+    print(f"{name:<22} {sum(caller) / count * 1e6:>14.1f} {total / count * 1e6:>13.1f} {lines / count:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages on {args.threads} threads")
+    print(f"{'setup':<22} {'caller us/msg':>14} {'total us/msg':>13} {'lines/msg':>10}")
+    run('before (sync, DEBUG)', configure_before, message_before, args.messages, args.threads)
+    run('after (no rate limit)', lambda stream: logs.configure_logging('INFO', '', 'json', 0),
+        message_after, args.messages, args.threads)
+    run('after (10/s per site)', lambda stream: logs.configure_logging('INFO', '', 'json', 10),
+        message_after, args.messages, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Exercise hedging, retries and the circuit breaker against a fault-injecting gTTS stand-in.
+
+A local HTTP stub answers like the gTTS endpoint, but can be told to delay
+every Nth response, answer a fraction with 429, or throttle every
+request. The gTTS engine is pointed at it directly ('plain') and through
+ResilientEngine ('resilient') in four scenarios:
+
+- tail: every 50th response is slow; each slow call should be hedged and
+  hedging should cut the p99.
+- flaky: some responses are 429s; jittered retries should hide them.
+- outage: every response is a 429; the breaker should stop calling the
+  stub after a few failed calls, and a fallback engine should take over
+  without its audio being cached as the text's audio. A long-text chunk synthesized through utils must not retry on top of
+  the engine's own retries.
+- recovery: the stub heals; one probe should close the breaker again, and
+  the text is synthesized and cached by gTTS.
+- hang: every response takes seconds; a fallback chain should answer
+  within its timeout, and the calls it abandons should give their threads
+  back by then instead of waiting for the stub.
+
+Each scenario asserts its expected outcome.
+
+Usage:
+    python benchmarks/bench_resilience.py [--requests 300] [--concurrency 8]
+"""
+import argparse
+import base64
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+# Short delays so the scenarios finish quickly
+os.environ.setdefault('TTS_RETRY_BASE_DELAY', '0.02')
+os.environ.setdefault('TTS_RETRY_MAX_DELAY', '0.2')
+os.environ.setdefault('TTS_HEDGE_MIN_DELAY', '0.05')
+os.environ.setdefault('SEGMENT_CACHE', 'false')
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# TEMP_DIR and the disk cache are relative to the working directory
+os.chdir(tempfile.mkdtemp())
+
+import logging  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+import handlers  # noqa: E402
+import utils  # noqa: E402
+from cache import audio_cache, make_key  # noqa: E402
+from engines import FallbackEngine, GTTSEngine, ToneEngine, set_engine  # noqa: E402
+from resilience import CircuitBreaker, ResilientEngine, HEDGES  # noqa: E402
+
+AUDIO = base64.b64encode(b'\xff\xf3' * 2000).decode('ascii')
+BODY = (")]}'\n\n" + f'[["wrb.fr","jQ1olc","[\\"{AUDIO}\\"]",null,null,null,"generic"]]\n').encode('ascii')
+
+
+class FaultHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        with server.lock:
+            server.hits += 1
+            slow = server.slow_every and server.hits % server.slow_every == 0
+            server.slowed += bool(slow)
+        time.sleep(server.latency)
+        if server.throttle or random.random() < server.throttle_ratio:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if slow:
+            time.sleep(server.slow_delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class FaultServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FaultHandler)
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self, latency=0.02, slow_every=0, slow_delay=1.0, throttle_ratio=0.0, throttle=False):
+        self.latency = latency
+        self.slow_every = slow_every
+        self.slow_delay = slow_delay
+        self.throttle_ratio = throttle_ratio
+        self.throttle = throttle
+        self.hits = 0
+        self.slowed = 0
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(engine, requests_count: int, concurrency: int) -> dict:
+    def one(i):
+        start = time.perf_counter()
+        try:
+            ok = bool(engine.synthesize(f"resilience sample {i}", 'en'))
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests_count)))
+    latencies = [latency for latency, _ in results]
+    return {
+        'ok': sum(ok for _, ok in results),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+def report(scenario: str, mode: str, r: dict, server: FaultServer, requests_count: int) -> None:
+    print(f"{scenario:<9} {mode:<10} {r['ok']:>5}/{requests_count:<5} {r['p50_ms']:>8.1f} "
+          f"{r['p99_ms']:>8.1f} {r['max_ms']:>8.1f} {server.hits:>10}")
+
+
+def hedges(result: str) -> float:
+    return sum(v for (_, res), v in HEDGES._values.items() if res == result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+    n, concurrency = args.requests, args.concurrency
+
+    server = FaultServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/_/TranslateWebserverUi/data/batchexecute"
+    plain = GTTSEngine(endpoint=url)
+
+    print(f"{'scenario':<9} {'mode':<10} {'ok':>11} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'stub hits':>10}")
+
+    # tail: every 50th response takes an extra second
+    results = {}
+    fired = won = 0
+    for mode in ('plain', 'resilient'):
+        engine = plain if mode == 'plain' else ResilientEngine(GTTSEngine(endpoint=url))
+        if mode == 'resilient':
+            server.configure()
+            run(engine, 40, concurrency)  # warm up the latency window that sets the hedge delay
+        fired, won = hedges('fired'), hedges('won')
+        server.configure(slow_every=50)
+        results[mode] = run(engine, n, concurrency)
+        report('tail', mode, results[mode], server, n)
+    fired, won = hedges('fired') - fired, hedges('won') - won
+    print(f"          {server.slowed} slow responses, hedges fired {fired:.0f}, won {won:.0f}")
+    assert fired >= server.slowed and won > 0, "slow calls were not hedged"
+    assert results['resilient']['p99_ms'] < results['plain']['p99_ms'] / 2, "hedging did not cut the p99"
+
+    # flaky: 20% of responses are 429s
+    for mode in ('plain', 'resilient'):
+        engine = plain if mode == 'plain' else ResilientEngine(GTTSEngine(endpoint=url), hedge_quantile=None,
+                                                               breaker=CircuitBreaker(failure_threshold=50))
+        server.configure(throttle_ratio=0.2)
+        results[mode] = run(engine, n, concurrency)
+        report('flaky', mode, results[mode], server, n)
+    assert results['resilient']['ok'] >= n * 0.97, "retries did not hide transient 429s"
+    assert results['resilient']['ok'] > results['plain']['ok']
+
+    # outage: every response is a 429
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=1.0)
+    resilient = ResilientEngine(GTTSEngine(endpoint=url), breaker=breaker)
+    server.configure(throttle=True)
+    r = run(plain, n, concurrency)
+    report('outage', 'plain', r, server, n)
+    server.configure(throttle=True)
+    r = run(resilient, n, concurrency)
+    report('outage', 'resilient', r, server, n)
+    assert breaker.state == 'open', f"breaker should be open, is {breaker.state}"
+    # Each failed call counts once; calls already running when it opens finish their attempts
+    limit = (breaker.failure_threshold + concurrency - 1) * (1 + resilient.retries)
+    assert server.hits <= limit, f"breaker let {server.hits} calls through"
+    chunk_engine = ResilientEngine(GTTSEngine(endpoint=url), hedge_quantile=None)
+    set_engine(chunk_engine)
+    server.configure(throttle=True)
+    success, _ = utils._synthesize_with_retry("one long-text chunk", 'en')
+    print(f"          a failing long-text chunk made {server.hits} upstream calls")
+    assert not success and server.hits == 1 + resilient.retries, "chunk retries stacked on engine retries"
+    assert chunk_engine.breaker.state == 'closed', "one failed chunk should not open the breaker"
+    server.configure(throttle=True)
+    chain = FallbackEngine([resilient, ToneEngine()])
+    r = run(chain, n, concurrency)
+    report('outage', 'fallback', r, server, n)
+    assert r['ok'] == n and server.hits == 0, "fallback should answer everything without calling the stub"
+    set_engine(chain)
+    key = make_key("spoken during the outage", 'en')
+    success, _, cached = handlers.synthesize_to_cache(key, "spoken during the outage", 'en')
+    assert success and not cached and audio_cache.get_audio(key) is None, "fallback audio was cached"
+
+    # recovery: the stub heals and a probe closes the breaker
+    server.configure()
+    time.sleep(breaker.reset_timeout)
+    # While the single half-open probe is in flight other calls still fail fast
+    probe = run(resilient, 1, 1)
+    assert probe['ok'] == 1 and breaker.state == 'closed', f"probe should close the breaker, is {breaker.state}"
+    r = run(resilient, n, concurrency)
+    report('recovery', 'resilient', r, server, n)
+    assert r['ok'] == n, "calls kept failing after recovery"
+    success, _, cached = handlers.synthesize_to_cache(key, "spoken during the outage", 'en')
+    assert success and cached and audio_cache.get_audio(key) is not None, "gTTS audio was not cached after recovery"
+
+    # hang: every response takes five seconds
+    hung = ResilientEngine(GTTSEngine(endpoint=url), hedge_quantile=None)
+    chain = FallbackEngine([hung, ToneEngine()], timeout=0.3, pool_size=max(1, concurrency // 2))
+    server.configure(slow_every=1, slow_delay=5.0)
+    r = run(chain, n, concurrency)
+    report('hang', 'fallback', r, server, n)
+    start = time.monotonic()
+    while chain._slots[hung]._value < chain.pool_size and time.monotonic() - start < 3:
+        time.sleep(0.01)
+    print(f"          abandoned calls freed their threads {(time.monotonic() - start) * 1000:.0f} ms "
+          f"after the last answer")
+    assert r['ok'] == n and r['max_ms'] < 1000, "fallback did not answer within its timeout"
+    assert chain._slots[hung]._value == chain.pool_size, "abandoned calls kept their threads past the deadline"
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Compare the threaded and asyncio runtimes: replies per second and memory per concurrent conversation.
+
+The fake Bot API runs in this process and answers every call but getUpdates
+after ``--latency`` seconds, like a slow Telegram. Each configuration runs the
+polling bot in its own child process with the offline tone engine, and a
+burst of one text message from each of ``--conversations`` users is queued,
+so most conversations spend their time waiting on Telegram at once. The
+child samples its own RSS, thread count and running conversations until
+every message is answered.
+
+Configurations are ``runtime:size``: for 'threads' the number of handler
+threads (HANDLER_WORKERS), for 'asyncio' the number of Bot API connections
+(ASYNC_TELEGRAM_CONNECTIONS). 'threads:1000' is what the threaded runtime
+needs to hold 1000 conversations in flight.
+
+Usage:
+    python benchmarks/bench_runtime.py [--configs threads:8,threads:1000,asyncio:100,asyncio:1000]
+                                       [--conversations 1000] [--latency 2]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+TEXT = "Runtime benchmark message from user {}, long enough to be a typical voice reply."
+
+
+class SlowBotAPI(FakeBotAPI):
+    """Fake Bot API whose calls take ``latency`` seconds, except getUpdates, so ingestion is not the bottleneck."""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.call_latency = latency
+
+    def dispatch(self, method: str, params: dict):
+        if method != 'getUpdates':
+            time.sleep(self.call_latency)
+        return super().dispatch(method, params)
+
+
+def text_update(user_id: int) -> dict:
+    return {
+        'message': {
+            'message_id': user_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load'},
+            'text': TEXT.format(user_id),
+        },
+    }
+
+
+def proc_status() -> tuple:
+    """Return (RSS in KiB, thread count) of this process."""
+    fields = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            fields[name] = value.split()[0] if value.split() else ''
+    return int(fields['VmRSS']), int(fields['Threads'])
+
+
+def sample(conversations: int) -> None:
+    """Watch the scheduler until every conversation finished, then print a JSON result and exit."""
+    from scheduler import scheduler
+
+    baseline_rss, baseline_threads = proc_status()
+    peak_rss = peak_threads = peak_running = 0
+    start = None
+    while True:
+        stats = scheduler.stats()
+        rss, threads = proc_status()
+        if start is None:
+            if stats['submitted'] == 0:
+                baseline_rss, baseline_threads = rss, threads
+            else:
+                start = time.monotonic()
+        peak_rss = max(peak_rss, rss)
+        peak_threads = max(peak_threads, threads)
+        peak_running = max(peak_running, stats['running'])
+        if stats['completed'] + stats['failed'] >= conversations or (start and time.monotonic() - start > 300):
+            break
+        time.sleep(0.01)
+
+    elapsed = time.monotonic() - start
+    print(json.dumps({
+        'replied': stats['completed'],
+        'seconds': elapsed,
+        'throughput': stats['completed'] / elapsed,
+        'peak_running': peak_running,
+        'threads': peak_threads - baseline_threads,
+        'rss_mb': (peak_rss - baseline_rss) / 1024,
+        'kb_per_conversation': (peak_rss - baseline_rss) / max(peak_running, 1),
+    }), flush=True)
+    os._exit(0)
+
+
+def child(config: str, conversations: int, base_url: str) -> None:
+    runtime, size = config.split(':')
+    os.environ['TELEGRAM_API_URL'] = base_url
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    os.environ['RUNTIME'] = runtime
+    os.environ['HANDLER_WORKERS' if runtime == 'threads' else 'ASYNC_TELEGRAM_CONNECTIONS'] = size
+    os.environ['ASYNC_MAX_CONVERSATIONS'] = str(conversations)
+    os.environ['TTS_ENGINES'] = 'tone'
+    os.environ['RATE_LIMIT_CAPACITY'] = str(10 ** 9)
+    os.environ['MAX_QUEUED_UPDATES'] = str(conversations)
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+
+    import logging
+    import bot
+
+    logging.disable(logging.CRITICAL)
+    threading.Thread(target=sample, args=(conversations,), daemon=True).start()
+    bot.run_bot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--configs', default='threads:8,threads:1000,asyncio:100,asyncio:1000')
+    parser.add_argument('--conversations', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=2.0)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.conversations, args.base_url)
+        return
+
+    print(f"{args.conversations} conversations, {args.latency * 1000:.0f} ms per Bot API call")
+    print(f"{'config':<14} {'replied':>7} {'seconds':>8} {'replies/s':>9} {'peak conv':>9} "
+          f"{'+threads':>8} {'+RSS MB':>8} {'KB/conv':>8}")
+    for config in args.configs.split(','):
+        api = SlowBotAPI(args.latency).start()
+        for user_id in range(10000, 10000 + args.conversations):
+            api.push_update(text_update(user_id))
+        out = subprocess.run(
+            [sys.executable, __file__, '--child', config, '--conversations', str(args.conversations),
+             '--base-url', api.base_url],
+            capture_output=True, text=True, cwd=tempfile.mkdtemp()
+        )
+        api.stop()
+        lines = [line for line in out.stdout.splitlines() if line.startswith('{')]
+        if not lines:
+            print(f"{config:<14} failed:\n{out.stderr[-2000:]}")
+            continue
+        r = json.loads(lines[-1])
+        print(f"{config:<14} {r['replied']:>7} {r['seconds']:>8.2f} {r['throughput']:>9.1f} {r['peak_running']:>9} "
+              f"{r['threads']:>8} {r['rss_mb']:>8.1f} {r['kb_per_conversation']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
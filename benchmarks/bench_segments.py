@@ -0,0 +1,147 @@
+"""
+Replay a templated message corpus with and without the sentence segment cache.
+
+The corpus mixes a handful of templates (order updates, reminders, greetings)
+whose fixed sentences repeat while an order number, name or date changes, so
+whole messages rarely repeat. Each setup starts from empty caches and runs
+every message through the whole-message audio cache and then
+utils.synthesize, the path a text message takes, with the offline tone
+engine wrapped to count calls and characters. 'gTTS requests' is the number
+of upstream requests gTTS would have made for the same engine calls: it sends
+one per sentence or clause, so a whole message costs several. 'segments,
+restarted' replays the corpus again on a new store opened from the same file,
+as after a restart.
+
+Usage:
+    python benchmarks/bench_segments.py [--messages 2000] [--max-bytes 134217728] [--seed 1]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+
+import logging  # noqa: E402
+logging.disable(logging.WARNING)
+
+import cache  # noqa: E402
+import utils  # noqa: E402
+from gtts import gTTS  # noqa: E402
+from engines import ToneEngine, set_engine  # noqa: E402
+from segments import SegmentStore  # noqa: E402
+
+NAMES = ['Asha', 'Ben', 'Chen', 'Dara', 'Emeka', 'Farah', 'Gus', 'Hana']
+TEMPLATES = [
+    "Hi {name}! Your order #{order} has shipped. It should arrive within three to five business days. "
+    "You can track the parcel from the orders page. Thank you for shopping with us!",
+    "Hello {name}. Your order #{order} has been delivered. We hope you enjoy your purchase. "
+    "If anything is wrong, reply to this message and we will sort it out. Thank you for shopping with us!",
+    "Reminder: your appointment is on {date}. Please arrive ten minutes early. "
+    "Bring a photo ID and your insurance card. Reply CANCEL if you can no longer make it.",
+    "Good morning {name}! Today's forecast is sunny with light winds. "
+    "Don't forget to drink water and take a break at noon. Have a great day!",
+    "Your verification code is {order}. It expires in ten minutes. Never share this code with anyone.",
+]
+
+
+class CountingEngine(ToneEngine):
+    """Tone engine that counts its calls, the characters it synthesizes and gTTS's requests for them."""
+
+    def __init__(self):
+        self.calls = 0
+        self.chars = 0
+        self.requests = 0
+
+    def stream(self, text: str, lang: str):
+        self.calls += 1
+        self.chars += len(text)
+        self.requests += len(gTTS(text, lang=lang)._tokenize(text))
+        return super().stream(text, lang)
+
+
+def corpus(messages: int, seed: int) -> list:
+    rng = random.Random(seed)
+    return [
+        rng.choice(TEMPLATES).format(
+            name=rng.choice(NAMES), order=rng.randint(100000, 999999),
+            date=f"{rng.randint(1, 28)} {rng.choice(['May', 'June', 'July'])} at {rng.randint(8, 17)}:00"
+        )
+        for _ in range(messages)
+    ]
+
+
+def replay(texts: list, segmented: bool, store: SegmentStore) -> dict:
+    engine = CountingEngine()
+    set_engine(engine)
+    utils.SEGMENT_CACHE = segmented
+    utils.segment_store = store
+    audio_cache = cache.AudioCache(cache_dir=tempfile.mkdtemp())
+    audio_bytes = 0
+    start = time.perf_counter()
+    for text in texts:
+        key = cache.make_key(text, 'en')
+        audio = audio_cache.get_audio(key)
+        if audio is None:
+            success, result = utils.synthesize(text, 'en')
+            assert success, result
+            audio = result.getvalue()
+            result.close()
+            audio_cache.put_audio(key, audio)
+        audio_bytes += len(audio)
+    return {
+        'calls': engine.calls,
+        'requests': engine.requests,
+        'chars': engine.chars,
+        'audio_mb': audio_bytes / 1e6,
+        'seconds': time.perf_counter() - start,
+        'segments': store.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--max-bytes', type=int, default=128 * 1024 * 1024)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    texts = corpus(args.messages, args.seed)
+    chars = sum(len(text) for text in texts)
+    print(f"{len(texts)} templated messages, {len(set(texts))} distinct, {chars} characters")
+    print(f"{'setup':<22} {'engine calls':>12} {'gTTS requests':>13} {'chars synth':>11} {'chars %':>8} {'hit ratio':>9} "
+          f"{'MB saved':>8} {'store MB':>8} {'evicted':>7} {'seconds':>7}")
+
+    path = os.path.join(tempfile.mkdtemp(), 'segments.db')
+    runs = [
+        ('whole messages only', False, SegmentStore(os.path.join(tempfile.mkdtemp(), 'unused.db'), args.max_bytes)),
+        ('segments', True, SegmentStore(path, args.max_bytes)),
+    ]
+    results = {}
+    for name, segmented, store in runs:
+        results[name] = replay(texts, segmented, store)
+        store.close()
+    results['segments, restarted'] = replay(texts, True, SegmentStore(path, args.max_bytes))
+
+    for name, r in results.items():
+        s = r['segments']
+        print(f"{name:<22} {r['calls']:>12} {r['requests']:>13} {r['chars']:>11} {r['chars'] / chars * 100:>7.1f}% "
+              f"{s['hit_ratio']:>9.3f} {s['bytes_saved'] / 1e6:>8.1f} {s['bytes'] / 1e6:>8.1f} "
+              f"{s['evictions']:>7} {r['seconds']:>7.2f}")
+
+    baseline, segmented = results['whole messages only'], results['segments']
+    print(f"\nSegment cache synthesizes {segmented['chars'] / baseline['chars'] * 100:.1f}% of the characters "
+          f"and needs {segmented['requests'] / baseline['requests'] * 100:.1f}% of the gTTS requests")
+    assert segmented['chars'] < baseline['chars']
+    assert segmented['requests'] < baseline['requests']
+    # Spliced clips hold the same audio as whole ones, less the silence between sentences
+    assert abs(segmented['audio_mb'] - baseline['audio_mb']) / baseline['audio_mb'] < 0.1
+    if segmented['segments']['evictions'] == 0:
+        assert results['segments, restarted']['segments']['misses'] == 0
+
+
+if __name__ == '__main__':
+    main()
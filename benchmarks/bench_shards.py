@@ -0,0 +1,120 @@
+"""
+Measure text-to-speech throughput with 1, 2, 4 and 8 shard worker processes.
+
+Each configuration runs the polling bot in its own process against the local
+fake Bot API, with the offline tone engine so synthesis is pure CPU work. A
+burst of distinct text messages from many users is queued for getUpdates,
+and throughput is the number of voice replies per second until all have
+arrived. '0' workers is the unsharded, single-process bot for comparison.
+Speed-ups are bounded by the number of cores available.
+
+Usage:
+    python benchmarks/bench_shards.py [--workers 0,1,2,4,8] [--updates 400] [--users 100]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import logging  # noqa: E402
+
+# Shard workers re-import this script, so silence them here rather than in child()
+logging.disable(logging.CRITICAL)
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+TEXT = ("Shard benchmark message number {} from user {}. It is long enough to make the synthesis "
+        "and the upload of the resulting audio the dominant cost of handling the update.")
+
+
+def text_update(update_id: int, user_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load'},
+            'text': TEXT.format(update_id, user_id),
+        },
+    }
+
+
+def drive(api: FakeBotAPI, workers: int, updates: int, users: int) -> None:
+    """Queue a burst of updates once the bot polls, wait for every voice reply, print a JSON result and exit."""
+    while api.calls['getUpdates'] == 0:
+        time.sleep(0.05)
+    # Give shard workers time to start their interpreters
+    time.sleep(2 + workers)
+
+    start = time.monotonic()
+    for i in range(updates):
+        api.push_update(text_update(i + 1, 10000 + i % users))
+
+    deadline = start + 300
+    while time.monotonic() < deadline and api.calls['sendVoice'] < updates:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - start
+    print(json.dumps({
+        'workers': workers,
+        'replied': api.calls['sendVoice'],
+        'seconds': elapsed,
+        'throughput': api.calls['sendVoice'] / elapsed,
+    }), flush=True)
+    os._exit(0)
+
+
+def child(workers: int, updates: int, users: int) -> None:
+    api = FakeBotAPI().start()
+    os.environ['TELEGRAM_API_URL'] = api.base_url
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    os.environ['SHARD_WORKERS'] = str(workers)
+    os.environ['TTS_ENGINES'] = 'tone'
+    os.environ['RATE_LIMIT_CAPACITY'] = str(10 ** 9)
+    os.environ['MAX_QUEUED_UPDATES'] = str(updates)
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+
+    import bot
+
+    threading.Thread(target=drive, args=(api, workers, updates, users), daemon=True).start()
+    bot.run_bot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', default='0,1,2,4,8')
+    parser.add_argument('--updates', type=int, default=400)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child, args.updates, args.users)
+        return
+
+    print(f"cores: {os.cpu_count()}")
+    print(f"{'workers':>7} {'replied':>8} {'seconds':>8} {'voice/s':>8}")
+    for workers in (int(w) for w in args.workers.split(',')):
+        out = subprocess.run(
+            [sys.executable, __file__, '--child', str(workers), '--updates', str(args.updates),
+             '--users', str(args.users)],
+            capture_output=True, text=True, cwd=tempfile.mkdtemp()
+        )
+        lines = [line for line in out.stdout.splitlines() if line.startswith('{')]
+        if not lines:
+            print(f"{workers:>7} failed:\n{out.stderr[-2000:]}")
+            continue
+        r = json.loads(lines[-1])
+        print(f"{r['workers']:>7} {r['replied']:>8} {r['seconds']:>8.2f} {r['throughput']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
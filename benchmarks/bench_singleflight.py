@@ -0,0 +1,110 @@
+"""
+Check that identical simultaneous requests share one synthesis.
+
+N threads request the same (text, lang) at the same instant through the
+handler's single-flight path, with the TTS engine replaced by an offline
+stand-in that takes ``--latency`` seconds. The run is repeated with an
+engine that fails, to show every waiter receives the failure. Engine calls and
+per-request latency are reported for each case.
+
+Usage:
+    python benchmarks/bench_singleflight.py [--requests 50] [--latency 0.5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+# TEMP_DIR and the disk cache are relative to the working directory
+os.chdir(tempfile.mkdtemp())
+
+import logging  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+import handlers  # noqa: E402
+from engines import TTSEngine, set_engine  # noqa: E402
+from cache import make_key  # noqa: E402
+from singleflight import synthesis_flight  # noqa: E402
+
+
+class FakeEngine(TTSEngine):
+    """Offline engine that counts its calls."""
+
+    name = 'fake'
+    latency = 0.5
+    fail = False
+    calls = 0
+    _lock = threading.Lock()
+
+    def stream(self, text, lang):
+        with FakeEngine._lock:
+            FakeEngine.calls += 1
+        time.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError('engine unavailable')
+        yield b'\xff' * 20000
+
+
+def run(requests: int, text: str, fail: bool) -> dict:
+    FakeEngine.calls = 0
+    FakeEngine.fail = fail
+    key = make_key(text, 'en')
+    barrier = threading.Barrier(requests)
+    results = [None] * requests
+    latencies = [0.0] * requests
+    peak_waiters = 0
+
+    def request(i):
+        barrier.wait()
+        start = time.perf_counter()
+        results[i] = synthesis_flight.do(key, handlers.synthesize_to_cache, key, text, 'en')
+        latencies[i] = time.perf_counter() - start
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(requests)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        peak_waiters = max(peak_waiters, synthesis_flight.waiters())
+        time.sleep(0.005)
+
+    outcomes = {ok for ok, _, _ in results}
+    payloads = {id(audio) for ok, audio, _ in results if ok}
+    return {
+        'engine_calls': FakeEngine.calls,
+        'outcomes': outcomes,
+        'distinct_payloads': len(payloads),
+        'peak_waiters': peak_waiters,
+        'max_latency': max(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.5)
+    args = parser.parse_args()
+
+    FakeEngine.latency = args.latency
+    set_engine(FakeEngine())
+
+    print(f"{'case':<8} {'requests':>9} {'engine calls':>13} {'peak waiters':>13} {'max latency s':>14}  outcome")
+    for case, fail in (('success', False), ('failure', True)):
+        r = run(args.requests, f"single-flight {case} {time.time()}", fail)
+        outcome = 'all ok' if r['outcomes'] == {True} else 'all failed' if r['outcomes'] == {False} else 'mixed'
+        print(f"{case:<8} {args.requests:>9} {r['engine_calls']:>13} {r['peak_waiters']:>13} "
+              f"{r['max_latency']:>14.2f}  {outcome}")
+        assert r['engine_calls'] == 1, f"expected one engine call, got {r['engine_calls']}"
+        assert r['outcomes'] == {not fail}, f"waiters disagree on the outcome: {r['outcomes']}"
+        assert r['distinct_payloads'] <= 1, "waiters received different audio objects"
+    assert synthesis_flight.in_flight() == 0 and synthesis_flight.waiters() == 0
+
+
+if __name__ == '__main__':
+    main()
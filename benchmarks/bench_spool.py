@@ -0,0 +1,181 @@
+"""
+Stress the TEMP_DIR spool with failures injected mid-request, then with a crash.
+
+Runs in a scratch directory with file-backed synthesis (AUDIO_BUFFER_MODE=file)
+and a small quota. ``--threads`` workers each make ``--requests`` requests
+through utils.synthesize like the handlers do. The engine (the tone engine)
+fails part-way through writing a share of the clips (``--engine-failures``),
+and a share of the "uploads" raise after reading part of the file
+(``--upload-failures``). A sampler watches the directory throughout.
+Afterwards every spool file must be gone and the file count must never have
+exceeded the quota.
+
+A second process then runs the same load and is killed with SIGKILL
+mid-flight, leaving its open files behind. A fresh process's startup sweep
+(with the TTL set to 0) must remove all of them.
+
+Usage:
+    python benchmarks/bench_spool.py [--threads 8] [--requests 200] [--engine-failures 0.2]
+                                     [--upload-failures 0.2] [--max-files 6]
+"""
+import argparse
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def configure(max_files: int) -> None:
+    # TEMP_DIR is relative to the working directory outside Render
+    os.chdir(os.environ.get('BENCH_SPOOL_DIR') or tempfile.mkdtemp())
+    os.environ.update({
+        'TELEGRAM_TOKEN': '123456:benchmark', 'TTS_ENGINES': 'tone', 'AUDIO_BUFFER_MODE': 'file',
+        'SEGMENT_CACHE': 'false', 'VOICE_ENCODING': 'none', 'SPOOL_MAX_FILES': str(max_files),
+        'SPOOL_ORPHAN_TTL': '0', 'LOG_LEVEL': 'CRITICAL',
+    })
+
+
+def spool_files(root: str) -> tuple:
+    """Return (count, bytes) of spool files in ``root``."""
+    count = total = 0
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return 0, 0
+    for entry in entries:
+        if entry.name.startswith('spool-'):
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+            count += 1
+    return count, total
+
+
+def load(threads: int, requests: int, engine_failures: float, upload_failures: float) -> dict:
+    """Run the request loop on ``threads`` threads; ``requests`` of 0 runs until killed."""
+    import utils
+    from engines import ToneEngine, set_engine
+
+    class FlakyEngine(ToneEngine):
+        """Tone engine that stops with an error part-way through some clips."""
+
+        name = 'flaky'
+
+        def stream(self, text: str, lang: str):
+            fail = random.random() < engine_failures
+            for index, part in enumerate(super().stream(text, lang)):
+                if fail and index == 1:
+                    raise RuntimeError("engine failed mid-clip")
+                yield part
+
+    set_engine(FlakyEngine())
+    results = {'ok': 0, 'synthesis_failed': 0, 'upload_failed': 0}
+    lock = threading.Lock()
+
+    def worker(seed: int) -> None:
+        rng = random.Random(seed)
+        count = 0
+        while not requests or count < requests:
+            count += 1
+            text = f"Stress request {seed}-{count} with a few words of text to speak. " * rng.randint(1, 4)
+            success, result = utils.synthesize(text, 'en')
+            if not success:
+                outcome = 'synthesis_failed'
+            else:
+                try:
+                    result.read(512)
+                    if rng.random() < upload_failures:
+                        raise ConnectionError("upload failed")
+                    result.read()
+                    outcome = 'ok'
+                except ConnectionError:
+                    outcome = 'upload_failed'
+                finally:
+                    result.close()
+            with lock:
+                results[outcome] += 1
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='requests per thread')
+    parser.add_argument('--engine-failures', type=float, default=0.2)
+    parser.add_argument('--upload-failures', type=float, default=0.2)
+    parser.add_argument('--max-files', type=int, default=6)
+    parser.add_argument('--crash-child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--sweep-child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    configure(args.max_files)
+
+    if args.crash_child:
+        load(args.threads, 0, args.engine_failures, args.upload_failures)
+        return
+    if args.sweep_child:
+        from spool import spool
+        print(spool.sweep())
+        return
+
+    from config import TEMP_DIR
+    from spool import spool
+
+    peak = [0, 0]
+    done = threading.Event()
+
+    def sample() -> None:
+        while not done.is_set():
+            files, size = spool_files(TEMP_DIR)
+            peak[0], peak[1] = max(peak[0], files), max(peak[1], size)
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    results = load(args.threads, args.requests, args.engine_failures, args.upload_failures)
+    elapsed = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    left, _ = spool_files(TEMP_DIR)
+    stats = spool.stats()
+    print(f"{sum(results.values())} requests in {elapsed:.1f} s: {results}")
+    print(f"spool quota {args.max_files} files: peak {peak[0]} files / {peak[1]} bytes on disk, "
+          f"{stats['full']} refused as full, {left} left afterwards, {stats['live_files']} still referenced")
+    assert left == 0 and stats['live_files'] == 0, "spool files leaked"
+    assert peak[0] <= args.max_files, "spool exceeded its file quota"
+
+    # Crash a process mid-flight, then let a new one sweep what it left
+    workdir = os.getcwd()
+    env = dict(os.environ, BENCH_SPOOL_DIR=workdir)
+    child = subprocess.Popen([sys.executable, __file__, '--crash-child', '--threads', str(args.threads),
+                              '--max-files', str(args.max_files)], env=env)
+    deadline = time.monotonic() + 30
+    while spool_files(TEMP_DIR)[0] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.5)
+    child.send_signal(signal.SIGKILL)
+    child.wait()
+    orphaned, _ = spool_files(TEMP_DIR)
+    swept = int(subprocess.run([sys.executable, __file__, '--sweep-child'], env=env,
+                               capture_output=True, text=True, check=True).stdout.split()[-1])
+    left, _ = spool_files(TEMP_DIR)
+    print(f"killed process left {orphaned} files; startup sweep removed {swept}, {left} left")
+    assert orphaned > 0 and left == 0, "orphans survived the startup sweep"
+
+
+if __name__ == '__main__':
+    main()
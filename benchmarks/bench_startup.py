@@ -0,0 +1,158 @@
+"""
+Measure startup of the web and worker roles: import time and time to first reply.
+
+Each role is started as a fresh process, as the deploy does:
+
+* web: the role's module is imported (``web`` here, ``main`` in trees that
+  still deploy ``main:app``) and served with werkzeug; time to first reply
+  is from spawning the process until /metrics answers 200.
+* worker: ``python worker.py`` (``python main.py`` with RENDER=true in older
+  trees) polls the fake Bot API, which holds one text message; time to first
+  reply is from spawning the process until the voice reply is sent. The tone
+  engine synthesizes, so no network is needed.
+
+Import time is measured inside a separate child that imports what the role
+loads before it can answer (``web``, or ``bot`` for the worker).
+``--baseline REF`` runs the same measurements against another commit,
+extracted with ``git archive``, for comparison.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--baseline HEAD~1]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+TOKEN = '123456:benchmark'
+
+_IMPORT = (
+    "import sys, time\n"
+    "start = time.perf_counter()\n"
+    "__import__(sys.argv[1])\n"
+    "print(time.perf_counter() - start)\n"
+)
+_SERVE = (
+    "import sys\n"
+    "from werkzeug.serving import make_server\n"
+    "make_server('127.0.0.1', int(sys.argv[2]), __import__(sys.argv[1]).app).serve_forever()\n"
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def environment(tree: str, api: FakeBotAPI = None) -> dict:
+    env = dict(os.environ, TELEGRAM_TOKEN=TOKEN, TTS_ENGINES='tone', BOT_MODE='polling', LOG_LEVEL='WARNING',
+               DATABASE_URL=f"sqlite:///{tempfile.mkdtemp()}/bot.db", PYTHONPATH=tree)
+    if api is not None:
+        env['TELEGRAM_API_URL'] = api.base_url
+    return env
+
+
+def import_seconds(tree: str, module: str) -> float:
+    out = subprocess.run([sys.executable, '-c', _IMPORT, module], env=environment(tree), cwd=tempfile.mkdtemp(),
+                         capture_output=True, text=True, check=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def web_first_reply(tree: str, module: str, timeout: float = 60) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', _SERVE, module, str(port)], env=environment(tree),
+                               cwd=tempfile.mkdtemp(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"{module} did not answer within {timeout} s")
+    finally:
+        process.kill()
+        process.wait()
+
+
+def worker_first_reply(tree: str, timeout: float = 60) -> float:
+    api = FakeBotAPI().start()
+    api.push_update({'message': {
+        'message_id': 1, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'Startup'}, 'text': 'Hello there, this is a startup test.',
+    }})
+    if os.path.exists(os.path.join(tree, 'worker.py')):
+        command, env = [sys.executable, os.path.join(tree, 'worker.py')], environment(tree, api)
+    else:
+        command, env = [sys.executable, os.path.join(tree, 'main.py')], dict(environment(tree, api), RENDER='true')
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, cwd=tempfile.mkdtemp(),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if api.calls['sendVoice']:
+                return time.perf_counter() - start
+            time.sleep(0.005)
+        raise TimeoutError(f"the worker sent no voice reply within {timeout} s")
+    finally:
+        process.kill()
+        process.wait()
+        api.stop()
+
+
+def measure(tree: str, runs: int) -> dict:
+    web = 'web' if os.path.exists(os.path.join(tree, 'web.py')) else 'main'
+    results = {}
+    for role, imported, first_reply in (('web', web, lambda: web_first_reply(tree, web)),
+                                        ('worker', 'bot', lambda: worker_first_reply(tree))):
+        results[role] = {
+            'import_ms': statistics.median(import_seconds(tree, imported) for _ in range(runs)) * 1000,
+            'reply_ms': statistics.median(first_reply() for _ in range(runs)) * 1000,
+        }
+    return results
+
+
+def extract(ref: str) -> str:
+    tree = tempfile.mkdtemp()
+    archive = subprocess.run(['git', 'archive', ref], cwd=ROOT, capture_output=True, check=True).stdout
+    path = os.path.join(tree, 'tree.tar')
+    with open(path, 'wb') as f:
+        f.write(archive)
+    with tarfile.open(path) as tar:
+        tar.extractall(tree)
+    os.remove(path)
+    return tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--baseline', help='git ref to compare against, e.g. HEAD~1')
+    args = parser.parse_args()
+
+    trees = [('working tree', ROOT)]
+    if args.baseline:
+        trees.insert(0, (args.baseline, extract(args.baseline)))
+    print(f"median of {args.runs} runs")
+    print(f"{'tree':<14} {'role':<7} {'import ms':>9} {'first reply ms':>14}")
+    for name, tree in trees:
+        for role, r in measure(tree, args.runs).items():
+            print(f"{name:<14} {role:<7} {r['import_ms']:>9.0f} {r['reply_ms']:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Exercise the bot status history: sampling cost, batched flushes, rollups and history queries.
+
+Runs against a scratch SQLite database. It checks that only one process holds
+the recorder lease and that the leader adds up the counters another process
+publishes, then measures the cost of one vitals sample and of writing a day of samples in one batch against one insert and
+commit per row. Then it simulates ``--days`` of history ending now: each
+simulated hour adds 60 minute rows and runs the rollup, with the retention
+limits of STATUS_MINUTE_RETENTION_HOURS, STATUS_HOUR_RETENTION_DAYS and
+STATUS_DAY_RETENTION_DAYS (24 hours, 7 days and 30 days unless set). The
+table must stay within the retention bounds, and /status/history is timed for the last day, week and month,
+along with the query plan SQLite picks for it.
+
+Usage:
+    python benchmarks/bench_status.py [--days 60]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'status.db')}"
+os.environ.setdefault('STATUS_MINUTE_RETENTION_HOURS', '24')
+os.environ.setdefault('STATUS_HOUR_RETENTION_DAYS', '7')
+os.environ.setdefault('STATUS_DAY_RETENTION_DAYS', '30')
+
+import logging  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+from sqlalchemy import func, insert, text, update  # noqa: E402
+from app import app, db, init_db  # noqa: E402
+from config import STATUS_MINUTE_RETENTION_HOURS, STATUS_HOUR_RETENTION_DAYS, STATUS_DAY_RETENTION_DAYS  # noqa: E402
+from models import BotStatus, Lease, MetricsSnapshot  # noqa: E402
+from metrics import STAGE_SECONDS  # noqa: E402
+from status import StatusRecorder  # noqa: E402
+
+
+def minute_row(at: datetime, rng: random.Random) -> dict:
+    healthy = rng.random() > 0.002
+    return {
+        'timestamp': at, 'resolution': 'minute', 'status': 'healthy' if healthy else 'unhealthy',
+        'last_health_check': at + timedelta(seconds=59), 'samples': 1, 'healthy_samples': int(healthy),
+        'updates_per_second': rng.uniform(0, 5), 'synthesis_p50': rng.uniform(0.3, 0.8),
+        'synthesis_p95': rng.uniform(0.8, 2.5), 'synthesis_p99': rng.uniform(2.5, 6), 'queue_depth': rng.randint(0, 20),
+    }
+
+
+def counts() -> dict:
+    with app.app_context():
+        return dict(db.session.query(BotStatus.resolution, func.count()).group_by(BotStatus.resolution).all())
+
+
+def publish_peer(updates: int, queue_depth: int) -> None:
+    """Store the metrics snapshot of a made-up second bot process."""
+    payload = {'bot_updates_received_total': {'series': [[[], updates]]},
+               'bot_queue_depth': {'series': [[[], queue_depth]]}}
+    with app.app_context():
+        db.session.merge(MetricsSnapshot(process='peer:2', updated_at=datetime.utcnow(), payload=json.dumps(payload)))
+        db.session.commit()
+
+
+def check_leadership() -> None:
+    """Only one recorder leads; another takes over once the lease expires; the leader sums both processes."""
+    first, second = StatusRecorder(), StatusRecorder()
+    second.owner = 'peer:1'
+    assert first.lead() and not second.lead(), "two recorders lead at once"
+    assert first.lead(), "the leader could not renew its lease"
+    with app.app_context():
+        db.session.execute(update(Lease).values(expires_at=datetime(2000, 1, 1)))
+        db.session.commit()
+    assert second.lead() and not first.lead(), "an expired lease was not taken over"
+
+    publish_peer(updates=100, queue_depth=0)
+    second._baseline()
+    publish_peer(updates=160, queue_depth=7)
+    row = second.sample()
+    assert row['queue_depth'] >= 7 and row['updates_per_second'] > 0, row
+    print("lease: one leader at a time, taken over after expiry; the leader counts another process's "
+          "updates and queue")
+    with app.app_context():
+        db.session.query(MetricsSnapshot).delete()
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--days', type=int, default=60)
+    args = parser.parse_args()
+    init_db()
+    rng = random.Random(0)
+    check_leadership()
+
+    recorder = StatusRecorder(buffer_size=1440)
+    for _ in range(200):
+        STAGE_SECONDS.observe(rng.uniform(0.2, 3), stage='synthesis', lang='en')
+    start = time.perf_counter()
+    for _ in range(1440):
+        recorder.sample()
+    sample_us = (time.perf_counter() - start) / 1440 * 1e6
+    start = time.perf_counter()
+    flushed = recorder.flush()
+    batch_ms = (time.perf_counter() - start) * 1000
+    rows = [minute_row(datetime(2000, 1, 1) + timedelta(minutes=i), rng) for i in range(1440)]
+    start = time.perf_counter()
+    with app.app_context():
+        for row in rows:
+            db.session.execute(insert(BotStatus), [row])
+            db.session.commit()
+        row_ms = (time.perf_counter() - start) * 1000
+        db.session.query(BotStatus).delete()
+        db.session.commit()
+    print(f"sample: {sample_us:.1f} us; writing {flushed} samples: {batch_ms:.0f} ms batched, "
+          f"{row_ms:.0f} ms one commit per row")
+
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    hour = (now - timedelta(days=args.days)).replace(minute=0)
+    start = time.perf_counter()
+    rollups = 0
+    while hour < now.replace(minute=0):
+        with app.app_context():
+            db.session.execute(insert(BotStatus), [minute_row(hour + timedelta(minutes=m), rng) for m in range(60)])
+            db.session.commit()
+        hour += timedelta(hours=1)
+        recorder.rollup(now=hour)
+        rollups += 1
+    elapsed = time.perf_counter() - start
+    rows = counts()
+    bound = {'minute': STATUS_MINUTE_RETENTION_HOURS * 60 + 60, 'hour': STATUS_HOUR_RETENTION_DAYS * 24 + 24,
+             'day': STATUS_DAY_RETENTION_DAYS + 1}
+    print(f"{args.days} days simulated with {rollups} hourly rollups in {elapsed:.1f} s "
+          f"({elapsed / rollups * 1000:.1f} ms per hour of history)")
+    print(f"rows kept: {rows} (bounds {bound}), {sum(rows.values())} in total instead of {args.days * 1440}")
+    assert all(rows.get(resolution, 0) <= limit for resolution, limit in bound.items()), "retention exceeded"
+
+    client = app.test_client()
+    print(f"{'range':<6} {'resolution':<10} {'points':>6} {'uptime':>8} {'ms':>6}")
+    for name, delta in (('day', timedelta(days=1)), ('week', timedelta(days=7)), ('month', timedelta(days=30))):
+        query = f"/status/history?start={(now - delta).isoformat()}Z&end={now.isoformat()}Z"
+        client.get(query)
+        start = time.perf_counter()
+        response = client.get(query)
+        ms = (time.perf_counter() - start) * 1000
+        body = response.get_json()
+        assert response.status_code == 200 and body['points'], body
+        print(f"{name:<6} {body['resolution']:<10} {len(body['points']):>6} {body['uptime']:>8.4f} {ms:>6.1f}")
+    with app.app_context():
+        plan = db.session.execute(text(
+            "EXPLAIN QUERY PLAN SELECT * FROM bot_status_history WHERE resolution = 'minute' "
+            "AND timestamp >= '2000-01-01' AND timestamp < '2100-01-01' ORDER BY timestamp"
+        )).all()
+    print("query plan:", '; '.join(row[-1] for row in plan))
+
+
+if __name__ == '__main__':
+    main()
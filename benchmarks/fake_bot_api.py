@@ -0,0 +1,188 @@
+"""
+Local stand-in for the Telegram Bot API used by the benchmarks.
+
+Serves ``/bot<token>/<method>`` over plain HTTP with keep-alive, answers the
+methods the bot uses with well-formed results, records when each call was
+made, and can emulate Telegram's flood control by answering 429 with a
+``retry_after`` once a global messages-per-second limit is exceeded.
+
+Point a bot at it with ``Bot(token, base_url=server.base_url)``.
+"""
+import itertools
+import json
+import queue
+import re
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+_PATH = re.compile(r'^/bot(?P<token>[^/]+)/(?P<method>\w+)$')
+_MULTIPART_FIELD = re.compile(rb'name="(?P<name>[^"]+)"\r\n\r\n(?P<value>[^\r]*)\r\n')
+_SEND_METHODS = {'sendMessage', 'sendVoice', 'editMessageText'}
+
+
+class FakeBotAPI:
+    """
+    Threaded fake Bot API server.
+
+    Args:
+        rate_limit (float): Sends per second allowed before answering 429, or None
+        latency (float): Seconds to sleep before answering each call
+    """
+
+    def __init__(self, rate_limit: float = None, latency: float = 0.0, host: str = '127.0.0.1'):
+        self.rate_limit = rate_limit
+        self.latency = latency
+        self.calls = Counter()
+        self.sent = []  # (monotonic time, method, chat_id, payload)
+        self.updates = queue.Queue()
+        self.flood_hits = 0
+        self._window = deque()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._server = ThreadingHTTPServer((host, 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self) -> 'FakeBotAPI':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, update: dict) -> int:
+        """Queue a raw update for getUpdates, assigning its update_id. Returns the id."""
+        update_id = next(self._update_ids)
+        update = dict(update, update_id=update_id)
+        self.updates.put(update)
+        return update_id
+
+    def _flood_controlled(self) -> float:
+        """Return seconds to retry after if this send exceeds the rate limit, else 0."""
+        if self.rate_limit is None:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            while self._window and now - self._window[0] >= 1.0:
+                self._window.popleft()
+            if len(self._window) >= self.rate_limit:
+                self.flood_hits += 1
+                return 1
+            self._window.append(now)
+        return 0
+
+    def _get_updates(self, params: dict) -> list:
+        timeout = float(params.get('timeout') or 0)
+        offset = int(params.get('offset') or 0)
+        updates = []
+        try:
+            updates.append(self.updates.get(timeout=max(timeout, 0.01)))
+            while True:
+                updates.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return [u for u in updates if u['update_id'] >= offset]
+
+    def _message(self, chat_id, **fields) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id or 0), 'type': 'private'},
+        }
+        message.update(fields)
+        return message
+
+    def dispatch(self, method: str, params: dict):
+        """Answer one Bot API call. Returns (status, payload)."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+        if str(params.get('chat_id', '')).lstrip('-').isdigit():
+            # Form-encoded calls carry every parameter as a string
+            params['chat_id'] = int(params['chat_id'])
+        if method in _SEND_METHODS:
+            retry_after = self._flood_controlled()
+            if retry_after:
+                return 429, {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {retry_after}',
+                    'parameters': {'retry_after': retry_after},
+                }
+            with self._lock:
+                self.sent.append((time.monotonic(), method, params.get('chat_id'), params))
+
+        chat_id = params.get('chat_id')
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        elif method == 'getUpdates':
+            result = self._get_updates(params)
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self._message(chat_id, text=params.get('text', ''))
+        elif method == 'sendVoice':
+            file_id = f"voice-{next(self._file_ids)}"
+            result = self._message(chat_id, voice={
+                'file_id': file_id, 'file_unique_id': file_id, 'duration': 1,
+            })
+        else:
+            # sendChatAction, answerCallbackQuery, deleteWebhook, setWebhook, ...
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; avoid Nagle/delayed-ACK stalls
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionError:
+                    pass  # The bot was stopped mid-request, e.g. during a long poll
+
+            def do_POST(self):
+                match = _PATH.match(self.path.split('?', 1)[0])
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if not match:
+                    self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                    return
+                self._reply(*api.dispatch(match.group('method'), self._params(body)))
+
+            do_GET = do_POST
+
+            def _params(self, body: bytes) -> dict:
+                content_type = self.headers.get('Content-Type', '')
+                if 'json' in content_type:
+                    return json.loads(body or b'{}')
+                if 'multipart' in content_type:
+                    return {m.group('name').decode(): m.group('value').decode('utf-8', 'replace')
+                            for m in _MULTIPART_FIELD.finditer(body)}
+                return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+            def _reply(self, status: int, payload: dict):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
@@ -0,0 +1,112 @@
+"""
+Local stand-in for the Google Translate text-to-speech endpoint that gTTS calls.
+
+Answers gTTS's batchexecute POSTs the way Google does, with the audio as
+base64 in a ``jQ1olc`` line, after a configurable latency, and fails a
+configurable share of requests with HTTP 500. The audio is silent MPEG-2
+Layer III at 24 kHz / 32 kbit/s, gTTS's own format, sized like real speech
+for the requested text.
+
+Point the bot at it with ``GTTS_ENDPOINT=<server.url>``.
+"""
+import base64
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Header of one silent MPEG-2 Layer III frame: 32 kbit/s, 24 kHz, mono, no CRC.
+# A frame holds 576 samples (24 ms) in 72 * 32000 / 24000 = 96 bytes
+_FRAME = bytes([0xFF, 0xF3, 0x44, 0xC4]) + bytes(92)
+_FRAME_SECONDS = 576 / 24000
+# Roughly how long gTTS speaks per character
+_SECONDS_PER_CHAR = 0.065
+
+
+def silent_mp3(text: str) -> bytes:
+    """Return silent MP3 about as long as gTTS takes to speak ``text``."""
+    return _FRAME * max(1, round(len(text) * _SECONDS_PER_CHAR / _FRAME_SECONDS))
+
+
+class FakeTTS:
+    """
+    Threaded fake gTTS endpoint.
+
+    Args:
+        latency (float): Seconds to wait before answering each request
+        error_rate (float): Share of requests answered with HTTP 500, from 0 to 1
+        seed (int): Seed for choosing which requests fail, for repeatable runs
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0, host: str = '127.0.0.1'):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()  # 'ok' and 'error' answers
+        self.characters = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/_/TranslateWebserverUi/data/batchexecute"
+
+    def start(self) -> 'FakeTTS':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def dispatch(self, body: bytes):
+        """Answer one request. Returns (status, response body)."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+            self.calls['error' if failed else 'ok'] += 1
+        if failed:
+            return 500, b'Internal Server Error'
+        # f.req is [[["jQ1olc", "[\"<text>\",\"<lang>\",null,\"null\"]", null, "generic"]]]
+        request = json.loads(parse_qs(body.decode())['f.req'][0])
+        text = json.loads(request[0][0][1])[0]
+        with self._lock:
+            self.characters += len(text)
+        audio = base64.b64encode(silent_mp3(text)).decode('ascii')
+        line = json.dumps([['wrb.fr', 'jQ1olc', json.dumps([audio]), None, None, None, 'generic']],
+                          separators=(',', ':'))
+        return 200, f")]}}'\n\n{len(line)}\n{line}\n".encode()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionError:
+                    pass  # The client gave up, e.g. after an engine timeout
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                status, data = server.dispatch(body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
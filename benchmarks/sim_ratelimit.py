@@ -0,0 +1,108 @@
+"""
+Simulate light users sharing synthesis capacity with one heavy user.
+
+Runs a discrete-event simulation on a virtual clock: messages queue FIFO
+for a fixed pool of synthesis workers whose service time grows with text
+length. The real CharacterRateLimiter is driven by the virtual clock, so the
+output shows light users' latency with no heavy user, with an unthrottled
+heavy user, and with the limiter in front of the queue. The run fails if the
+limiter lets light users' p99 grow past twice what it is without the heavy
+user, or stops serving the heavy user altogether.
+
+Usage:
+    python benchmarks/sim_ratelimit.py [--seconds 600] [--light-users 50]
+"""
+import argparse
+import heapq
+import os
+import random
+import sys
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+from ratelimit import CharacterRateLimiter  # noqa: E402
+
+WORKERS = 4
+HEAVY_USER = 0
+
+
+def service_time(chars: int) -> float:
+    """Rough gTTS cost: fixed round-trip overhead plus time per character."""
+    return 0.3 + chars / 1000
+
+
+def workload(seconds: float, light_users: int, heavy: bool, rng: random.Random) -> list:
+    arrivals = []
+    for user_id in range(1, light_users + 1):
+        t = rng.expovariate(1 / 10)
+        while t < seconds:
+            arrivals.append((t, user_id, rng.randint(20, 200)))
+            t += rng.expovariate(1 / 10)
+    if heavy:
+        t = 0.0
+        while t < seconds:
+            arrivals.append((t, HEAVY_USER, 20000))
+            t += 2.0
+    arrivals.sort()
+    return arrivals
+
+
+def simulate(arrivals: list, limiter: CharacterRateLimiter = None, clock: list = None) -> dict:
+    free_at = [0.0] * WORKERS
+    heapq.heapify(free_at)
+    light, heavy_served, throttled = [], 0, 0
+    for arrival, user_id, chars in arrivals:
+        if limiter is not None:
+            clock[0] = arrival
+            if limiter.consume(user_id, chars) > 0:
+                throttled += 1
+                continue
+        start = max(arrival, heapq.heappop(free_at))
+        done = start + service_time(chars)
+        heapq.heappush(free_at, done)
+        if user_id == HEAVY_USER:
+            heavy_served += 1
+        else:
+            light.append(done - arrival)
+    light.sort()
+    return {
+        'p50': light[len(light) // 2],
+        'p99': light[int(len(light) * 0.99) - 1],
+        'heavy_served': heavy_served,
+        'throttled': throttled,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=600)
+    parser.add_argument('--light-users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    clock = [0.0]
+    scenarios = [
+        ('light only', workload(args.seconds, args.light_users, False, random.Random(args.seed)), None),
+        ('heavy, no limit', workload(args.seconds, args.light_users, True, random.Random(args.seed)), None),
+        ('heavy, limited', workload(args.seconds, args.light_users, True, random.Random(args.seed)),
+         CharacterRateLimiter(exempt=(), clock=lambda: clock[0])),
+    ]
+
+    print(f"{'scenario':<16} {'light p50 s':>12} {'light p99 s':>12} {'heavy served':>13} {'throttled':>10}")
+    results = {}
+    for name, arrivals, limiter in scenarios:
+        r = results[name] = simulate(arrivals, limiter, clock)
+        print(f"{name:<16} {r['p50']:>12.2f} {r['p99']:>12.2f} {r['heavy_served']:>13} {r['throttled']:>10}")
+
+    limited = results['heavy, limited']
+    assert limited['p99'] <= 2 * results['light only']['p99'], "the limiter did not protect light users' p99"
+    assert limited['heavy_served'] > 0, "the limiter starved the heavy user"
+
+
+if __name__ == '__main__':
+    main()
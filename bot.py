@@ -1,38 +1,40 @@
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
-from config import TELEGRAM_TOKEN, logger
+from telegram import Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, TypeHandler
+from config import TELEGRAM_TOKEN, TELEGRAM_API_URL, JOB_DRAIN_SECONDS, SHARD_WORKERS, STATUS_HISTORY
 from handlers import (
     start_command,
     help_command,
-    handle_text,
+    text_handler,
     error_handler,
     lang_command,
     button_callback,
-    broadcast_command
+    broadcast_command,
+    stats_command
 )
+from scheduler import scheduler
+from jobqueue import job_queue, durable, track_offset, resume_jobs
+from ratelimit import rate_limited
+from broadcast import resume_broadcasts
+from userstore import user_store
+from heartbeat import heartbeat, track_update, HeartbeatBot
+from logs import bind_update
+from httppool import http_pool
+from shards import shard_pool
+from app import init_db
+from utils import warm_up
+from spool import spool
+from status import status_recorder
+import logging
 import signal
 import sys
 import os
 import atexit
 import time
-import threading
+
+logger = logging.getLogger(__name__)
 
 # Global updater instance for cleanup
 _updater = None
-_last_health_check = time.time()
-_health_check_interval = 300  # 5 minutes
-
-def health_check():
-    """Periodic health check function."""
-    global _last_health_check
-    while True:
-        try:
-            current_time = time.time()
-            if current_time - _last_health_check > _health_check_interval:
-                logger.info("Health check: Bot is running normally")
-                _last_health_check = current_time
-            time.sleep(60)  # Check every minute
-        except Exception as e:
-            logger.error(f"Health check error: {str(e)}")
 
 def cleanup():
     """Cleanup function to be called on exit."""
@@ -40,69 +42,122 @@ def cleanup():
     if _updater:
         logger.info("Cleaning up bot resources...")
         try:
+            # Stops polling first; the dispatcher then hands every update it
+            # already received to the job queue before it stops
             _updater.stop()
+            # Shard workers finish their queued jobs and acknowledge what they handled
+            shard_pool.stop(JOB_DRAIN_SECONDS)
+            job_queue.commit_offset()
+            user_store.flush()
             logger.info("Bot resources cleaned up successfully")
         except Exception as e:
-            logger.error(f"Error during cleanup: {str(e)}")
+            logger.error("Error during cleanup: %s", e)
 
 def signal_handler(signum, frame):
     """Handle shutdown signals gracefully."""
-    logger.info(f"Received shutdown signal {signum}. Stopping bot...")
+    logger.info("Received shutdown signal %s. Stopping bot...", signum)
     cleanup()
+    # Let queued jobs finish; whatever is left is resumed by the next process
+    if not scheduler.drain(JOB_DRAIN_SECONDS):
+        released = job_queue.release()
+        logger.warning("Jobs still running after %ss, %s handed back to the queue", JOB_DRAIN_SECONDS, released)
+    scheduler.shutdown(wait=False)
+    user_store.stop()
     sys.exit(0)
 
+def register_handlers(dispatcher) -> None:
+    """Add the bot's command, message and callback handlers to a dispatcher."""
+    # Tag log records with the update's id, and record every update for the
+    # heartbeat, before the regular handlers run
+    dispatcher.add_handler(TypeHandler(Update, bind_update), group=-2)
+    dispatcher.add_handler(TypeHandler(Update, track_update), group=-1)
+    dispatcher.add_handler(CommandHandler("start", start_command))
+    dispatcher.add_handler(CommandHandler("help", help_command))
+    dispatcher.add_handler(CommandHandler("lang", lang_command))
+    dispatcher.add_handler(CommandHandler("broadcast", broadcast_command))
+    dispatcher.add_handler(CommandHandler("stats", stats_command))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, rate_limited(durable(text_handler))))
+
+    # Add callback query handler for inline keyboard buttons
+    dispatcher.add_handler(CallbackQueryHandler(button_callback))
+
+    # Add error handler
+    dispatcher.add_error_handler(error_handler)
+
+def register_routing(dispatcher) -> None:
+    """Make a dispatcher forward every update to the shard workers instead of handling it."""
+    dispatcher.add_handler(TypeHandler(Update, bind_update), group=-2)
+    dispatcher.add_handler(TypeHandler(Update, track_update), group=-1)
+    dispatcher.add_handler(TypeHandler(Update, shard_pool.route))
+    dispatcher.add_error_handler(error_handler)
+
 def run_bot() -> None:
     """Run the bot."""
     global _updater
 
+    # One-time setup; a restart below only rebuilds the Updater
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    atexit.register(cleanup)
+    logger.info("Initializing bot...")
+    init_db()
+    # Load stored preferences and start writing changes back in the background
+    user_store.load()
+    user_store.start()
+    # Remove audio files left behind by a previous run, then keep TEMP_DIR swept
+    spool.start()
+
     while True:  # Main restart loop
         try:
-            # Set up signal handlers for graceful shutdown
-            signal.signal(signal.SIGINT, signal_handler)
-            signal.signal(signal.SIGTERM, signal_handler)
-            atexit.register(cleanup)
-
-            logger.info("Initializing bot...")
-            # Create the Updater with a higher read timeout to handle conflicts better
-            _updater = Updater(TELEGRAM_TOKEN, use_context=True, request_kwargs={'read_timeout': 30})
-            dispatcher = _updater.dispatcher
-
-            # Add handlers
-            dispatcher.add_handler(CommandHandler("start", start_command))
-            dispatcher.add_handler(CommandHandler("help", help_command))
-            dispatcher.add_handler(CommandHandler("lang", lang_command))
-            dispatcher.add_handler(CommandHandler("broadcast", broadcast_command))
-            dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text))
-
-            # Add callback query handler for inline keyboard buttons
-            dispatcher.add_handler(CallbackQueryHandler(button_callback))
-
-            # Add error handler
-            dispatcher.add_error_handler(error_handler)
+            # Create the Updater on the shared keep-alive connection pool; the bot
+            # reports each completed poll to the heartbeat
+            bot = HeartbeatBot(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL, request=http_pool.telegram_request())
+            _updater = Updater(bot=bot, use_context=True)
+
+            if SHARD_WORKERS:
+                # Handlers run in the shard workers; the offset follows their acknowledgements
+                shard_pool.start(on_handled=job_queue.handled)
+                register_routing(_updater.dispatcher)
+            else:
+                register_handlers(_updater.dispatcher)
+                # Advance the committed offset once all other handlers have run
+                _updater.dispatcher.add_handler(TypeHandler(Update, track_offset), group=1)
 
             logger.info("Starting bot...")
 
-            # Start health check thread
-            health_thread = threading.Thread(target=health_check, daemon=True)
-            health_thread.start()
+            # Publish liveness data for /health
+            heartbeat.start('polling', backlog=shard_pool.backlog if SHARD_WORKERS else None)
+            if STATUS_HISTORY:
+                # Sample the bot's vitals into the status history
+                status_recorder.start()
 
-            # Ensure clean start by removing webhook and dropping pending updates
+            # Remove any webhook, keeping the updates Telegram has queued for us.
+            # Telegram has applied the change by the time it answers
             _updater.bot.delete_webhook()
             logger.info("Webhook deleted")
 
-            # Small delay to ensure webhook deletion is processed
-            time.sleep(1)
-
-            logger.info("Starting polling...")
-            # Use only drop_pending_updates to avoid conflict with clean parameter
-            _updater.start_polling(drop_pending_updates=True)
+            # Resume right after the last update a previous run fully accepted
+            offset = job_queue.committed_offset()
+            if offset is not None:
+                _updater.last_update_id = offset + 1
+            logger.info("Starting polling from update offset %s...", _updater.last_update_id)
+            _updater.start_polling(drop_pending_updates=False)
             logger.info("Bot is running...")
+            if not SHARD_WORKERS:
+                warm_up()
+
+            # Pick up jobs and broadcasts interrupted by a previous restart; shard
+            # workers resume their own users' jobs
+            if not SHARD_WORKERS:
+                resume_jobs(_updater.dispatcher, text_handler)
+            resume_broadcasts(_updater.bot)
 
-            # Run the bot until a stop signal is received
-            _updater.idle()
+            # Run the bot until a stop signal is received. PTB's own handlers would
+            # replace signal_handler and only stop the updater, so none are installed
+            _updater.idle(stop_signals=())
 
         except Exception as e:
-            logger.error(f"Error running bot: {str(e)}")
+            logger.error("Error running bot: %s", e)
             cleanup()
             logger.info("Waiting 10 seconds before restart attempt...")
             time.sleep(10)  # Wait before attempting restart
\ No newline at end of file
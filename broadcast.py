@@ -0,0 +1,250 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import select, update
+from telegram import Bot
+from telegram.error import RetryAfter, Unauthorized, BadRequest, TelegramError
+from app import app, db
+from models import BroadcastJob
+from userstore import user_store
+from config import (
+    BROADCAST_MAX_RATE,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_BATCH_SIZE,
+    BROADCAST_PROGRESS_INTERVAL,
+    BROADCAST_LEASE_SECONDS,
+    BROADCAST_STARTED,
+    BROADCAST_PROGRESS,
+    BROADCAST_DONE
+)
+from metrics import BROADCAST_MESSAGES, BROADCAST_RETRY_AFTER
+
+logger = logging.getLogger(__name__)
+
+# Attempts per recipient for RetryAfter and transient network errors
+MAX_SEND_ATTEMPTS = 5
+
+# Jobs currently being sent by this process
+_active_jobs = set()
+_active_jobs_lock = threading.Lock()
+
+
+class AdaptivePacer:
+    """
+    Spaces sends out to at most ``max_rate`` per second across all threads.
+
+    A RetryAfter from Telegram pauses every sender for the requested time and
+    halves the rate; each success then raises it again by 1% of the ceiling.
+    """
+
+    def __init__(self, max_rate: float = BROADCAST_MAX_RATE, min_rate: float = 1.0):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self) -> None:
+        """Block until the caller's send slot comes up."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.01)
+
+    def retry_after(self, seconds: float) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+def _send(bot: Bot, pacer: AdaptivePacer, chat_id: int, text: str) -> bool:
+    """Send one broadcast message, returning False if the recipient is unreachable."""
+    for attempt in range(MAX_SEND_ATTEMPTS):
+        pacer.wait()
+        try:
+            bot.send_message(chat_id=chat_id, text=text)
+            pacer.success()
+            BROADCAST_MESSAGES.inc(result='sent')
+            return True
+        except RetryAfter as e:
+            logger.warning("Broadcast flood control hit, slowing down for %ss", e.retry_after)
+            BROADCAST_RETRY_AFTER.inc()
+            pacer.retry_after(e.retry_after)
+        except (Unauthorized, BadRequest) as e:
+            logger.debug("Broadcast recipient %s unreachable: %s", chat_id, e)
+            BROADCAST_MESSAGES.inc(result='unreachable')
+            return False
+        except TelegramError as e:
+            logger.warning("Transient error broadcasting to %s (attempt %s): %s", chat_id, attempt + 1, e)
+    BROADCAST_MESSAGES.inc(result='failed')
+    return False
+
+
+def _report(bot: Bot, job: BroadcastJob, text: str) -> None:
+    try:
+        bot.edit_message_text(chat_id=job.admin_chat_id, message_id=job.progress_message_id, text=text)
+    except TelegramError as e:
+        logger.debug("Could not update broadcast progress for job %s: %s", job.id, e)
+
+
+def _execute(bot: Bot, job_id: int) -> None:
+    job = db.session.get(BroadcastJob, job_id)
+
+    if job.progress_message_id is None:
+        progress = bot.send_message(chat_id=job.admin_chat_id, text=BROADCAST_STARTED.format(job.total))
+        job.progress_message_id = progress.message_id
+    job.status = 'running'
+    db.session.commit()
+    logger.info("Broadcast job %s running from user id %s (%s of %s done)",
+                job_id, job.cursor, job.processed, job.total)
+
+    # Read once: ORM attributes expire on commit and must not be loaded from sender threads
+    text = job.message
+    pacer = AdaptivePacer()
+    started_at = time.monotonic()
+    started_processed = job.processed
+    last_report = started_at
+
+    with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix=f'broadcast-{job_id}') as executor:
+        # Recipients are streamed from the users table one page at a time
+        for batch in user_store.iter_active_pages(after_id=job.cursor, page_size=BROADCAST_BATCH_SIZE):
+            results = list(executor.map(lambda chat_id: _send(bot, pacer, chat_id, text), batch))
+            failed = [chat_id for chat_id, ok in zip(batch, results) if not ok]
+
+            # Commit the cursor after every batch; a restart re-sends at most one batch
+            job.cursor = batch[-1]
+            job.processed += len(batch)
+            job.success_count += len(batch) - len(failed)
+            job.failure_count += len(failed)
+            job.updated_at = datetime.utcnow()
+            db.session.commit()
+            user_store.deactivate(failed)
+
+            now = time.monotonic()
+            if now - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                rate = (job.processed - started_processed) / (now - started_at)
+                total = max(job.total, job.processed)
+                _report(bot, job, BROADCAST_PROGRESS.format(job.processed, total, job.failure_count, rate))
+                last_report = now
+
+    job.status = 'done'
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    elapsed = time.monotonic() - started_at
+    logger.info("Broadcast job %s completed: %s successful, %s failed, %.1f msg/s", job_id, job.success_count,
+                job.failure_count, (job.processed - started_processed) / max(elapsed, 1e-9))
+    _report(bot, job, BROADCAST_DONE.format(job.success_count, job.failure_count))
+
+
+def _run_job(bot: Bot, job_id: int) -> None:
+    try:
+        with app.app_context():
+            _execute(bot, job_id)
+    except Exception as e:
+        logger.error("Broadcast job %s stopped: %s", job_id, e)
+    finally:
+        with _active_jobs_lock:
+            _active_jobs.discard(job_id)
+
+
+def _spawn(bot: Bot, job_id: int) -> None:
+    with _active_jobs_lock:
+        if job_id in _active_jobs:
+            return
+        _active_jobs.add(job_id)
+    threading.Thread(target=_run_job, args=(bot, job_id), name=f'broadcast-{job_id}', daemon=True).start()
+
+
+def start_broadcast(bot: Bot, admin_chat_id: int, message: str) -> Optional[int]:
+    """
+    Persist a new broadcast job to all active users and start sending it in the background.
+
+    Args:
+        bot (Bot): Bot to send with
+        admin_chat_id (int): Chat that receives progress updates
+        message (str): Text to broadcast
+
+    Returns:
+        Optional[int]: Id of the new job, or None if there is nobody to send to
+    """
+    # Make sure users seen since the last flush are part of the audience
+    user_store.flush()
+    total = user_store.count_active()
+    if not total:
+        return None
+
+    now = datetime.utcnow()
+    with app.app_context():
+        job = BroadcastJob(
+            admin_chat_id=admin_chat_id,
+            message=message,
+            total=total,
+            cursor=0,
+            processed=0,
+            success_count=0,
+            failure_count=0,
+            status='pending',
+            created_at=now,
+            updated_at=now
+        )
+        db.session.add(job)
+        db.session.commit()
+        job_id = job.id
+    logger.info("Created broadcast job %s for %s users", job_id, total)
+    _spawn(bot, job_id)
+    return job_id
+
+
+def resume_broadcasts(bot: Bot) -> None:
+    """
+    Restart broadcast jobs left unfinished by a previous run.
+
+    Several processes may call this at once (gunicorn workers in webhook
+    mode), so a job is only taken over once it has made no progress for
+    BROADCAST_LEASE_SECONDS, and the takeover is a compare-and-set on
+    ``updated_at`` that exactly one caller can win. Jobs that are still
+    within their lease are checked again once it would have expired.
+    """
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=BROADCAST_LEASE_SECONDS)
+    recheck = False
+    try:
+        with app.app_context():
+            jobs = db.session.execute(
+                select(BroadcastJob.id, BroadcastJob.updated_at).where(BroadcastJob.status != 'done')
+            ).all()
+            claimed = []
+            for job_id, updated_at in jobs:
+                with _active_jobs_lock:
+                    if job_id in _active_jobs:
+                        continue
+                if updated_at > stale_before:
+                    recheck = True
+                    continue
+                result = db.session.execute(
+                    update(BroadcastJob)
+                    .where(BroadcastJob.id == job_id, BroadcastJob.updated_at == updated_at)
+                    .values(updated_at=now)
+                )
+                db.session.commit()
+                if result.rowcount == 1:
+                    claimed.append(job_id)
+    except Exception as e:
+        logger.error("Failed to load unfinished broadcasts: %s", e)
+        return
+    for job_id in claimed:
+        logger.info("Resuming broadcast job %s", job_id)
+        _spawn(bot, job_id)
+    if recheck:
+        timer = threading.Timer(BROADCAST_LEASE_SECONDS, resume_broadcasts, args=(bot,))
+        timer.daemon = True
+        timer.start()
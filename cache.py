@@ -0,0 +1,319 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+from config import (
+    AUDIO_CACHE_MAX_BYTES,
+    AUDIO_CACHE_DISK_MAX_BYTES,
+    AUDIO_CACHE_MAX_FILE_IDS,
+    AUDIO_CACHE_DIR
+)
+from metrics import Gauge
+from spool import pid_running
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+_PROCESS_DIR = re.compile(r'^proc-(?P<pid>\d+)$')
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text so that trivially different messages share a cache entry.
+
+    Args:
+        text (str): Raw message text
+
+    Returns:
+        str: NFC-normalized text with runs of whitespace collapsed
+    """
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def make_key(text: str, lang: str) -> str:
+    """
+    Build the content-addressed cache key for a (text, lang) pair.
+
+    Args:
+        text (str): Text to be spoken
+        lang (str): Language code
+
+    Returns:
+        str: Hex digest identifying the audio clip
+    """
+    payload = f"{lang}\x00{normalize_text(text)}".encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()
+
+
+class AudioCache:
+    """
+    Two-tier LRU cache of synthesized audio plus the Telegram file_ids it was uploaded as.
+
+    The memory tier is bounded by ``max_bytes``; entries evicted from it are
+    spilled to disk, which is in turn bounded by ``disk_max_bytes``.
+
+    Several processes (shard workers, gunicorn workers) share ``cache_dir``,
+    so each one spills to its own ``proc-<pid>`` subdirectory and enforces
+    the budget there alone. On startup the clips of processes that are no
+    longer running are taken over, and temporary files left by an
+    interrupted spill are deleted.
+    """
+
+    def __init__(self, max_bytes: int = AUDIO_CACHE_MAX_BYTES,
+                 disk_max_bytes: int = AUDIO_CACHE_DISK_MAX_BYTES,
+                 max_file_ids: int = AUDIO_CACHE_MAX_FILE_IDS,
+                 cache_dir: str = AUDIO_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.max_file_ids = max_file_ids
+        self.root = cache_dir
+        self.cache_dir = os.path.join(cache_dir, f"proc-{os.getpid()}")
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> bytes
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> size in bytes
+        self._disk_bytes = 0
+        self._file_ids = OrderedDict()  # key -> Telegram file_id
+        self._stats = {
+            'file_id_hits': 0,
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+            'file_id_evictions': 0,
+        }
+        self._load_disk_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.audio")
+
+    def _adopt(self, directory: str) -> None:
+        """Move the clips in ``directory`` into this process's own directory and delete the rest."""
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if name.endswith('.audio'):
+                    os.replace(path, os.path.join(self.cache_dir, name))
+                elif name.endswith('.tmp'):
+                    os.remove(path)
+            except OSError:
+                continue  # Taken over by another process starting at the same time
+        if directory != self.root:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+
+    def _load_disk_index(self) -> None:
+        """Rebuild the disk tier index from files left by previous runs, oldest first."""
+        try:
+            os.makedirs(self.cache_dir, mode=0o755, exist_ok=True)
+            # Files directly in the root were written by versions without per-process directories
+            self._adopt(self.root)
+            for name in os.listdir(self.root):
+                match = _PROCESS_DIR.match(name)
+                if match and not pid_running(int(match.group('pid'))):
+                    self._adopt(os.path.join(self.root, name))
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name.endswith('.tmp'):
+                    # Left by a crash or a full disk mid-spill
+                    os.remove(path)
+                    continue
+                if not name.endswith('.audio'):
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name[:-len('.audio')], stat.st_size))
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._remove(self._evict_disk())
+            logger.info("Audio cache loaded %s clips (%s bytes) from %s",
+                        len(self._disk), self._disk_bytes, self.cache_dir)
+        except Exception as e:
+            logger.error("Failed to load audio cache index: %s", e)
+
+    def get_file_id(self, key: str) -> Optional[str]:
+        """Return the Telegram file_id previously recorded for ``key``, if any."""
+        with self._lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+                self._stats['file_id_hits'] += 1
+            return file_id
+
+    def set_file_id(self, key: str, file_id: str) -> None:
+        """Remember the file_id Telegram assigned to the uploaded clip for ``key``."""
+        with self._lock:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+            while len(self._file_ids) > self.max_file_ids:
+                self._file_ids.popitem(last=False)
+                self._stats['file_id_evictions'] += 1
+
+    def forget_file_id(self, key: str) -> None:
+        """Drop a file_id that Telegram no longer accepts."""
+        with self._lock:
+            self._file_ids.pop(key, None)
+
+    def get_audio(self, key: str) -> Optional[bytes]:
+        """
+        Look up cached audio bytes, promoting disk hits back into memory.
+
+        Args:
+            key (str): Cache key from :func:`make_key`
+
+        Returns:
+            Optional[bytes]: Audio bytes, or None on a miss
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return data
+            if key not in self._disk:
+                self._stats['misses'] += 1
+                return None
+            self._disk.move_to_end(key)
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            logger.warning("Audio cache file for %s is unreadable: %s", key, e)
+            with self._lock:
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_bytes -= size
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            evicted = self._store_memory(key, data)
+        self._spill(evicted)
+        return data
+
+    def put_audio(self, key: str, data: bytes) -> None:
+        """
+        Store freshly synthesized audio.
+
+        Args:
+            key (str): Cache key from :func:`make_key`
+            data (bytes): Audio bytes
+        """
+        with self._lock:
+            if len(data) > self.max_bytes:
+                evicted = [(key, data)]
+            else:
+                evicted = self._store_memory(key, data)
+        self._spill(evicted)
+
+    def _store_memory(self, key: str, data: bytes) -> list:
+        """
+        Add an entry to the memory tier. Called with the lock held.
+
+        Returns:
+            list: (key, data) pairs pushed out of memory, for the caller to spill once the lock is released
+        """
+        evicted = []
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_bytes and len(self._memory) > 1:
+            old_key, old_data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old_data)
+            self._stats['memory_evictions'] += 1
+            evicted.append((old_key, old_data))
+        return evicted
+
+    def _spill(self, entries: list) -> None:
+        """
+        Write entries pushed out of memory to the disk tier.
+
+        Called without the lock, so lookups do not wait on the disk; the
+        index is only updated once a file is complete.
+        """
+        for key, data in entries:
+            if len(data) > self.disk_max_bytes:
+                continue
+            with self._lock:
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+                    continue
+            path = self._path(key)
+            # Two threads may spill the same key; each writes its own temporary file
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.error("Failed to spill audio cache entry %s: %s", key, e)
+                continue
+            with self._lock:
+                if key not in self._disk:
+                    self._disk[key] = len(data)
+                    self._disk_bytes += len(data)
+                stale = self._evict_disk()
+            self._remove(stale)
+
+    def _evict_disk(self) -> list:
+        """Drop the oldest disk entries until the tier fits. Called with the lock held; returns the evicted keys."""
+        stale = []
+        while self._disk_bytes > self.disk_max_bytes and self._disk:
+            old_key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._stats['disk_evictions'] += 1
+            stale.append(old_key)
+        return stale
+
+    def _remove(self, keys: list) -> None:
+        """Delete the files of evicted disk entries. Called without the lock."""
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError as e:
+                logger.warning("Failed to remove evicted cache file %s: %s", key, e)
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters and current tier sizes."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+                'file_ids': len(self._file_ids),
+            })
+        return stats
+
+
+# Shared cache instance used by the handlers
+audio_cache = AudioCache()
+
+
+def _cache_counters() -> dict:
+    stats = audio_cache.stats()
+    return {(name,): stats[name] for name in stats if name.endswith(('hits', 'misses', 'evictions'))}
+
+
+def _cache_sizes() -> dict:
+    stats = audio_cache.stats()
+    return {(tier,): stats[f'{tier}_bytes'] for tier in ('memory', 'disk')}
+
+
+Gauge('audio_cache_events_total', 'Audio cache lookups and evictions by outcome.',
+      _cache_counters, labelnames=('event',), kind='counter')
+Gauge('audio_cache_bytes', 'Bytes of audio held by each cache tier.',
+      _cache_sizes, labelnames=('tier',))
@@ -1,20 +1,41 @@
 import os
+import hashlib
 import logging
-import sys
+from logs import configure_logging
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG,
-    stream=sys.stdout  # Ensure logs go to stdout for better visibility
-)
+# Logging settings
+# Records are queued and written to stdout by a background thread, as JSON
+# lines carrying the id of the update being handled (LOG_FORMAT=text gives
+# plain lines). LOG_LEVEL applies to every logger unless LOG_LEVELS overrides
+# it per module, e.g. "telegram=WARNING,engines=DEBUG". Below WARNING each
+# logging call site writes at most LOG_RATE_PER_SECOND records per second; the
+# number dropped is reported on the next one (0 disables the limit).
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_RATE_PER_SECOND = float(os.getenv('LOG_RATE_PER_SECOND', '10'))
+configure_logging(LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_RATE_PER_SECOND)
 logger = logging.getLogger(__name__)
 
 # Bot Configuration
+# Only the processes that run the bot need it; they refuse to start without it
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', '')
-if not TELEGRAM_TOKEN:
-    logger.error("No TELEGRAM_TOKEN provided in environment variables!")
-    sys.exit(1)  # Exit if no token is provided
+
+# Bot API endpoint; only needs changing to point the bot at a local stand-in
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL') or None
+
+# Update ingestion
+# 'polling' runs long polling in the worker process. 'webhook' has Telegram push
+# updates to the web service at WEBHOOK_URL/webhook/WEBHOOK_SECRET, where they
+# are stored in the database, queued (up to WEBHOOK_QUEUE_SIZE) and processed in
+# the web process.
+BOT_MODE = (os.getenv('BOT_MODE') or 'polling').strip().lower()
+WEBHOOK_URL = (os.getenv('WEBHOOK_URL') or os.getenv('RENDER_EXTERNAL_URL', '')).rstrip('/')
+# Without a bot token there is nothing secret to derive it from, and webhook mode does not start
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or (
+    hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()[:32] if TELEGRAM_TOKEN else ''
+)
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
 
 # Admin Configuration
 ADMIN_IDS = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
@@ -27,10 +48,10 @@ TEMP_DIR = "/tmp/temp_audio" if os.environ.get('RENDER') == 'true' else "temp_au
 try:
     # Ensure directory exists with correct permissions
     os.makedirs(TEMP_DIR, mode=0o755, exist_ok=True)
-    logger.info(f"Successfully created/verified temp directory at {TEMP_DIR}")
+    logger.info("Successfully created/verified temp directory at %s", TEMP_DIR)
 except Exception as e:
-    logger.error(f"Failed to create temp directory: {str(e)}")
-    sys.exit(1)  # Exit if we can't create the temp directory
+    # Synthesis creates it again when needed and reports the error per message
+    logger.error("Failed to create temp directory: %s", e)
 
 # Language settings
 DEFAULT_LANG = 'en'
@@ -104,17 +125,226 @@ ERROR_MESSAGE = "Sorry, an error occurred while processing your request. Please
 TEXT_TOO_LONG = "Text is too long! Please send a message with less than 100,000 characters."
 INVALID_LANGUAGE = "Invalid language code. Use /help to see all available languages and their codes."
 LANGUAGE_CHANGED = "Language changed to {}"
+CHUNK_FAILED = "Sorry, part {} of {} could not be converted to speech."
+BUSY_MESSAGE = "The bot is busy right now. Please try again in a minute."
+RATE_LIMITED = "You're sending a lot of text. Please try again in {} seconds."
 
 # Admin Messages
 BROADCAST_HELP = """
 Admin Only Command:
 /broadcast [message] - Send a message to all users
 Example: /broadcast Hello everyone!
+/stats - Show bot performance counters
 
-Note: This command is only available to admin users.
+Note: These commands are only available to admin users.
 """
 
 BROADCAST_UNAUTHORIZED = "Sorry, you are not authorized to use this command."
 BROADCAST_USAGE = "Please provide a message to broadcast.\nExample: /broadcast Hello everyone!"
-BROADCAST_SUCCESS = "Message broadcast to {} users successfully!"
-BROADCAST_NO_USERS = "No users to broadcast to."
\ No newline at end of file
+BROADCAST_STARTED = "Broadcasting to {} users..."
+BROADCAST_PROGRESS = "Broadcast in progress: {} of {} sent ({} failed, {:.1f} msg/s)"
+BROADCAST_DONE = "Broadcast finished: {} delivered, {} failed."
+BROADCAST_NO_USERS = "No users to broadcast to."
+STATS_UNAUTHORIZED = "Sorry, you are not authorized to use this command."
+
+# Audio cache settings
+# Recently synthesized clips are kept in memory, spilled to disk under TEMP_DIR
+# once the memory tier is full, and Telegram file_ids are remembered so repeats
+# can be answered without synthesizing or uploading anything. Each process
+# spills to its own subdirectory of AUDIO_CACHE_DIR, holding up to
+# AUDIO_CACHE_DISK_MAX_BYTES there.
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+AUDIO_CACHE_DISK_MAX_BYTES = int(os.getenv('AUDIO_CACHE_DISK_MAX_BYTES', str(256 * 1024 * 1024)))
+AUDIO_CACHE_MAX_FILE_IDS = int(os.getenv('AUDIO_CACHE_MAX_FILE_IDS', '100000'))
+AUDIO_CACHE_DIR = os.path.join(TEMP_DIR, 'cache')
+
+# Segment cache settings
+# Texts are synthesized sentence by sentence and each sentence's audio is kept
+# in a SQLite store at SEGMENT_CACHE_PATH (at most SEGMENT_CACHE_MAX_BYTES, least
+# recently used first out), so templated messages only synthesize the sentences
+# not heard before and the clip is spliced together. SEGMENT_CACHE=false
+# synthesizes every text in a single engine call.
+SEGMENT_CACHE = os.getenv('SEGMENT_CACHE', 'true').lower() == 'true'
+SEGMENT_CACHE_MAX_BYTES = int(os.getenv('SEGMENT_CACHE_MAX_BYTES', str(128 * 1024 * 1024)))
+SEGMENT_CACHE_PATH = os.getenv('SEGMENT_CACHE_PATH') or os.path.join(TEMP_DIR, 'segments.db')
+
+# Synthesis buffer settings
+# 'memory' synthesizes into pooled in-memory buffers and only touches disk once
+# a clip grows past AUDIO_SPILL_THRESHOLD bytes; 'file' keeps the original
+# write-to-TEMP_DIR behaviour.
+AUDIO_BUFFER_MODE = os.getenv('AUDIO_BUFFER_MODE', 'memory')
+AUDIO_SPILL_THRESHOLD = int(os.getenv('AUDIO_SPILL_THRESHOLD', str(4 * 1024 * 1024)))
+AUDIO_BUFFER_POOL_SIZE = int(os.getenv('AUDIO_BUFFER_POOL_SIZE', '8'))
+
+# Spool settings
+# Speech files in TEMP_DIR are reference counted and deleted when the last
+# user releases them. The spool holds at most SPOOL_MAX_BYTES and
+# SPOOL_MAX_FILES, evicting the oldest files left behind by failed requests
+# or crashed processes to make room, and sweeps those orphans once they are
+# SPOOL_ORPHAN_TTL seconds old, at startup and every SPOOL_SWEEP_INTERVAL seconds.
+SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_BYTES', str(256 * 1024 * 1024)))
+SPOOL_MAX_FILES = int(os.getenv('SPOOL_MAX_FILES', '1000'))
+SPOOL_ORPHAN_TTL = float(os.getenv('SPOOL_ORPHAN_TTL', '600'))
+SPOOL_SWEEP_INTERVAL = float(os.getenv('SPOOL_SWEEP_INTERVAL', '300'))
+
+# Voice encoding settings
+# With VOICE_ENCODING=opus synthesized speech is transcoded to OGG/Opus at
+# VOICE_OPUS_BITRATE, Telegram's native voice format, by ffmpeg (FFMPEG_BINARY,
+# found on PATH by default) while it is synthesized. 'none', or no ffmpeg
+# installed, uploads the engine's MP3 or WAV as it is.
+VOICE_ENCODING = os.getenv('VOICE_ENCODING', 'opus')
+VOICE_OPUS_BITRATE = os.getenv('VOICE_OPUS_BITRATE', '24k')
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY') or None
+
+# Long text settings
+# Messages longer than LONG_TEXT_THRESHOLD characters are split at sentence or
+# clause boundaries into chunks of at most CHUNK_MAX_CHARS, synthesized on a
+# pool of SYNTHESIS_WORKERS threads and sent back in order as they finish. A
+# failed chunk is retried CHUNK_RETRIES times, unless remote engines already
+# retry their calls (TTS_RESILIENCE, see below), so retries never multiply.
+LONG_TEXT_THRESHOLD = int(os.getenv('LONG_TEXT_THRESHOLD', '2000'))
+CHUNK_MAX_CHARS = int(os.getenv('CHUNK_MAX_CHARS', '1500'))
+SYNTHESIS_WORKERS = int(os.getenv('SYNTHESIS_WORKERS', '4'))
+CHUNK_RETRIES = int(os.getenv('CHUNK_RETRIES', '2'))
+
+# Speech engine settings
+# Comma-separated engines in order of preference: 'gtts', 'espeak' (local
+# espeak-ng, skipped when not installed) and 'tone' (deterministic offline
+# tones for tests). A call that fails or runs past TTS_ENGINE_TIMEOUT seconds
+# falls back to the next engine, and stops its requests and retries by then.
+# Each engine but the last waits for first audio on TTS_ENGINE_POOL_SIZE threads;
+# calls beyond that fall back straight away.
+TTS_ENGINES = [name.strip() for name in os.getenv('TTS_ENGINES', 'gtts,espeak').split(',') if name.strip()]
+TTS_ENGINE_TIMEOUT = float(os.getenv('TTS_ENGINE_TIMEOUT', '15'))
+TTS_ENGINE_POOL_SIZE = int(os.getenv('TTS_ENGINE_POOL_SIZE', '16'))
+# gTTS request URL override, only needed to point gTTS at a local stand-in
+GTTS_ENDPOINT = os.getenv('GTTS_ENDPOINT') or None
+
+# Speech engine resilience settings
+# Calls to remote engines (gTTS) are retried up to TTS_RETRIES times on
+# throttling, 5xx and network errors before their first audio, with
+# full-jitter exponential backoff from TTS_RETRY_BASE_DELAY up to
+# TTS_RETRY_MAX_DELAY seconds. A call with no audio after the recent
+# TTS_HEDGE_QUANTILE time to first audio (never less than TTS_HEDGE_MIN_DELAY
+# seconds) gets a hedged duplicate, with at most TTS_HEDGE_MAX_IN_FLIGHT
+# duplicates at once. BREAKER_FAILURE_THRESHOLD consecutive calls failing
+# after their retries open the circuit breaker: calls then fail immediately,
+# falling back to the next engine, and a probe is let through every
+# BREAKER_RESET_SECONDS until the upstream recovers.
+TTS_RESILIENCE = os.getenv('TTS_RESILIENCE', 'true').lower() == 'true'
+TTS_RETRIES = int(os.getenv('TTS_RETRIES', '2'))
+TTS_RETRY_BASE_DELAY = float(os.getenv('TTS_RETRY_BASE_DELAY', '0.5'))
+TTS_RETRY_MAX_DELAY = float(os.getenv('TTS_RETRY_MAX_DELAY', '8'))
+TTS_HEDGE_QUANTILE = float(os.getenv('TTS_HEDGE_QUANTILE', '0.95'))
+TTS_HEDGE_MIN_DELAY = float(os.getenv('TTS_HEDGE_MIN_DELAY', '0.3'))
+TTS_HEDGE_MAX_IN_FLIGHT = int(os.getenv('TTS_HEDGE_MAX_IN_FLIGHT', '4'))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '30'))
+
+# Scheduling settings
+# Text messages are processed on HANDLER_WORKERS threads with one serial queue
+# per user; beyond MAX_QUEUED_UPDATES waiting messages new ones are turned away.
+HANDLER_WORKERS = int(os.getenv('HANDLER_WORKERS', '8'))
+MAX_QUEUED_UPDATES = int(os.getenv('MAX_QUEUED_UPDATES', '200'))
+
+# Runtime settings
+# With RUNTIME=asyncio text messages are handled as coroutines on one event loop
+# instead of on HANDLER_WORKERS threads, up to ASYNC_MAX_CONVERSATIONS at once.
+# Their Telegram calls are made asynchronously over at most
+# ASYNC_TELEGRAM_CONNECTIONS keep-alive connections, and only synthesis and
+# database calls still block, on ASYNC_BLOCKING_WORKERS threads. The default,
+# 'threads', keeps the thread pool.
+RUNTIME = os.getenv('RUNTIME', 'threads')
+ASYNC_MAX_CONVERSATIONS = int(os.getenv('ASYNC_MAX_CONVERSATIONS', '1000'))
+ASYNC_TELEGRAM_CONNECTIONS = int(os.getenv('ASYNC_TELEGRAM_CONNECTIONS', '100'))
+ASYNC_BLOCKING_WORKERS = int(os.getenv('ASYNC_BLOCKING_WORKERS', '16'))
+
+# Worker sharding settings
+# With SHARD_WORKERS above 0 the ingesting process (polling worker or webhook web
+# service) only receives updates and forwards each one to worker process
+# user_id % SHARD_WORKERS, so a user's updates stay in order on one process
+# while different users use different cores. Up to SHARD_QUEUE_SIZE updates per
+# worker may be unacknowledged before ingestion waits. Crashed workers are
+# restarted. 0 handles everything in the ingesting process.
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', '500'))
+
+# TEMP_DIR also holds the audio cache of every process that synthesizes (the
+# shard workers, or the one bot process) and by default the segment store, which
+# keep to their own limits, so the whole directory stays under this sum; the
+# spool's sweep warns if it does not.
+TEMP_DIR_MAX_BYTES = SPOOL_MAX_BYTES + AUDIO_CACHE_DISK_MAX_BYTES * max(1, SHARD_WORKERS) + SEGMENT_CACHE_MAX_BYTES
+
+# Job queue settings
+# Accepted text messages are stored as jobs in the database until they are
+# answered, so a restart resumes them instead of losing them. The process running
+# a job renews its lease every JOB_LEASE_SECONDS / 3; a job whose lease ran out is
+# assumed lost with its process and run again, at most JOB_MAX_ATTEMPTS times.
+# Stored webhook updates are leased the same way. On SIGTERM the bot stops polling and waits up to
+# JOB_DRAIN_SECONDS for queued jobs. Finished jobs are kept for
+# JOB_RETENTION_HOURS to recognise updates Telegram delivers twice, and the
+# polling offset is committed at most every JOB_OFFSET_COMMIT_INTERVAL seconds.
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '300'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_DRAIN_SECONDS = float(os.getenv('JOB_DRAIN_SECONDS', '20'))
+JOB_RETENTION_HOURS = float(os.getenv('JOB_RETENTION_HOURS', '48'))
+JOB_OFFSET_COMMIT_INTERVAL = float(os.getenv('JOB_OFFSET_COMMIT_INTERVAL', '1'))
+
+# Rate limit settings
+# Each user may convert up to RATE_LIMIT_CAPACITY characters in a burst, refilled
+# at RATE_LIMIT_REFILL_PER_SECOND characters per second. Admins are exempt.
+RATE_LIMIT_CAPACITY = int(os.getenv('RATE_LIMIT_CAPACITY', '20000'))
+RATE_LIMIT_REFILL_PER_SECOND = float(os.getenv('RATE_LIMIT_REFILL_PER_SECOND', '200'))
+
+# Broadcast settings
+# Broadcasts are sent by BROADCAST_CONCURRENCY threads at no more than
+# BROADCAST_MAX_RATE messages per second, slowing down when Telegram answers
+# with RetryAfter. Progress is committed to the database every
+# BROADCAST_BATCH_SIZE recipients and reported to the admin every
+# BROADCAST_PROGRESS_INTERVAL seconds.
+BROADCAST_MAX_RATE = float(os.getenv('BROADCAST_MAX_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '100'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+# A job with no progress for this long is considered abandoned and may be resumed
+BROADCAST_LEASE_SECONDS = float(os.getenv('BROADCAST_LEASE_SECONDS', '60'))
+
+# Outbound HTTP settings
+# gTTS calls share a keep-alive pool of HTTP_POOL_SIZE connections and Telegram
+# API calls one of TELEGRAM_POOL_SIZE (by default enough for every handler and
+# broadcast thread plus the dispatcher); both use these connect/read timeouts.
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '16'))
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', str(HANDLER_WORKERS + BROADCAST_CONCURRENCY + 4)))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+# Optional proxy for Telegram API calls, e.g. http://proxy:3128 or socks5://proxy:1080
+TELEGRAM_PROXY_URL = os.getenv('TELEGRAM_PROXY_URL') or None
+
+# User store settings
+# Language changes and last-seen times are cached in memory and written to the
+# database in batches every USER_FLUSH_INTERVAL seconds and on shutdown. A
+# language change is written at once, and the other bot processes (gunicorn
+# workers, shard workers) pick it up within USER_FLUSH_INTERVAL seconds.
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', '5'))
+
+# Heartbeat settings
+# The bot process publishes liveness data to the database every HEARTBEAT_INTERVAL
+# seconds; /health reports unhealthy once the heartbeat or the polling loop has
+# been silent for HEARTBEAT_STALE_SECONDS.
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', '15'))
+HEARTBEAT_STALE_SECONDS = float(os.getenv('HEARTBEAT_STALE_SECONDS', '90'))
+
+# Status history settings
+# With STATUS_HISTORY on, the bot samples its vitals (health, updates per second,
+# synthesis latency percentiles, queue depth) once a minute into an in-memory
+# ring buffer of STATUS_BUFFER_SIZE samples, written to the bot_status table in
+# one batch every STATUS_FLUSH_INTERVAL seconds. Minute rows older than
+# STATUS_MINUTE_RETENTION_HOURS are rolled up into hours, hours older than
+# STATUS_HOUR_RETENTION_DAYS into days, and days older than
+# STATUS_DAY_RETENTION_DAYS are deleted, so the table stays at a few thousand rows.
+STATUS_HISTORY = os.getenv('STATUS_HISTORY', 'true').lower() == 'true'
+STATUS_FLUSH_INTERVAL = float(os.getenv('STATUS_FLUSH_INTERVAL', '300'))
+STATUS_BUFFER_SIZE = int(os.getenv('STATUS_BUFFER_SIZE', '1440'))
+STATUS_MINUTE_RETENTION_HOURS = float(os.getenv('STATUS_MINUTE_RETENTION_HOURS', '24'))
+STATUS_HOUR_RETENTION_DAYS = float(os.getenv('STATUS_HOUR_RETENTION_DAYS', '30'))
+STATUS_DAY_RETENTION_DAYS = float(os.getenv('STATUS_DAY_RETENTION_DAYS', '365'))
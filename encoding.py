@@ -0,0 +1,207 @@
+import logging
+import math
+import shutil
+import struct
+import subprocess
+import threading
+from typing import Optional
+from config import VOICE_ENCODING, VOICE_OPUS_BITRATE, FFMPEG_BINARY
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+ENCODED_BYTES = Counter(
+    'voice_encoding_bytes_total',
+    'Bytes of audio going into and coming out of the voice encoder.',
+    ('direction',)
+)
+
+# Opus granule positions count samples at 48 kHz whatever the input rate
+_OPUS_RATE = 48000
+
+
+def audio_format(data: bytes) -> str:
+    """Return the container of an audio file from its first bytes: 'ogg', 'wav' or 'mp3'."""
+    if data[:4] == b'OggS':
+        return 'ogg'
+    if data[:4] == b'RIFF':
+        return 'wav'
+    return 'mp3'
+
+
+def _ogg_duration(data: bytes) -> Optional[float]:
+    # The last page's granule position is the number of samples up to its end,
+    # including the pre-skip declared in the OpusHead packet of the first page
+    last = data.rfind(b'OggS', max(0, len(data) - 65536))
+    head = data.find(b'OpusHead')
+    if last < 0 or head < 0 or last + 14 > len(data):
+        return None
+    granule, = struct.unpack_from('<q', data, last + 6)
+    pre_skip, = struct.unpack_from('<H', data, head + 10)
+    return max(0, granule - pre_skip) / _OPUS_RATE
+
+
+def _wav_duration(data: bytes) -> Optional[float]:
+    offset = 12
+    byte_rate = None
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack_from('<4sI', data, offset)
+        if chunk_id == b'fmt ':
+            byte_rate, = struct.unpack_from('<I', data, offset + 16)
+        elif chunk_id == b'data' and byte_rate:
+            # Streamed WAVs declare a placeholder size; the data runs to the end
+            return min(size, len(data) - offset - 8) / byte_rate
+        offset += 8 + size + (size & 1)
+    return None
+
+
+def voice_duration(data: bytes) -> Optional[int]:
+    """
+    Return the length of an OGG/Opus or WAV clip in whole seconds, as Telegram's voice metadata wants it.
+
+    Args:
+        data (bytes): Complete audio file
+
+    Returns:
+        Optional[int]: Seconds rounded up, or None when the length cannot be read cheaply (MP3)
+    """
+    try:
+        if data[:4] == b'OggS':
+            seconds = _ogg_duration(data)
+        elif data[:4] == b'RIFF':
+            seconds = _wav_duration(data)
+        else:
+            return None
+    except struct.error:
+        return None
+    return None if seconds is None else max(1, math.ceil(seconds))
+
+
+class EncoderSink:
+    """
+    Writable file object that pipes audio through ffmpeg into ``fp`` as it is written.
+
+    A reader thread copies the encoder's output into ``fp`` while the
+    engine is still writing, so encoding overlaps synthesis and only the
+    last fraction of a second is left when synthesis ends.
+    """
+
+    def __init__(self, command: list, fp):
+        self._fp = fp
+        self._in = 0
+        self._out = 0
+        self._error = None
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._copy_output, name='voice-encoder', daemon=True)
+        self._reader.start()
+
+    def _copy_output(self) -> None:
+        try:
+            while True:
+                part = self._process.stdout.read(16384)
+                if not part:
+                    return
+                self._out += len(part)
+                self._fp.write(part)
+        except Exception as e:
+            self._error = e
+
+    def write(self, data) -> int:
+        self._in += len(data)
+        self._process.stdin.write(data)
+        return len(data)
+
+    def close(self) -> None:
+        """
+        Finish encoding and wait until all of it is in ``fp``.
+
+        Raises:
+            RuntimeError: If ffmpeg fails or its output could not be written
+        """
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._reader.join()
+        returncode = self._process.wait()
+        stderr = self._process.stderr.read().decode(errors='replace').strip()
+        self._process.stdout.close()
+        self._process.stderr.close()
+        if self._error is not None:
+            raise RuntimeError(f"Failed to write encoded audio: {str(self._error)}")
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with {returncode}: {stderr}")
+        ENCODED_BYTES.inc(self._in, direction='in')
+        ENCODED_BYTES.inc(self._out, direction='out')
+
+    def abort(self) -> None:
+        """Stop encoding after synthesis failed; nothing written to ``fp`` is usable."""
+        if self._process.poll() is None:
+            self._process.kill()
+        self._reader.join()
+        self._process.wait()
+        for pipe in (self._process.stdin, self._process.stdout, self._process.stderr):
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+
+
+class OpusEncoder:
+    """
+    Transcode synthesized speech to OGG/Opus, Telegram's native voice format, with ffmpeg.
+
+    Opus in VoIP mode at a speech bitrate (24 kbit/s by default) is several
+    times smaller than gTTS's MP3 and is played by Telegram as a voice note.
+    The input container (MP3 or WAV) is detected by ffmpeg.
+    """
+
+    format = 'ogg'
+
+    def __init__(self, bitrate: str = VOICE_OPUS_BITRATE, binary: Optional[str] = FFMPEG_BINARY):
+        self.bitrate = bitrate
+        self.binary = binary or shutil.which('ffmpeg')
+
+    def available(self) -> bool:
+        return self.binary is not None
+
+    def command(self) -> list:
+        return [
+            self.binary, '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0', '-vn',
+            '-ac', '1', '-c:a', 'libopus', '-b:a', self.bitrate, '-application', 'voip',
+            '-f', 'ogg', 'pipe:1',
+        ]
+
+    def open(self, fp) -> EncoderSink:
+        """Start an encoder writing into ``fp``; write the audio to the result, then close it."""
+        return EncoderSink(self.command(), fp)
+
+
+_encoder = None
+_encoder_checked = False
+_encoder_lock = threading.Lock()
+
+
+def get_encoder() -> Optional[OpusEncoder]:
+    """Return the voice encoder configured by VOICE_ENCODING, or None to upload the engine's audio as it is."""
+    global _encoder, _encoder_checked
+    if not _encoder_checked:
+        with _encoder_lock:
+            if not _encoder_checked:
+                if VOICE_ENCODING == 'opus':
+                    encoder = OpusEncoder()
+                    if encoder.available():
+                        _encoder = encoder
+                        logger.info("Encoding voice messages to Opus at %s with %s", encoder.bitrate, encoder.binary)
+                    else:
+                        logger.warning("ffmpeg is not installed, sending voice messages without Opus encoding")
+                _encoder_checked = True
+    return _encoder
+
+
+def set_encoder(encoder: Optional[OpusEncoder]) -> None:
+    """Replace the voice encoder, e.g. with None to compare against unencoded audio in benchmarks."""
+    global _encoder, _encoder_checked
+    _encoder = encoder
+    _encoder_checked = True
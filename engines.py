@@ -0,0 +1,502 @@
+import array
+import base64
+import contextvars
+import functools
+import inspect
+import io
+import logging
+import math
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import requests
+from config import GTTS_ENDPOINT, TTS_ENGINES, TTS_ENGINE_TIMEOUT, TTS_ENGINE_POOL_SIZE, TTS_RESILIENCE
+from httppool import http_pool
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Base64 audio in a line of the TTS endpoint's response, as gTTS parses it
+_GTTS_AUDIO = re.compile(r'jQ1olc","\[\\"(.*)\\"]')
+# gTTS release whose private request API and response format GTTSEngine relies
+# on; requirements.txt pins it, and check_gtts() refuses any other
+GTTS_VERSION = '2.5.4'
+
+# time.monotonic() by which the current call must have produced its first audio
+_deadline = contextvars.ContextVar('tts_deadline', default=None)
+
+# Fallback engines that produced audio inside the innermost record_fallbacks() block
+_fallbacks = contextvars.ContextVar('tts_fallbacks', default=None)
+
+
+@contextmanager
+def record_fallbacks() -> Iterator[list]:
+    """
+    Collect the names of fallback engines that produce audio inside the block.
+
+    A FallbackEngine adds an engine's name when it commits to any engine
+    but the first one supporting the language. Audio from such an engine
+    stands in for an outage and should not be cached as the text's audio.
+    Threads started with a copy of the context add to the same list, and
+    names recorded in a nested block are added to the enclosing one too.
+
+    Yields:
+        list: Names of the fallback engines used, empty if none were
+    """
+    outer = _fallbacks.get()
+    used = []
+    token = _fallbacks.set(used)
+    try:
+        yield used
+    finally:
+        _fallbacks.reset(token)
+        if outer is not None:
+            outer.extend(used)
+
+
+def _record_fallback(engine: 'TTSEngine') -> None:
+    used = _fallbacks.get()
+    if used is not None:
+        used.append(engine.name)
+
+
+def time_left() -> Optional[float]:
+    """
+    Return the seconds left before the current call's deadline.
+
+    A FallbackEngine sets the deadline while it waits for an engine's first
+    audio, so that a call it has given up on stops by itself instead of
+    holding a thread: requests time out and retries stop once it passes.
+
+    Returns:
+        Optional[float]: Seconds left, negative once passed, or None without a deadline
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check_gtts() -> None:
+    """
+    Verify that the installed gTTS still provides what GTTSEngine borrows from it.
+
+    GTTSEngine calls the private ``gTTS._prepare_requests()`` and parses the
+    responses with a copy of gTTS's own pattern, neither of which gTTS
+    promises to keep.
+
+    Raises:
+        RuntimeError: If the installed gTTS is not GTTS_VERSION or no longer matches
+    """
+    import gtts
+    from gtts import gTTS
+
+    problems = []
+    if gtts.__version__ != GTTS_VERSION:
+        problems.append(f"version {gtts.__version__} is installed, {GTTS_VERSION} is required")
+    try:
+        # Only builds the requests, nothing is sent
+        prepared = gTTS(text='check', lang='en')._prepare_requests()
+        if not prepared or not all(isinstance(request, requests.PreparedRequest) for request in prepared):
+            problems.append("_prepare_requests() no longer returns prepared requests")
+    except Exception as e:
+        problems.append(f"_prepare_requests() failed: {e!r}")
+    try:
+        if _GTTS_AUDIO.pattern not in inspect.getsource(gTTS.stream):
+            problems.append("gTTS.stream() parses responses with another pattern")
+    except (OSError, TypeError):
+        pass  # No source shipped; the version check stands in
+    if problems:
+        raise RuntimeError(f"GTTSEngine does not support the installed gTTS: {'; '.join(problems)}")
+
+
+ENGINE_SECONDS = Histogram(
+    'tts_engine_seconds',
+    'Time taken by each speech engine to synthesize a text, successful or not.',
+    ('engine', 'lang')
+)
+ENGINE_FAILURES = Counter(
+    'tts_engine_failures_total',
+    'Speech engine calls that failed or were abandoned for a fallback, by reason.',
+    ('engine', 'reason')
+)
+
+
+class TTSEngine:
+    """
+    Base class for speech engines.
+
+    Subclasses implement :meth:`stream`, yielding audio as it becomes
+    available; whole-clip synthesis and writing to a file object are built
+    on top of it.
+    """
+
+    name = 'engine'
+    format = 'mp3'  # container of the produced audio, used as the file extension
+    remote = False  # True for engines that call a network service
+
+    def available(self) -> bool:
+        """Return False if the engine cannot run in this environment."""
+        return True
+
+    def supports(self, lang: str) -> bool:
+        """Return True if the engine can speak ``lang``."""
+        return True
+
+    def stream(self, text: str, lang: str) -> Iterator[bytes]:
+        """
+        Synthesize ``text`` and yield the audio in parts as they are produced.
+
+        Args:
+            text (str): Text to convert to speech
+            lang (str): Language code
+
+        Yields:
+            bytes: Consecutive parts of the audio file
+        """
+        raise NotImplementedError
+
+    def timed_stream(self, text: str, lang: str) -> Iterator[bytes]:
+        """:meth:`stream`, recording the engine's latency and failures."""
+        start = time.perf_counter()
+        try:
+            yield from self.stream(text, lang)
+        except Exception:
+            ENGINE_FAILURES.inc(engine=self.name, reason='error')
+            raise
+        finally:
+            ENGINE_SECONDS.observe(time.perf_counter() - start, engine=self.name, lang=lang)
+
+    def write_to_fp(self, text: str, lang: str, fp) -> str:
+        """
+        Synthesize ``text`` into a writable file object.
+
+        Returns:
+            str: Format of the audio written
+        """
+        for part in self.timed_stream(text, lang):
+            fp.write(part)
+        return self.format
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        """Synthesize ``text`` and return the complete audio file."""
+        buffer = io.BytesIO()
+        self.write_to_fp(text, lang, buffer)
+        return buffer.getvalue()
+
+
+def read_gtts_audio(response: requests.Response) -> Iterator[bytes]:
+    """
+    Yield the audio carried by a response from the gTTS endpoint.
+
+    Raises:
+        ValueError: If an audio line is present but carries no audio
+    """
+    for line in response.iter_lines(chunk_size=1024):
+        decoded = line.decode('utf-8')
+        if 'jQ1olc' in decoded:
+            match = _GTTS_AUDIO.search(decoded)
+            if not match:
+                raise ValueError("No audio stream in TTS response")
+            yield base64.b64decode(match.group(1).encode('ascii'))
+
+
+class GTTSEngine(TTSEngine):
+    """
+    Google Translate's text-to-speech endpoint through gTTS.
+
+    gTTS prepares the requests, but they are sent through the shared
+    keep-alive session instead of the fresh session gTTS opens per part,
+    so connections and TLS handshakes are reused across calls. ``endpoint``
+    replaces the request URL, to point the engine at a local stand-in.
+    """
+
+    name = 'gtts'
+    format = 'mp3'
+    remote = True
+
+    def __init__(self, endpoint: Optional[str] = GTTS_ENDPOINT):
+        self.endpoint = endpoint
+
+    def available(self) -> bool:
+        try:
+            check_gtts()
+        except RuntimeError as e:
+            logger.error("%s; pin gtts==%s or update GTTSEngine", e, GTTS_VERSION)
+            ENGINE_FAILURES.inc(engine=self.name, reason='incompatible')
+            return False
+        return True
+
+    def stream(self, text: str, lang: str) -> Iterator[bytes]:
+        # Imported on first use; processes that never synthesize skip loading gTTS
+        from gtts import gTTS, gTTSError
+        tts = gTTS(text=text, lang=lang)
+        session = http_pool.session
+        for prepared in tts._prepare_requests():
+            if self.endpoint:
+                prepared.url = self.endpoint
+            timeout = http_pool.timeout
+            left = time_left()
+            if left is not None:
+                if left <= 0:
+                    raise gTTSError(tts=tts)
+                timeout = tuple(min(limit, left) for limit in timeout)
+            response = None
+            try:
+                with session.send(prepared, stream=True, timeout=timeout) as response:
+                    response.raise_for_status()
+                    yield from read_gtts_audio(response)
+            except requests.HTTPError:
+                raise gTTSError(tts=tts, response=response)
+            except requests.RequestException:
+                raise gTTSError(tts=tts)
+            except ValueError:
+                raise gTTSError(tts=tts, response=response)
+
+
+class EspeakEngine(TTSEngine):
+    """Local, offline synthesis with the espeak-ng command line tool."""
+
+    name = 'espeak'
+    format = 'wav'
+
+    # espeak-ng voice for each supported language code
+    VOICES = {
+        'en': 'en', 'es': 'es', 'fr': 'fr', 'de': 'de', 'it': 'it', 'pt': 'pt',
+        'ru': 'ru', 'hi': 'hi', 'ja': 'ja', 'ko': 'ko', 'ml': 'ml',
+    }
+
+    def __init__(self, binary: Optional[str] = None):
+        self.binary = binary or shutil.which('espeak-ng') or shutil.which('espeak')
+
+    def available(self) -> bool:
+        return self.binary is not None
+
+    def supports(self, lang: str) -> bool:
+        return lang in self.VOICES
+
+    def stream(self, text: str, lang: str) -> Iterator[bytes]:
+        # Text goes through stdin so it is never parsed as options
+        process = subprocess.Popen(
+            [self.binary, '--stdout', '-v', self.VOICES[lang]],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        try:
+            process.stdin.write(text.encode('utf-8'))
+            process.stdin.close()
+            while True:
+                part = process.stdout.read(16384)
+                if not part:
+                    break
+                yield part
+            if process.wait() != 0:
+                raise RuntimeError(f"espeak exited with {process.returncode}: "
+                                   f"{process.stderr.read().decode(errors='replace').strip()}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+
+@functools.lru_cache(maxsize=1024)
+def _tone(frequency: int, sample_rate: int, count: int) -> bytes:
+    """Return ``count`` 16-bit samples of a sine tone, or of silence for frequency 0."""
+    if not frequency:
+        return bytes(count * 2)
+    samples = array.array('h', (
+        int(8000 * math.sin(2 * math.pi * frequency * i / sample_rate)) for i in range(count)
+    ))
+    if sys.byteorder == 'big':
+        samples.byteswap()  # WAV samples are little-endian
+    return samples.tobytes()
+
+
+class ToneEngine(TTSEngine):
+    """
+    Deterministic synthetic engine for tests and load tests.
+
+    Every character becomes a short sine tone whose pitch depends on the
+    character and the language, and whitespace becomes silence, so the same
+    input always yields the same WAV file and its length follows the text.
+    No network or external tools are involved.
+    """
+
+    name = 'tone'
+    format = 'wav'
+
+    SAMPLE_RATE = 8000
+    UNIT_SECONDS = 0.06
+
+    def _samples_per_unit(self) -> int:
+        return int(self.SAMPLE_RATE * self.UNIT_SECONDS)
+
+    def _unit(self, frequency: int) -> bytes:
+        return _tone(frequency, self.SAMPLE_RATE, self._samples_per_unit())
+
+    def stream(self, text: str, lang: str) -> Iterator[bytes]:
+        seed = zlib.crc32(lang.encode('utf-8'))
+        data_size = len(text) * self._samples_per_unit() * 2
+        yield struct.pack(
+            '<4sI4s4sIHHIIHH4sI',
+            b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, 1,
+            self.SAMPLE_RATE, self.SAMPLE_RATE * 2, 2, 16, b'data', data_size
+        )
+        for start in range(0, len(text), 64):
+            yield b''.join(
+                self._unit(0 if char.isspace() else 200 + (ord(char) * 37 + seed) % 600)
+                for char in text[start:start + 64]
+            )
+
+
+class FallbackEngine(TTSEngine):
+    """
+    Try engines in order, moving on when one fails or takes longer than ``timeout``.
+
+    For every engine but the last, the first part of the audio is awaited on
+    a worker thread, so a slow call can be abandoned before anything reaches
+    the caller's file object. Each engine has its own ``pool_size`` threads;
+    when they are all busy the engine is skipped. An abandoned call runs
+    under a deadline of ``timeout`` seconds (see :func:`time_left`), so it
+    gives its thread back soon after. Once the first part is in, the engine is
+    committed to and the rest streams straight through; a failure after that
+    point is raised rather than falling back, as part of the clip is already
+    written. The last engine has nothing to fall back to and streams
+    straight into the caller's file object. Audio from any engine but the
+    first candidate is reported to :func:`record_fallbacks`.
+    """
+
+    name = 'fallback'
+
+    def __init__(self, engines: list, timeout: float = TTS_ENGINE_TIMEOUT, pool_size: int = TTS_ENGINE_POOL_SIZE):
+        self.engines = engines
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._executors = {
+            engine: ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix=f'tts-{engine.name}')
+            for engine in engines
+        }
+        self._slots = {engine: threading.BoundedSemaphore(pool_size) for engine in engines}
+
+    @property
+    def format(self) -> str:
+        return self.engines[0].format
+
+    def supports(self, lang: str) -> bool:
+        return any(engine.supports(lang) for engine in self.engines)
+
+    def stream(self, text: str, lang: str) -> Iterator[bytes]:
+        buffer = io.BytesIO()
+        self.write_to_fp(text, lang, buffer)
+        yield buffer.getvalue()
+
+    def write_to_fp(self, text: str, lang: str, fp) -> str:
+        candidates = [engine for engine in self.engines if engine.supports(lang)]
+        for index, engine in enumerate(candidates):
+            if index == len(candidates) - 1:
+                if index:
+                    _record_fallback(engine)
+                return engine.write_to_fp(text, lang, fp)
+            slots = self._slots[engine]
+            if not slots.acquire(blocking=False):
+                logger.warning("TTS engine %s has %d calls waiting for audio, falling back",
+                               engine.name, self.pool_size)
+                ENGINE_FAILURES.inc(engine=engine.name, reason='saturated')
+                continue
+            parts = engine.timed_stream(text, lang)
+            context = contextvars.copy_context()
+            context.run(_deadline.set, time.monotonic() + self.timeout)
+            future = self._executors[engine].submit(context.run, next, parts, b'')
+            future.add_done_callback(lambda _, slots=slots: slots.release())
+            try:
+                first = future.result(timeout=self.timeout)
+            except FutureTimeout:
+                logger.warning("TTS engine %s took over %ss, falling back", engine.name, self.timeout)
+                ENGINE_FAILURES.inc(engine=engine.name, reason='timeout')
+                # The abandoned stream is closed once its first part arrives
+                future.add_done_callback(lambda _, parts=parts: parts.close())
+                continue
+            except Exception as e:
+                logger.warning("TTS engine %s failed, falling back: %s", engine.name, e)
+                continue
+            if index:
+                _record_fallback(engine)
+            fp.write(first)
+            for part in parts:
+                fp.write(part)
+            return engine.format
+        raise RuntimeError(f"No TTS engine supports language {lang}")
+
+
+ENGINES = {
+    'gtts': GTTSEngine,
+    'espeak': EspeakEngine,
+    'tone': ToneEngine,
+}
+
+
+def build_engine(names: list) -> TTSEngine:
+    """
+    Build the engine, or fallback chain of engines, named in ``names``.
+
+    Unknown names and engines that cannot run here are skipped. Remote
+    engines are wrapped in a ResilientEngine (hedging, retries and a circuit
+    breaker) unless TTS_RESILIENCE is off.
+
+    Args:
+        names (list): Engine names in order of preference
+
+    Returns:
+        TTSEngine: A single engine, or a FallbackEngine over several
+    """
+    engines = []
+    for name in names:
+        if name not in ENGINES:
+            logger.warning("Unknown TTS engine %r ignored", name)
+            continue
+        engine = ENGINES[name]()
+        if not engine.available():
+            logger.info("TTS engine %s is not available here, skipping it", name)
+            continue
+        engines.append(engine)
+    if not engines:
+        logger.warning("No configured TTS engine is available, using gTTS")
+        engines = [GTTSEngine()]
+    if TTS_RESILIENCE:
+        from resilience import ResilientEngine
+        engines = [ResilientEngine(engine) if engine.remote else engine for engine in engines]
+    return engines[0] if len(engines) == 1 else FallbackEngine(engines)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> TTSEngine:
+    """Return the engine configured by TTS_ENGINES, building it on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = build_engine(TTS_ENGINES)
+                logger.info("Using TTS engine chain: %s",
+                            ', '.join(e.name for e in getattr(_engine, 'engines', [_engine])))
+    return _engine
+
+
+def built_engine() -> Optional[TTSEngine]:
+    """Return the engine if this process has built it, without building it."""
+    return _engine
+
+
+def set_engine(engine: TTSEngine) -> None:
+    """Replace the engine used for synthesis, e.g. with an offline one for benchmarks."""
+    global _engine
+    _engine = engine
@@ -1,4 +1,6 @@
+import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatAction
+from telegram.error import BadRequest
 from telegram.ext import CallbackContext, CallbackQueryHandler
 from config import (
     WELCOME_MESSAGE,
@@ -8,21 +10,33 @@ from config import (
     INVALID_LANGUAGE,
     LANGUAGE_CHANGED,
     SUPPORTED_LANGUAGES,
-    DEFAULT_LANG,
     ADMIN_IDS,
     BROADCAST_HELP,
     BROADCAST_UNAUTHORIZED,
     BROADCAST_USAGE,
-    BROADCAST_SUCCESS,
     BROADCAST_NO_USERS,
-    logger
+    STATS_UNAUTHORIZED,
+    CHUNK_FAILED,
+    LONG_TEXT_THRESHOLD,
+    RUNTIME
 )
-from utils import generate_speech, cleanup_file
-
-# Store user language preferences (in memory)
-user_languages = {}
-# Store active user IDs (in memory)
-active_users = set()
+from utils import synthesize, synthesize_chunks, split_text
+from cache import audio_cache, make_key
+from engines import record_fallbacks
+from segments import segment_store
+from spool import spool
+from encoding import audio_format, voice_duration
+from scheduler import scheduler
+from ratelimit import rate_limiter
+from broadcast import start_broadcast
+from userstore import user_store
+from metrics import STAGE_SECONDS, TEXT_LENGTH_CHARS, ERRORS
+from singleflight import synthesis_flight
+from httppool import http_pool
+from aioruntime import runtime
+from aiotelegram import AsyncTelegram
+
+logger = logging.getLogger(__name__)
 
 def create_language_keyboard():
     """Create an inline keyboard for language selection."""
@@ -69,16 +83,16 @@ def create_main_menu_keyboard():
 def start_command(update: Update, context: CallbackContext) -> None:
     """Handle the /start command."""
     user_id = update.effective_user.id
-    logger.info(f"Start command received from user {user_id}")
-    # Add user to active users
-    active_users.add(user_id)
+    logger.info("Start command received from user %s", user_id)
+    # Add user to the broadcast audience
+    user_store.touch(user_id)
     keyboard = create_main_menu_keyboard()
     update.message.reply_text(WELCOME_MESSAGE, reply_markup=keyboard)
 
 def help_command(update: Update, context: CallbackContext) -> None:
     """Handle the /help command."""
     user_id = update.effective_user.id
-    logger.info(f"Help command received from user {user_id}")
+    logger.info("Help command received from user %s", user_id)
     # Add help message for admin users
     if user_id in ADMIN_IDS:
         help_text = HELP_MESSAGE + "\n\n" + BROADCAST_HELP
@@ -90,11 +104,11 @@ def help_command(update: Update, context: CallbackContext) -> None:
 def broadcast_command(update: Update, context: CallbackContext) -> None:
     """Handle the /broadcast command (admin only)."""
     user_id = update.effective_user.id
-    logger.info(f"Broadcast command received from user {user_id}")
+    logger.info("Broadcast command received from user %s", user_id)
 
     # Check if user is admin
     if user_id not in ADMIN_IDS:
-        logger.warning(f"Unauthorized broadcast attempt from user {user_id}")
+        logger.warning("Unauthorized broadcast attempt from user %s", user_id)
         update.message.reply_text(BROADCAST_UNAUTHORIZED)
         return
 
@@ -105,40 +119,48 @@ def broadcast_command(update: Update, context: CallbackContext) -> None:
 
     # Get broadcast message
     message = ' '.join(context.args)
-    success_count = 0
-    failed_users = []
 
-    # Broadcast message to all active users
-    for target_id in active_users:
-        try:
-            context.bot.send_message(chat_id=target_id, text=message)
-            success_count += 1
-            logger.debug(f"Broadcast message sent to user {target_id}")
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to user {target_id}: {str(e)}")
-            failed_users.append(target_id)
-
-    # Log broadcast results
-    logger.info(f"Broadcast completed: {success_count} successful, {len(failed_users)} failed")
-
-    # Remove failed users from active users set
-    for failed_id in failed_users:
-        active_users.discard(failed_id)
-
-    # Send result to admin
-    if success_count > 0:
-        update.message.reply_text(BROADCAST_SUCCESS.format(success_count))
-    else:
+    # Hand the broadcast to a background job that paces itself and survives restarts
+    job_id = start_broadcast(context.bot, update.effective_chat.id, message)
+    if job_id is None:
         update.message.reply_text(BROADCAST_NO_USERS)
+        return
+    logger.info("Broadcast job %s queued", job_id)
+
+def stats_command(update: Update, context: CallbackContext) -> None:
+    """Handle the /stats command (admin only)."""
+    user_id = update.effective_user.id
+    logger.info("Stats command received from user %s", user_id)
+
+    if user_id not in ADMIN_IDS:
+        update.message.reply_text(STATS_UNAUTHORIZED)
+        return
+
+    lines = ["Audio cache:"]
+    lines += [f"{name}: {value}" for name, value in audio_cache.stats().items()]
+    lines += ["", "Segment cache:"]
+    lines += [f"{name}: {value}" for name, value in segment_store.stats().items()]
+    lines += ["", "Spool:"]
+    lines += [f"{name}: {value}" for name, value in spool.stats().items()]
+    lines += ["", "Scheduler:"]
+    lines += [f"{name}: {value}" for name, value in scheduler.stats().items()]
+    lines += ["", "Rate limiter:"]
+    lines += [f"{name}: {value}" for name, value in rate_limiter.stats().items()]
+    lines += ["", "Single-flight:"]
+    lines += [f"in_flight: {synthesis_flight.in_flight()}", f"waiters: {synthesis_flight.waiters()}"]
+    for pool, stats in http_pool.stats().items():
+        lines += ["", f"HTTP pool ({pool}):"]
+        lines += [f"{name}: {value}" for name, value in stats.items()]
+    update.message.reply_text("\n".join(lines))
 
 def lang_command(update: Update, context: CallbackContext) -> None:
     """Handle the /lang command to change language."""
-    logger.info(f"Language command received from user {update.effective_user.id}")
+    logger.info("Language command received from user %s", update.effective_user.id)
     keyboard = create_language_keyboard()
     message = (
         "Please select your preferred language:\n\n"
         "Current language: " + SUPPORTED_LANGUAGES.get(
-            user_languages.get(update.effective_user.id, DEFAULT_LANG),
+            user_store.get_language(update.effective_user.id),
             "English (default)"
         )
     )
@@ -148,7 +170,7 @@ def button_callback(update: Update, context: CallbackContext) -> None:
     """Handle button callbacks."""
     query = update.callback_query
     user_id = query.from_user.id
-    logger.debug(f"Received callback query from user {user_id}: {query.data}")
+    logger.debug("Received callback query from user %s: %s", user_id, query.data)
 
     # Answer callback query to remove loading state
     query.answer()
@@ -156,29 +178,29 @@ def button_callback(update: Update, context: CallbackContext) -> None:
     if query.data == "change_lang":
         keyboard = create_language_keyboard()
         query.edit_message_text("Please select your preferred language:", reply_markup=keyboard)
-        logger.debug(f"Showing language selection menu to user {user_id}")
+        logger.debug("Showing language selection menu to user %s", user_id)
 
     elif query.data == "help":
         keyboard = create_main_menu_keyboard()
         query.edit_message_text(HELP_MESSAGE, reply_markup=keyboard)
-        logger.debug(f"Showing help message to user {user_id}")
+        logger.debug("Showing help message to user %s", user_id)
 
     elif query.data == "about":
         keyboard = create_main_menu_keyboard()
         about_text = "I'm a Text-to-Speech bot that can convert your messages into voice in multiple languages! 🎤"
         query.edit_message_text(about_text, reply_markup=keyboard)
-        logger.debug(f"Showing about message to user {user_id}")
+        logger.debug("Showing about message to user %s", user_id)
 
     elif query.data.startswith("lang_"):
         lang_code = query.data.split("_")[1]
         if lang_code in SUPPORTED_LANGUAGES:
-            user_languages[user_id] = lang_code
+            user_store.set_language(user_id, lang_code)
             keyboard = create_main_menu_keyboard()
             message = LANGUAGE_CHANGED.format(SUPPORTED_LANGUAGES[lang_code])
             query.edit_message_text(message, reply_markup=keyboard)
-            logger.info(f"Language changed to {SUPPORTED_LANGUAGES[lang_code]} for user {user_id}")
+            logger.info("Language changed to %s for user %s", SUPPORTED_LANGUAGES[lang_code], user_id)
         else:
-            logger.warning(f"Invalid language code received from user {user_id}: {lang_code}")
+            logger.warning("Invalid language code received from user %s: %s", user_id, lang_code)
             query.edit_message_text(INVALID_LANGUAGE)
 
 def handle_text(update: Update, context: CallbackContext) -> None:
@@ -188,11 +210,12 @@ def handle_text(update: Update, context: CallbackContext) -> None:
 
     text = update.message.text
     user_id = update.effective_user.id
-    logger.info(f"Processing text message from user {user_id}: {text[:50]}...")
+    logger.info("Processing text message from user %s (%d characters)", user_id, len(text))
+    TEXT_LENGTH_CHARS.observe(len(text))
 
     # Check message length
     if len(text) > 100000:
-        logger.warning(f"Text too long from user {user_id}: {len(text)} characters")
+        logger.warning("Text too long from user %s: %d characters", user_id, len(text))
         update.message.reply_text(TEXT_TOO_LONG)
         return
 
@@ -204,32 +227,239 @@ def handle_text(update: Update, context: CallbackContext) -> None:
         )
 
         # Get user's language preference or use default
-        lang = user_languages.get(user_id, DEFAULT_LANG)
-        logger.info(f"Generating speech for user {user_id} in {SUPPORTED_LANGUAGES[lang]}")
-
-        # Generate speech
-        success, result = generate_speech(text, lang)
-
-        if success:
-            logger.info(f"Speech generated successfully for user {user_id}, sending voice message")
-            # Send voice message
-            with open(result, 'rb') as audio:
-                update.message.reply_voice(voice=audio)
-            # Cleanup
-            cleanup_file(result)
-            logger.info(f"Voice message sent and cleanup completed for user {user_id}")
-        else:
-            logger.error(f"Speech generation failed for user {user_id}: {result}")
-            update.message.reply_text(ERROR_MESSAGE)
+        lang = user_store.get_language(user_id)
+        user_store.touch(user_id)
+        logger.debug("Generating speech for user %s in %s", user_id, lang)
+
+        if len(text) > LONG_TEXT_THRESHOLD:
+            with STAGE_SECONDS.time(stage='total', lang=lang):
+                send_long_text(update, context, text, lang)
+            return
+
+        with STAGE_SECONDS.time(stage='total', lang=lang):
+            send_voice(update, text, lang)
 
     except Exception as e:
-        logger.error(f"Error processing message for user {user_id}: {str(e)}")
+        logger.error("Error processing message for user %s: %s", user_id, e)
+        ERRORS.inc(type=type(e).__name__)
         update.message.reply_text(ERROR_MESSAGE)
 
+def synthesize_to_cache(cache_key: str, text: str, lang: str) -> tuple[bool, object, bool]:
+    """
+    Generate speech and store it in the audio cache.
+
+    Audio from a fallback engine is not cached, so the text is synthesized
+    by the preferred engine again once it has recovered.
+
+    Args:
+        cache_key (str): Audio cache key for (text, lang)
+        text (str): Text to convert to speech
+        lang (str): Language code
+
+    Returns:
+        tuple[bool, object, bool]: (success, audio bytes or error_message, whether the audio was cached)
+    """
+    # Synthesis and file_write stages are recorded by utils
+    with record_fallbacks() as fallbacks:
+        success, result = synthesize(text, lang)
+    if not success:
+        return False, result, False
+    # Closing the result releases its buffer or file
+    try:
+        audio = result.getvalue()
+    finally:
+        with STAGE_SECONDS.time(stage='cleanup', lang=lang):
+            result.close()
+    if fallbacks:
+        logger.info("Not caching audio produced by fallback engine %s", ', '.join(fallbacks))
+        return True, audio, False
+    audio_cache.put_audio(cache_key, audio)
+    return True, audio, True
+
+def send_voice(update: Update, text: str, lang: str) -> None:
+    """Reply with a single voice message, reusing cached audio where possible."""
+    user_id = update.effective_user.id
+    cache_key = make_key(text, lang)
+
+    # Re-send a clip Telegram already has, without synthesizing or uploading
+    file_id = audio_cache.get_file_id(cache_key)
+    if file_id:
+        try:
+            with STAGE_SECONDS.time(stage='resend', lang=lang):
+                update.message.reply_voice(voice=file_id)
+            logger.info("Voice message re-sent from cached file_id for user %s", user_id)
+            return
+        except BadRequest as e:
+            logger.warning("Cached file_id rejected for user %s: %s", user_id, e)
+            ERRORS.inc(type='StaleFileId')
+            audio_cache.forget_file_id(cache_key)
+
+    audio = audio_cache.get_audio(cache_key)
+    cached = audio is not None
+    if audio is None:
+        # Identical requests arriving while this one synthesizes share its result
+        success, audio, cached = synthesis_flight.do(cache_key, synthesize_to_cache, cache_key, text, lang)
+
+        if not success:
+            logger.error("Speech generation failed for user %s: %s", user_id, audio)
+            ERRORS.inc(type='SynthesisFailed')
+            update.message.reply_text(ERROR_MESSAGE)
+            return
+        logger.debug("Speech generated for user %s, sending voice message", user_id)
+
+    with STAGE_SECONDS.time(stage='upload', lang=lang):
+        sent = update.message.reply_voice(voice=audio, duration=voice_duration(audio),
+                                          filename=f"voice.{audio_format(audio)}")
+
+    # Remember the file_id for future repeats, unless the audio stood in for an outage
+    if cached and sent and sent.voice:
+        audio_cache.set_file_id(cache_key, sent.voice.file_id)
+    logger.info("Voice message sent for user %s", user_id)
+
+def send_long_text(update: Update, context: CallbackContext, text: str, lang: str) -> None:
+    """Synthesize a long text in chunks and send each part as soon as it is ready."""
+    user_id = update.effective_user.id
+    chunks = split_text(text)
+    total = len(chunks)
+    logger.info("Sending long text for user %s as %d voice messages", user_id, total)
+
+    for index, (success, result) in enumerate(synthesize_chunks(chunks, lang), start=1):
+        if not success:
+            logger.error("Chunk %d/%d failed for user %s: %s", index, total, user_id, result)
+            ERRORS.inc(type='SynthesisFailed')
+            update.message.reply_text(CHUNK_FAILED.format(index, total))
+            continue
+        try:
+            with STAGE_SECONDS.time(stage='upload', lang=lang):
+                update.message.reply_voice(voice=result, caption=f"{index}/{total}",
+                                           duration=voice_duration(result.getvalue()))
+        finally:
+            with STAGE_SECONDS.time(stage='cleanup', lang=lang):
+                result.close()
+        if index < total:
+            context.bot.send_chat_action(
+                chat_id=update.effective_chat.id,
+                action=ChatAction.RECORD_VOICE
+            )
+
+    logger.info("Long text delivered for user %s", user_id)
+
+async def handle_text_async(update: Update, context: CallbackContext) -> None:
+    """Handle text messages like handle_text, as a coroutine on the asyncio runtime."""
+    if not update.message or not update.message.text:
+        return
+
+    text = update.message.text
+    user_id = update.effective_user.id
+    logger.info("Processing text message from user %s (%d characters)", user_id, len(text))
+    TEXT_LENGTH_CHARS.observe(len(text))
+
+    telegram = runtime.telegram(context.bot)
+    if len(text) > 100000:
+        logger.warning("Text too long from user %s: %d characters", user_id, len(text))
+        await telegram.reply_text(update.message, TEXT_TOO_LONG)
+        return
+
+    try:
+        await telegram.send_chat_action(update.effective_chat.id, ChatAction.RECORD_VOICE)
+
+        lang = user_store.get_language(user_id)
+        user_store.touch(user_id)
+        logger.debug("Generating speech for user %s in %s", user_id, lang)
+
+        if len(text) > LONG_TEXT_THRESHOLD:
+            with STAGE_SECONDS.time(stage='total', lang=lang):
+                await send_long_text_async(telegram, update, text, lang)
+            return
+
+        with STAGE_SECONDS.time(stage='total', lang=lang):
+            await send_voice_async(telegram, update, text, lang)
+
+    except Exception as e:
+        logger.error("Error processing message for user %s: %s", user_id, e)
+        ERRORS.inc(type=type(e).__name__)
+        await telegram.reply_text(update.message, ERROR_MESSAGE)
+
+async def send_voice_async(telegram: AsyncTelegram, update: Update, text: str, lang: str) -> None:
+    """Coroutine version of send_voice: Telegram calls are made with ``telegram``, synthesis on the blocking pool."""
+    user_id = update.effective_user.id
+    cache_key = make_key(text, lang)
+
+    file_id = audio_cache.get_file_id(cache_key)
+    if file_id:
+        try:
+            with STAGE_SECONDS.time(stage='resend', lang=lang):
+                await telegram.reply_voice(update.message, file_id)
+            logger.info("Voice message re-sent from cached file_id for user %s", user_id)
+            return
+        except BadRequest as e:
+            logger.warning("Cached file_id rejected for user %s: %s", user_id, e)
+            ERRORS.inc(type='StaleFileId')
+            audio_cache.forget_file_id(cache_key)
+
+    audio = audio_cache.get_audio(cache_key)
+    cached = audio is not None
+    if audio is None:
+        success, audio, cached = await runtime.blocking(
+            synthesis_flight.do, cache_key, synthesize_to_cache, cache_key, text, lang
+        )
+
+        if not success:
+            logger.error("Speech generation failed for user %s: %s", user_id, audio)
+            ERRORS.inc(type='SynthesisFailed')
+            await telegram.reply_text(update.message, ERROR_MESSAGE)
+            return
+        logger.debug("Speech generated for user %s, sending voice message", user_id)
+
+    with STAGE_SECONDS.time(stage='upload', lang=lang):
+        sent = await telegram.reply_voice(update.message, audio, duration=voice_duration(audio),
+                                          filename=f"voice.{audio_format(audio)}")
+
+    if cached and sent and sent.voice:
+        audio_cache.set_file_id(cache_key, sent.voice.file_id)
+    logger.info("Voice message sent for user %s", user_id)
+
+async def send_long_text_async(telegram: AsyncTelegram, update: Update, text: str, lang: str) -> None:
+    """Coroutine version of send_long_text: only waiting for the next synthesized chunk uses the blocking pool."""
+    user_id = update.effective_user.id
+    chunks = split_text(text)
+    total = len(chunks)
+    logger.info("Sending long text for user %s as %d voice messages", user_id, total)
+
+    # The chunks are still synthesized ahead on the synthesis pool while earlier ones upload
+    results = synthesize_chunks(chunks, lang)
+    try:
+        for index in range(1, total + 1):
+            success, result = await runtime.blocking(next, results)
+            if not success:
+                logger.error("Chunk %d/%d failed for user %s: %s", index, total, user_id, result)
+                ERRORS.inc(type='SynthesisFailed')
+                await telegram.reply_text(update.message, CHUNK_FAILED.format(index, total))
+                continue
+            try:
+                audio = result.getvalue()
+                with STAGE_SECONDS.time(stage='upload', lang=lang):
+                    await telegram.reply_voice(update.message, audio, caption=f"{index}/{total}",
+                                               duration=voice_duration(audio),
+                                               filename=f"voice.{audio_format(audio)}")
+            finally:
+                with STAGE_SECONDS.time(stage='cleanup', lang=lang):
+                    result.close()
+            if index < total:
+                await telegram.send_chat_action(update.effective_chat.id, ChatAction.RECORD_VOICE)
+    finally:
+        await runtime.blocking(results.close)
+
+    logger.info("Long text delivered for user %s", user_id)
+
+# Text message handler for the configured runtime
+text_handler = handle_text_async if RUNTIME == 'asyncio' else handle_text
+
 def error_handler(update: Update, context: CallbackContext) -> None:
     """Handle errors."""
     error = context.error
-    logger.error(f"Update {update} caused error {error}")
+    logger.error("Update %s caused error %s", getattr(update, 'update_id', None), error)
+    ERRORS.inc(type=type(error).__name__)
 
     try:
         if "Conflict" in str(error):
@@ -239,4 +469,4 @@ def error_handler(update: Update, context: CallbackContext) -> None:
         if update and update.effective_message:
             update.effective_message.reply_text(ERROR_MESSAGE)
     except Exception as e:
-        logger.error(f"Error in error handler: {str(e)}")
\ No newline at end of file
+        logger.error("Error in error handler: %s", e)
\ No newline at end of file
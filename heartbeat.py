@@ -0,0 +1,161 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from sqlalchemy import delete
+from sqlalchemy.dialects import postgresql, sqlite
+from telegram import Update
+from telegram.ext import CallbackContext, ExtBot
+from app import app, db
+from models import Heartbeat, MetricsSnapshot
+from scheduler import scheduler
+from utils import in_flight_synthesis
+from metrics import Gauge, process_name, snapshot
+from config import HEARTBEAT_INTERVAL, HEARTBEAT_STALE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatPublisher:
+    """
+    Publish this process's liveness data to the heartbeat table.
+
+    Polls and updates are only recorded in memory, so tracking them costs a
+    couple of assignments; a background thread writes one upsert every
+    ``interval`` seconds. The web process reads the row back in /health,
+    which works whether or not the bot runs in the same process. The same
+    transaction stores a snapshot of this process's metrics, which the web
+    process adds to /metrics.
+    """
+
+    def __init__(self, interval: float = HEARTBEAT_INTERVAL):
+        self.interval = interval
+        self.mode = None
+        self._backlog = None
+        self._last_poll_at = None
+        self._last_update_id = None
+        self._last_update_at = None
+        self._update_lag = None
+        self.updates = 0  # updates received by this process
+        self._stop = threading.Event()
+        self._thread = None
+
+    def polled(self) -> None:
+        """Record that a getUpdates call completed."""
+        self._last_poll_at = datetime.utcnow()
+
+    def record_update(self, update: Update) -> None:
+        """Record the newest update received and how long it took to reach us."""
+        self._last_update_id = update.update_id
+        self._last_update_at = datetime.utcnow()
+        self.updates += 1
+        message = update.effective_message
+        if message and message.date:
+            self._update_lag = max(0.0, time.time() - message.date.timestamp())
+
+    def healthy(self) -> bool:
+        """Return whether this process is serving updates; in polling mode getUpdates must be completing."""
+        if self.mode != 'polling':
+            return self.mode is not None
+        return (self._last_poll_at is not None
+                and (datetime.utcnow() - self._last_poll_at).total_seconds() < HEARTBEAT_STALE_SECONDS)
+
+    def queue_depth(self) -> int:
+        """Return the jobs waiting for a handler worker plus the updates received but not yet dispatched."""
+        queue_depth = scheduler.stats()['queue_depth']
+        if self._backlog is not None:
+            queue_depth += self._backlog()
+        return queue_depth
+
+    def snapshot(self) -> dict:
+        """Return the row that the next publish would write."""
+        return {
+            'mode': self.mode,
+            'updated_at': datetime.utcnow(),
+            'last_poll_at': self._last_poll_at,
+            'last_update_id': self._last_update_id,
+            'last_update_at': self._last_update_at,
+            'update_lag_seconds': self._update_lag,
+            'queue_depth': self.queue_depth(),
+            'in_flight': in_flight_synthesis(),
+        }
+
+    def publish(self) -> None:
+        """Upsert the current snapshot into the heartbeat table, and this process's metrics next to it."""
+        row = self.snapshot()
+        metrics = {'process': process_name(), 'updated_at': row['updated_at'], 'payload': json.dumps(snapshot())}
+        with app.app_context():
+            insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+            stmt = insert(Heartbeat).values(**row)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Heartbeat.mode],
+                set_={column: stmt.excluded[column] for column in row if column != 'mode'}
+            )
+            db.session.execute(stmt)
+            stmt = insert(MetricsSnapshot).values(**metrics)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[MetricsSnapshot.process],
+                set_={'updated_at': stmt.excluded.updated_at, 'payload': stmt.excluded.payload}
+            )
+            db.session.execute(stmt)
+            # Processes that are gone (restarts, deploys) leave their last snapshot behind
+            db.session.execute(delete(MetricsSnapshot).where(
+                MetricsSnapshot.updated_at < row['updated_at'] - timedelta(hours=1)
+            ))
+            db.session.commit()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error("Failed to publish heartbeat: %s", e)
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self, mode: str, backlog: Optional[Callable[[], int]] = None) -> None:
+        """
+        Start publishing if this process is not already doing so.
+
+        Args:
+            mode (str): 'polling' or 'webhook'; /health reads the row of the configured mode
+            backlog (Callable[[], int]): Optional count of received updates not yet dispatched
+        """
+        self.mode = mode
+        self._backlog = backlog
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the publishing thread."""
+        self._stop.set()
+
+
+# Shared heartbeat publisher
+heartbeat = HeartbeatPublisher()
+
+# Read back from the published snapshots by the status recorder. Shard workers
+# also see every update, so only the process receiving them from Telegram counts
+Gauge('bot_updates_received_total', 'Updates received from Telegram by this process.',
+      lambda: heartbeat.updates if heartbeat.mode in ('polling', 'webhook') else 0, kind='counter')
+Gauge('bot_queue_depth', 'Jobs waiting for a handler worker plus updates not yet dispatched.', heartbeat.queue_depth)
+
+
+def track_update(update: object, context: CallbackContext) -> None:
+    """Handler callback that records every incoming update in the heartbeat."""
+    if isinstance(update, Update):
+        heartbeat.record_update(update)
+
+
+class HeartbeatBot(ExtBot):
+    """Bot that records each completed getUpdates call, so the heartbeat shows polling progress."""
+
+    def get_updates(self, *args, **kwargs):
+        updates = super().get_updates(*args, **kwargs)
+        heartbeat.polled()
+        return updates
@@ -0,0 +1,161 @@
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from telegram.utils.request import Request
+from config import (
+    HTTP_POOL_SIZE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    TELEGRAM_POOL_SIZE,
+    TELEGRAM_PROXY_URL
+)
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats:
+    """Thread-safe connection pool counters for one group of outbound traffic."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {
+            'requests': 0,  # connections checked out of the pool
+            'opened': 0,  # new TCP (+TLS) connections made
+            'saturated': 0,  # checkouts that found every pooled connection busy
+            'discarded': 0,  # connections closed because the pool was full on return
+        }
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def stats(self) -> dict:
+        """Return the counters plus the number of checkouts that reused a connection."""
+        with self._lock:
+            stats = dict(self._counts)
+        stats['reused'] = max(0, stats['requests'] - stats['opened'])
+        return stats
+
+
+_counting_classes = {}
+
+
+def _counting_pool_class(base, stats: PoolStats):
+    """Subclass a urllib3 connection pool class so it reports to ``stats``."""
+    key = (base, id(stats))
+    if key not in _counting_classes:
+        class CountingPool(base):
+            def _get_conn(self, timeout=None):
+                stats.add('requests')
+                if self.pool is not None and self.pool.empty():
+                    stats.add('saturated')
+                return super()._get_conn(timeout)
+
+            def _new_conn(self):
+                stats.add('opened')
+                return super()._new_conn()
+
+            def _put_conn(self, conn):
+                if self.pool is not None and self.pool.full():
+                    stats.add('discarded')
+                return super()._put_conn(conn)
+
+        CountingPool.__name__ = f"Counting{base.__name__}"
+        _counting_classes[key] = CountingPool
+    return _counting_classes[key]
+
+
+def instrument(pool_manager, stats: PoolStats) -> None:
+    """
+    Make a urllib3 PoolManager (requests' or PTB's vendored copy) count into ``stats``.
+
+    Must be called before the manager opens its first pool.
+    """
+    pool_manager.pool_classes_by_scheme = {
+        scheme: _counting_pool_class(cls, stats)
+        for scheme, cls in pool_manager.pool_classes_by_scheme.items()
+    }
+
+
+def build_session(pool_size: int, stats: PoolStats) -> requests.Session:
+    """
+    Create a keep-alive requests session whose connections are counted in ``stats``.
+
+    Up to ``pool_size`` connections per host are kept open. When all of them
+    are busy, callers wait for one instead of opening a throwaway connection.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+    instrument(adapter.poolmanager, stats)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class HTTPPool:
+    """
+    Shared outbound HTTP connection pools for this process.
+
+    gTTS calls go through one keep-alive requests session and Telegram API
+    calls through one PTB Request object, so connections (and their TLS
+    handshakes) are reused across requests instead of made per call. PTB
+    ships its own copy of urllib3, so the two stay separate pools, but both
+    are sized, timed out and counted here.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tts_stats = PoolStats()
+        self.telegram_stats = PoolStats()
+        # Connections of the asyncio runtime's Telegram client (aiotelegram.py)
+        self.telegram_async_stats = PoolStats()
+        self._session = None
+        self._telegram_request = None
+
+    @property
+    def timeout(self) -> tuple:
+        """(connect, read) timeout for requests made through :attr:`session`."""
+        return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+    @property
+    def session(self) -> requests.Session:
+        """Keep-alive session for text-to-speech HTTP calls."""
+        with self._lock:
+            if self._session is None:
+                self._session = build_session(HTTP_POOL_SIZE, self.tts_stats)
+            return self._session
+
+    def telegram_request(self) -> Request:
+        """Return the shared PTB Request used by every Bot in this process."""
+        with self._lock:
+            if self._telegram_request is None:
+                self._telegram_request = Request(
+                    con_pool_size=TELEGRAM_POOL_SIZE,
+                    connect_timeout=HTTP_CONNECT_TIMEOUT,
+                    read_timeout=HTTP_READ_TIMEOUT,
+                    proxy_url=TELEGRAM_PROXY_URL
+                )
+                pool_manager = getattr(self._telegram_request, '_con_pool', None)
+                if hasattr(pool_manager, 'pool_classes_by_scheme'):
+                    instrument(pool_manager, self.telegram_stats)
+                else:
+                    logger.warning("Telegram connection pool cannot be instrumented, stats will stay at zero")
+            return self._telegram_request
+
+    def stats(self) -> dict:
+        """Return pool counters for both kinds of traffic."""
+        return {
+            'tts': self.tts_stats.stats(),
+            'telegram': self.telegram_stats.stats(),
+            'telegram_async': self.telegram_async_stats.stats(),
+        }
+
+
+# Shared outbound connection pools
+http_pool = HTTPPool()
+
+Gauge('http_pool_events_total', 'Outbound connection pool events by pool and kind.',
+      lambda: {(pool, event): value for pool, stats in http_pool.stats().items() for event, value in stats.items()},
+      labelnames=('pool', 'event'), kind='counter')
@@ -0,0 +1,470 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import delete, or_, and_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher
+from app import app, db
+from models import TTSJob, UpdateOffset, WebhookUpdate
+from scheduler import scheduler
+from aioruntime import runtime
+from logs import bind_update
+from config import (
+    JOB_LEASE_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    JOB_RETENTION_HOURS,
+    JOB_OFFSET_COMMIT_INTERVAL,
+    BUSY_MESSAGE
+)
+from metrics import Counter
+from userstore import user_store
+
+logger = logging.getLogger(__name__)
+
+JOBS = Counter(
+    'tts_jobs_total',
+    'Durable text-to-speech jobs by event.',
+    ('event',)
+)
+
+
+def _insert():
+    return postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+
+
+class JobQueue:
+    """
+    Persistent queue of accepted text-to-speech jobs.
+
+    Each job is keyed by the update_id it came from, so an update Telegram
+    delivers twice (after a restart, or a webhook retry) maps to the job
+    already recorded instead of a second reply. Jobs are claimed with a
+    lease before they run, which a background thread renews while they
+    run; a job whose process died is run again once the lease expires, so
+    every accepted job is answered at least once.
+
+    The queue also keeps track of received updates. In polling mode that is
+    the offset: the newest update whose handlers have all run, committed at
+    most every ``commit_interval`` seconds and on shutdown, so the next
+    process resumes right after it. In webhook mode each update is stored
+    before Telegram gets its answer and deleted once its handlers have run,
+    under a lease like a job's, so another process can take over the updates
+    of one that died.
+    """
+
+    def __init__(self, lease_seconds: float = JOB_LEASE_SECONDS, max_attempts: int = JOB_MAX_ATTEMPTS,
+                 commit_interval: float = JOB_OFFSET_COMMIT_INTERVAL):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._claimed = set()  # jobs this process is running
+        self._held = set()  # webhook updates this process is handling
+        self._offset = None  # newest handled update id
+        self._committed = None
+        self._committed_at = 0.0
+        self._renewer = None
+
+    @staticmethod
+    def owner_id(pid: Optional[int] = None) -> str:
+        """Return the owner recorded on jobs claimed by process ``pid`` (default: this one)."""
+        return f"{socket.gethostname()}:{pid or os.getpid()}"
+
+    def add(self, update: Update) -> Optional[int]:
+        """
+        Record a job for ``update``.
+
+        Returns:
+            Optional[int]: The new job's id, or None if the update already has a job
+        """
+        now = datetime.utcnow()
+        with app.app_context():
+            stmt = _insert()(TTSJob).values(
+                update_id=update.update_id,
+                user_id=update.effective_user.id,
+                payload=update.to_json(),
+                status='pending',
+                attempts=0,
+                created_at=now,
+                updated_at=now
+            ).on_conflict_do_nothing(index_elements=[TTSJob.update_id]).returning(TTSJob.id)
+            job_id = db.session.execute(stmt).scalar()
+            db.session.commit()
+        JOBS.inc(event='accepted' if job_id is not None else 'duplicate')
+        return job_id
+
+    def claim(self, job_id: int) -> bool:
+        """Take a pending job, or one whose lease expired, for this process. Only one caller can win."""
+        now = datetime.utcnow()
+        with app.app_context():
+            result = db.session.execute(
+                update(TTSJob)
+                .where(
+                    TTSJob.id == job_id,
+                    TTSJob.attempts < self.max_attempts,
+                    or_(TTSJob.status == 'pending',
+                        and_(TTSJob.status == 'running', TTSJob.lease_until < now))
+                )
+                .values(status='running', attempts=TTSJob.attempts + 1, owner=self.owner_id(),
+                        lease_until=now + timedelta(seconds=self.lease_seconds), updated_at=now)
+            )
+            db.session.commit()
+        if result.rowcount != 1:
+            return False
+        with self._lock:
+            self._claimed.add(job_id)
+        self._start_renewer()
+        return True
+
+    def _start_renewer(self) -> None:
+        with self._lock:
+            if self._renewer and self._renewer.is_alive():
+                return
+            self._renewer = threading.Thread(target=self._renew_leases, name='job-leases', daemon=True)
+            self._renewer.start()
+
+    def _renew_leases(self) -> None:
+        """Extend the leases of the jobs and webhook updates this process holds, three times per lease."""
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._lock:
+                claimed = list(self._claimed)
+                held = list(self._held)
+            lease_until = datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+            try:
+                with app.app_context():
+                    if claimed:
+                        db.session.execute(
+                            update(TTSJob)
+                            .where(TTSJob.id.in_(claimed), TTSJob.owner == self.owner_id(), TTSJob.status == 'running')
+                            .values(lease_until=lease_until)
+                        )
+                    if held:
+                        db.session.execute(
+                            update(WebhookUpdate)
+                            .where(WebhookUpdate.update_id.in_(held), WebhookUpdate.owner == self.owner_id())
+                            .values(lease_until=lease_until)
+                        )
+                    db.session.commit()
+            except Exception as e:
+                logger.error("Failed to renew job leases: %s", e)
+
+    def finish(self, job_id: int, status: str = 'done') -> None:
+        """Mark a job finished and drop its payload, which holds the user's text."""
+        with app.app_context():
+            db.session.execute(
+                update(TTSJob)
+                .where(TTSJob.id == job_id)
+                .values(status=status, payload='', lease_until=None, updated_at=datetime.utcnow())
+            )
+            db.session.commit()
+        with self._lock:
+            self._claimed.discard(job_id)
+        JOBS.inc(event=status)
+
+    def running_here(self, job_id: int) -> bool:
+        """Return True if this process has claimed ``job_id`` and not finished it."""
+        with self._lock:
+            return job_id in self._claimed
+
+    def release(self, pid: Optional[int] = None) -> int:
+        """
+        Hand jobs back to the queue before their leases expire.
+
+        Called when this process shuts down before its jobs finished, or with
+        the pid of a crashed worker process, so the jobs are run again right
+        away instead of once their leases expire.
+
+        Args:
+            pid (int): Process whose running jobs to release (default: this one)
+
+        Returns:
+            int: Number of jobs released
+        """
+        if pid is None:
+            with self._lock:
+                self._claimed = set()
+        with app.app_context():
+            result = db.session.execute(
+                update(TTSJob)
+                .where(TTSJob.owner == self.owner_id(pid), TTSJob.status == 'running')
+                .values(status='pending', owner=None, lease_until=None, updated_at=datetime.utcnow())
+            )
+            db.session.commit()
+        return result.rowcount
+
+    def unfinished(self) -> list:
+        """
+        Return ``(id, user_id, payload, lease_until)`` for every pending or running job.
+
+        Jobs that used up their attempts are marked failed instead, and
+        finished jobs past the retention period are deleted.
+        """
+        now = datetime.utcnow()
+        with app.app_context():
+            db.session.execute(
+                update(TTSJob)
+                .where(TTSJob.status.in_(('pending', 'running')), TTSJob.attempts >= self.max_attempts)
+                .values(status='failed', payload='', lease_until=None, updated_at=now)
+            )
+            db.session.execute(
+                delete(TTSJob).where(
+                    TTSJob.status.notin_(('pending', 'running')),
+                    TTSJob.updated_at < now - timedelta(hours=JOB_RETENTION_HOURS)
+                )
+            )
+            db.session.commit()
+            return db.session.execute(
+                select(TTSJob.id, TTSJob.user_id, TTSJob.payload, TTSJob.lease_until)
+                .where(TTSJob.status.in_(('pending', 'running')))
+                .order_by(TTSJob.id)
+            ).all()
+
+    def store_update(self, data: dict) -> bool:
+        """
+        Store a webhook update before it is acknowledged, so it survives a crash.
+
+        Args:
+            data (dict): The update as Telegram sent it
+
+        Returns:
+            bool: False if the update is already stored, i.e. Telegram delivered it again
+        """
+        now = datetime.utcnow()
+        with app.app_context():
+            stmt = _insert()(WebhookUpdate).values(
+                update_id=data['update_id'],
+                payload=json.dumps(data),
+                owner=self.owner_id(),
+                lease_until=now + timedelta(seconds=self.lease_seconds)
+            ).on_conflict_do_nothing(index_elements=[WebhookUpdate.update_id]).returning(WebhookUpdate.update_id)
+            stored = db.session.execute(stmt).scalar()
+            db.session.commit()
+        if stored is None:
+            return False
+        with self._lock:
+            self._held.add(stored)
+        self._start_renewer()
+        return True
+
+    def forget_updates(self, update_ids: list) -> None:
+        """Delete stored webhook updates whose handlers have all run."""
+        with self._lock:
+            self._held.difference_update(update_ids)
+        with app.app_context():
+            db.session.execute(delete(WebhookUpdate).where(WebhookUpdate.update_id.in_(update_ids)))
+            db.session.commit()
+
+    def holds_update(self, update_id: int) -> bool:
+        """Return True if this process stored or took over ``update_id`` and has not deleted it."""
+        with self._lock:
+            return update_id in self._held
+
+    def stored_updates(self) -> list:
+        """Return ``(update_id, lease_until)`` for every stored webhook update, oldest first."""
+        with app.app_context():
+            return db.session.execute(
+                select(WebhookUpdate.update_id, WebhookUpdate.lease_until)
+                .order_by(WebhookUpdate.update_id)
+            ).all()
+
+    def claim_update(self, update_id: int) -> Optional[dict]:
+        """
+        Take over a stored webhook update whose lease expired. Only one caller can win.
+
+        Returns:
+            Optional[dict]: The update as Telegram sent it, or None if it was handled or taken meanwhile
+        """
+        now = datetime.utcnow()
+        with app.app_context():
+            result = db.session.execute(
+                update(WebhookUpdate)
+                .where(WebhookUpdate.update_id == update_id, WebhookUpdate.lease_until < now)
+                .values(owner=self.owner_id(), lease_until=now + timedelta(seconds=self.lease_seconds))
+            )
+            payload = db.session.scalar(select(WebhookUpdate.payload).where(WebhookUpdate.update_id == update_id))
+            db.session.commit()
+        if result.rowcount != 1:
+            return None
+        with self._lock:
+            self._held.add(update_id)
+        self._start_renewer()
+        return json.loads(payload)
+
+    def handled(self, update_id: int) -> None:
+        """Record that every handler has run for ``update_id``, committing the offset if it is due."""
+        with self._lock:
+            if self._offset is None or update_id > self._offset:
+                self._offset = update_id
+            due = time.monotonic() - self._committed_at >= self.commit_interval
+        if due:
+            self.commit_offset()
+
+    def commit_offset(self) -> None:
+        """Write the newest handled update id to the database."""
+        with self._lock:
+            offset = self._offset
+            if offset is None or offset == self._committed:
+                return
+            self._committed_at = time.monotonic()
+        row = {'mode': 'polling', 'update_id': offset, 'updated_at': datetime.utcnow()}
+        try:
+            with app.app_context():
+                stmt = _insert()(UpdateOffset).values(**row)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[UpdateOffset.mode],
+                    set_={'update_id': stmt.excluded.update_id, 'updated_at': stmt.excluded.updated_at}
+                )
+                db.session.execute(stmt)
+                db.session.commit()
+        except Exception as e:
+            logger.error("Failed to commit update offset %s: %s", offset, e)
+            return
+        with self._lock:
+            self._committed = offset
+
+    def committed_offset(self) -> Optional[int]:
+        """Return the last committed update id, or None if nothing was committed yet."""
+        with app.app_context():
+            row = db.session.get(UpdateOffset, 'polling')
+            offset = row.update_id if row else None
+        with self._lock:
+            self._committed = self._offset = offset
+        return offset
+
+
+# Shared persistent job queue
+job_queue = JobQueue()
+
+
+def _run_job(job_id: Optional[int], handler, update: Update, context: CallbackContext) -> None:
+    bind_update(update)
+    if job_id is not None and not job_queue.claim(job_id):
+        # Finished already, or another process holds it
+        return
+    try:
+        handler(update, context)
+    except Exception as e:
+        context.dispatcher.dispatch_error(update, e)
+    finally:
+        if job_id is not None:
+            try:
+                job_queue.finish(job_id)
+            except Exception as e:
+                logger.error("Failed to mark job %s finished: %s", job_id, e)
+
+
+async def _run_job_async(job_id: Optional[int], handler, update: Update, context: CallbackContext) -> None:
+    # Same as _run_job for coroutine handlers, keeping the database calls off the event loop
+    bind_update(update)
+    if job_id is not None and not await runtime.blocking(job_queue.claim, job_id):
+        return
+    try:
+        await handler(update, context)
+    except Exception as e:
+        await runtime.blocking(context.dispatcher.dispatch_error, update, e)
+    finally:
+        if job_id is not None:
+            try:
+                await runtime.blocking(job_queue.finish, job_id)
+            except Exception as e:
+                logger.error("Failed to mark job %s finished: %s", job_id, e)
+
+
+def _runner(handler):
+    return _run_job_async if asyncio.iscoroutinefunction(handler) else _run_job
+
+
+def durable(handler):
+    """
+    Wrap a handler so each update is stored as a job before it runs on the shared scheduler.
+
+    Duplicate deliveries of an update are ignored. If the job cannot be
+    stored the handler still runs, just without surviving a restart. If the
+    scheduler is saturated the user immediately gets BUSY_MESSAGE. Coroutine
+    handlers need the asyncio scheduler (RUNTIME=asyncio). The wrapper
+    returns whether the update was accepted, for ``rate_limited``.
+    """
+    run = _runner(handler)
+
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext) -> bool:
+        user_id = update.effective_user.id if update.effective_user else None
+        try:
+            job_id = job_queue.add(update)
+        except Exception as e:
+            logger.error("Failed to store job for update %s, running it anyway: %s", update.update_id, e)
+            job_id = None
+        else:
+            if job_id is None:
+                logger.info("Update %s already has a job, ignoring the duplicate", update.update_id)
+                return False
+        if not scheduler.submit(user_id, run, job_id, handler, update, context, lang=user_store.get_language(user_id)):
+            logger.warning("Scheduler full, rejecting update from user %s", user_id)
+            if job_id is not None:
+                job_queue.finish(job_id, 'rejected')
+            if update.effective_message:
+                update.effective_message.reply_text(BUSY_MESSAGE)
+            return False
+        return True
+    return wrapper
+
+
+def track_offset(update: Update, context: CallbackContext) -> None:
+    """Dispatcher callback, registered after all other handlers, that advances the polling offset."""
+    job_queue.handled(update.update_id)
+
+
+def resume_jobs(dispatcher: Dispatcher, handler, shard: Optional[tuple] = None) -> None:
+    """
+    Queue the jobs left unfinished by a previous run on the shared scheduler.
+
+    Pending jobs are queued right away. Jobs still leased by another (or a
+    crashed) process are checked again once the earliest lease would have
+    expired, and are only run if claiming them succeeds then. Jobs that do
+    not fit in the scheduler are checked again a few seconds later.
+
+    Args:
+        dispatcher (Dispatcher): Dispatcher whose bot answers the jobs
+        handler: Handler the jobs were accepted for
+        shard (tuple): Optional (index, count) to only resume the jobs of users
+            with ``user_id % count == index``
+    """
+    try:
+        jobs = job_queue.unfinished()
+    except Exception as e:
+        logger.error("Failed to load unfinished jobs: %s", e)
+        return
+
+    now = datetime.utcnow()
+    next_check = None
+    resumed = 0
+    for job_id, user_id, payload, lease_until in jobs:
+        if job_queue.running_here(job_id) or (shard and user_id % shard[1] != shard[0]):
+            continue
+        if lease_until is not None and lease_until > now:
+            next_check = min(next_check or lease_until, lease_until)
+            continue
+        update = Update.de_json(json.loads(payload), dispatcher.bot)
+        context = CallbackContext.from_update(update, dispatcher)
+        if not scheduler.submit(user_id, _runner(handler), job_id, handler, update, context,
+                                lang=user_store.get_language(user_id)):
+            # The rest stay pending until the scheduler has room again
+            next_check = now + timedelta(seconds=5)
+            break
+        resumed += 1
+    if resumed:
+        logger.info("Resumed %s unfinished text-to-speech jobs", resumed)
+        JOBS.inc(resumed, event='resumed')
+    if next_check is not None:
+        timer = threading.Timer((next_check - now).total_seconds() + 1, resume_jobs, args=(dispatcher, handler, shard))
+        timer.daemon = True
+        timer.start()
@@ -0,0 +1,146 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Id of the Telegram update being handled, attached to every record logged while handling it
+request_id = ContextVar('request_id', default=None)
+
+_listener = None
+
+
+def bind_update(update: object, context: object = None) -> None:
+    """
+    Make ``update``'s id the request id of records logged from here on in this thread or task.
+
+    Usable as a dispatcher callback, so it can run before every other handler.
+    """
+    request_id.set(getattr(update, 'update_id', None))
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let each logging call site below WARNING through at most ``rate`` times per second.
+
+    Per-message events (one "voice message sent" per reply) would otherwise
+    grow with traffic. Records are keyed by logger and line, so each call
+    site has its own budget of ``burst`` records refilled at ``rate`` per
+    second. The number of records dropped since the last one that got
+    through is attached to it as ``suppressed``. Warnings and errors are
+    never dropped.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._lock = threading.Lock()
+        self._buckets = {}  # (logger, lineno) -> [tokens, updated_at, suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+            bucket[0] = tokens - 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """Format each record as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        if getattr(record, 'request_id', None) is not None:
+            entry['request_id'] = record.request_id
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread.
+
+    The standard QueueHandler renders the message before enqueueing it;
+    here the caller only stamps the request id, and the message, its
+    arguments and any traceback are formatted when the record is written.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id.get()
+        return record
+
+
+def configure_logging(level: str = 'INFO', module_levels: str = '', fmt: str = 'json', rate: float = 0) -> None:
+    """
+    Send every log record through a queue to a background thread that writes it to stdout.
+
+    Args:
+        level (str): Level of the root logger
+        module_levels (str): Per-logger overrides, e.g. "telegram=WARNING,engines=DEBUG"
+        fmt (str): 'json' for one JSON object per line, 'text' for plain lines
+        rate (float): Records per second allowed per call site below WARNING (0: no limit)
+    """
+    global _listener
+    stop_logging()
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(log_queue)
+    if rate > 0:
+        handler.addFilter(RateLimitFilter(rate))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for item in module_levels.split(','):
+        name, _, module_level = item.partition('=')
+        if name.strip() and module_level.strip():
+            logging.getLogger(name.strip()).setLevel(module_level.strip().upper())
+
+    _listener = QueueListener(log_queue, output)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """Write out every queued record and stop the background thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
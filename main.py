@@ -1,39 +1,48 @@
-from bot import run_bot
-from config import logger, TELEGRAM_TOKEN
-import time
+from config import TELEGRAM_TOKEN, BOT_MODE
+import logging
+import os
 from threading import Thread
-from app import app  # Import the Flask app
+
+logger = logging.getLogger(__name__)
 
 def run_flask():
-    """Run the Flask application."""
+    """Run the Flask application; in webhook mode importing it starts the bot."""
+    from web import app
     app.run(host='0.0.0.0', port=5000)
 
 def main():
-    """Main entry point for the application."""
+    """
+    Run the web app and the bot in one process, for local development.
+
+    Deployments run the two roles separately, with ``gunicorn web:app`` and
+    ``python worker.py``, so neither loads what only the other needs.
+    """
+    if os.environ.get('RENDER') == 'true':
+        # Older deploy configs still start the worker as python main.py
+        from worker import main as worker_main
+        worker_main()
+        return
+
     if not TELEGRAM_TOKEN:
         logger.error("TELEGRAM_TOKEN not set. Please set it in environment variables.")
         return
 
-    # In deployment, the web service will handle the Flask app separately
-    # Only start the Flask server in a thread when running in standalone mode
-    import os
-    if os.environ.get('RENDER') != 'true':
-        # Start Flask server in a separate thread for local development
-        flask_thread = Thread(target=run_flask, daemon=True)
-        flask_thread.start()
-        logger.info("Flask server started")
-
-    logger.info("Starting Text-to-Speech Bot...")
-    while True:  # Continuous operation loop
-        try:
-            run_bot()
-        except KeyboardInterrupt:
-            logger.info("Bot stopped by user")
-            break
-        except Exception as e:
-            logger.error(f"Unexpected error in main loop: {str(e)}")
-            logger.info("Restarting bot in 10 seconds...")
-            time.sleep(10)
+    if BOT_MODE == 'webhook':
+        # Updates are pushed to the Flask app, which runs the bot itself
+        logger.info("Starting Text-to-Speech Bot in webhook mode...")
+        run_flask()
+        return
+
+    # Start Flask server in a separate thread for local development
+    flask_thread = Thread(target=run_flask, daemon=True)
+    flask_thread.start()
+    logger.info("Flask server started")
+
+    from worker import run
+    run()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
+elif __name__ == 'main':
+    # Older deploy configs still start the web service as main:app
+    from web import app  # noqa: F401
@@ -0,0 +1,305 @@
+import bisect
+import os
+import socket
+import threading
+import time
+from operator import itemgetter
+from typing import Optional
+
+# Default latency buckets in seconds, from 5ms to 2 minutes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _value_lines(name: str, labelnames: tuple, series: list) -> list:
+    return [f"{name}{_format_labels(labelnames, key)} {value}" for key, value in series]
+
+
+def _histogram_lines(name: str, labelnames: tuple, buckets: tuple, series: list) -> list:
+    lines = []
+    for key, counts in series:
+        cumulative = 0
+        for bound, count in zip(buckets, counts):
+            cumulative += count
+            le = _format_labels(labelnames, key, f'le="{bound}"')
+            lines.append(f"{name}_bucket{le} {cumulative}")
+        cumulative += counts[len(buckets)]
+        le = _format_labels(labelnames, key, 'le="+Inf"')
+        lines.append(f"{name}_bucket{le} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, key)} {counts[-1]}")
+        lines.append(f"{name}_count{_format_labels(labelnames, key)} {cumulative}")
+    return lines
+
+
+class _Metric:
+    """Base class for metrics kept in the process-wide registry."""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # itemgetter returns a bare value for one name and a tuple for several
+        if len(self.labelnames) == 1:
+            name = self.labelnames[0]
+            self._key = lambda labels: (labels[name],)
+        elif self.labelnames:
+            self._key = itemgetter(*self.labelnames)
+        else:
+            self._key = lambda labels: ()
+        _registry.append(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list:
+        return _value_lines(self.name, self.labelnames, self._series())
+
+    def _series(self) -> list:
+        """Return (label values, value) pairs."""
+        raise NotImplementedError
+
+    def snapshot(self) -> dict:
+        """Return the metric's description and current values in a JSON-serializable form."""
+        return {
+            'help': self.documentation,
+            'kind': self.kind,
+            'labels': list(self.labelnames),
+            'series': [[list(key), value] for key, value in self._series()],
+        }
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, optionally split by labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _series(self) -> list:
+        with self._lock:
+            return list(self._values.items())
+
+
+class Gauge(_Metric):
+    """
+    Point-in-time value read from a callback at scrape time.
+
+    The callback returns either a number or, for labelled gauges, a dict of
+    label-value tuples to numbers. Nothing is recorded on the hot path.
+    """
+
+    def __init__(self, name: str, documentation: str, callback, labelnames: tuple = (), kind: str = 'gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self._callback = callback
+
+    def _series(self) -> list:
+        try:
+            values = self._callback()
+        except Exception:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return list(values.items())
+
+
+class Histogram(_Metric):
+    """Cumulative histogram with fixed bucket boundaries, optionally split by labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels) -> None:
+        self._observe(value, self._key(labels))
+
+    def _observe(self, value: float, key: tuple) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels) -> '_Timer':
+        """Return a context manager that observes the duration of its ``with`` block."""
+        return _Timer(self, self._key(labels))
+
+    def counts(self, **labels) -> list:
+        """
+        Return the per-bucket observation counts, summed over every series matching ``labels``.
+
+        Args:
+            **labels: Label values to match; labels left out match any value
+
+        Returns:
+            list: Count per bucket, the last entry for observations above every bound
+        """
+        positions = [(self.labelnames.index(name), value) for name, value in labels.items()]
+        total = [0] * (len(self.buckets) + 1)
+        with self._lock:
+            for key, counts in self._values.items():
+                if all(key[index] == value for index, value in positions):
+                    for i in range(len(total)):
+                        total[i] += counts[i]
+        return total
+
+    def _series(self) -> list:
+        with self._lock:
+            return [(key, list(counts)) for key, counts in self._values.items()]
+
+    def _samples(self) -> list:
+        return _histogram_lines(self.name, self.labelnames, self.buckets, self._series())
+
+    def snapshot(self) -> dict:
+        snapshot = super().snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+
+def bucket_quantile(buckets: tuple, counts: list, q: float) -> Optional[float]:
+    """
+    Estimate a quantile from histogram bucket counts, as Prometheus's histogram_quantile does.
+
+    The value is interpolated linearly within the bucket holding the quantile;
+    observations above the last bound are reported as that bound.
+
+    Args:
+        buckets (tuple): Upper bounds of the buckets
+        counts (list): Count per bucket, as returned by :meth:`Histogram.counts`
+        q (float): Quantile between 0 and 1
+
+    Returns:
+        Optional[float]: The estimate, or None without observations
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    for index, count in enumerate(counts[:len(buckets)]):
+        if count and cumulative + count >= rank:
+            lower = buckets[index - 1] if index else 0.0
+            return lower + (buckets[index] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return buckets[-1]
+
+
+class _Timer:
+    """Context manager recording elapsed time into a histogram."""
+
+    __slots__ = ('_histogram', '_key', '_start')
+
+    def __init__(self, histogram: Histogram, key: tuple):
+        self._histogram = histogram
+        self._key = key
+
+    def __enter__(self) -> '_Timer':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._histogram._observe(time.perf_counter() - self._start, self._key)
+
+
+def process_name() -> str:
+    """Return the name this process publishes its metrics under: host:pid."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def snapshot() -> dict:
+    """
+    Return every registered metric's values in a JSON-serializable form.
+
+    Bot processes publish this with their heartbeat so that the web process,
+    which serves /metrics, can include metrics it does not record itself.
+    """
+    return {metric.name: metric.snapshot() for metric in list(_registry)}
+
+
+def render(snapshots: Optional[dict] = None) -> str:
+    """
+    Render every registered metric in the Prometheus text exposition format.
+
+    Args:
+        snapshots (dict): Optional :func:`snapshot` of other processes by
+            process name; their series are added with a ``process`` label
+
+    Returns:
+        str: The exposition text
+    """
+    families = {}
+    for metric in list(_registry):
+        families[metric.name] = metric.render()
+    for process, metrics in (snapshots or {}).items():
+        for name, data in metrics.items():
+            lines = families.setdefault(name, [f"# HELP {name} {data['help']}", f"# TYPE {name} {data['kind']}"])
+            labelnames = tuple(data['labels']) + ('process',)
+            series = [(tuple(key) + (process,), value) for key, value in data['series']]
+            if 'buckets' in data:
+                lines.extend(_histogram_lines(name, labelnames, tuple(data['buckets']), series))
+            else:
+                lines.extend(_value_lines(name, labelnames, series))
+    return '\n'.join(line for lines in families.values() for line in lines) + '\n'
+
+
+# Text-to-speech pipeline
+STAGE_SECONDS = Histogram(
+    'tts_stage_seconds',
+    'Time spent in each stage of handling a text message.',
+    ('stage', 'lang')
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    'tts_queue_wait_seconds',
+    'Time text messages waited in the scheduler before a worker picked them up.',
+    ('lang',)
+)
+TEXT_LENGTH_CHARS = Histogram(
+    'tts_text_length_chars',
+    'Length of text messages received for conversion.',
+    buckets=(10, 50, 100, 250, 500, 1000, 2000, 5000, 10000, 25000, 50000, 100000)
+)
+ERRORS = Counter(
+    'tts_errors_total',
+    'Errors while handling updates, by exception type.',
+    ('type',)
+)
+
+# Broadcasts
+BROADCAST_MESSAGES = Counter(
+    'broadcast_messages_total',
+    'Broadcast messages attempted, by result.',
+    ('result',)
+)
+BROADCAST_RETRY_AFTER = Counter(
+    'broadcast_retry_after_total',
+    'Flood-control responses received while broadcasting.'
+)
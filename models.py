@@ -1,8 +1,115 @@
 from app import db
+from config import DEFAULT_LANG
 
 class BotStatus(db.Model):
-    """Model to track bot status and uptime."""
+    """Model to track bot status and uptime: one row per minute, rolled up into hours and days as it ages."""
+    # A new table: the original bot_status was never written and lacks the columns below
+    __tablename__ = 'bot_status_history'
+    __table_args__ = (db.Index('ix_bot_status_history_resolution_timestamp', 'resolution', 'timestamp'),)
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, nullable=False)
-    status = db.Column(db.String(20), nullable=False)  # 'healthy' or 'unhealthy'
-    last_health_check = db.Column(db.DateTime, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)  # start of the minute, hour or day
+    resolution = db.Column(db.String(10), nullable=False, default='minute')  # 'minute', 'hour' or 'day'
+    status = db.Column(db.String(20), nullable=False)  # 'healthy' or 'unhealthy'; unhealthy if any sample was
+    last_health_check = db.Column(db.DateTime, nullable=False)  # time of the last sample in the bucket
+    samples = db.Column(db.Integer, nullable=False, default=1)
+    healthy_samples = db.Column(db.Integer, nullable=False, default=0)
+    updates_per_second = db.Column(db.Float, nullable=False, default=0.0)
+    synthesis_p50 = db.Column(db.Float, nullable=True)  # seconds; None without synthesis in the bucket
+    synthesis_p95 = db.Column(db.Float, nullable=True)  # rollups keep the worst minute's value
+    synthesis_p99 = db.Column(db.Float, nullable=True)
+    queue_depth = db.Column(db.Integer, nullable=False, default=0)  # rollups keep the maximum
+
+
+class BroadcastJob(db.Model):
+    """Model to persist admin broadcasts so they resume after a restart."""
+    id = db.Column(db.Integer, primary_key=True)
+    admin_chat_id = db.Column(db.BigInteger, nullable=False)
+    progress_message_id = db.Column(db.BigInteger, nullable=True)
+    message = db.Column(db.Text, nullable=False)
+    total = db.Column(db.Integer, nullable=False)  # active users when the job was created
+    cursor = db.Column(db.BigInteger, nullable=False, default=0)  # last user id processed
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    success_count = db.Column(db.Integer, nullable=False, default=0)
+    failure_count = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending', 'running' or 'done'
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+
+class User(db.Model):
+    """Model to persist user preferences and the broadcast audience."""
+    __tablename__ = 'users'
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)  # Telegram user id
+    language = db.Column(db.String(10), nullable=False, default=DEFAULT_LANG)
+    active = db.Column(db.Boolean, nullable=False, default=True)  # False once a broadcast cannot reach them
+    last_seen = db.Column(db.DateTime, nullable=False)
+
+
+class LanguageChange(db.Model):
+    """Model logging language changes, so every process can update its in-memory copy of the users' languages."""
+    __tablename__ = 'language_changes'
+    # Ids must keep growing after old rows are deleted, or readers would skip new ones
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)  # processes read the rows after the last id they have seen
+    user_id = db.Column(db.BigInteger, nullable=False)
+    language = db.Column(db.String(10), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)  # rows are deleted after an hour
+
+
+class Heartbeat(db.Model):
+    """Model holding the latest liveness data published by the bot process, one row per mode."""
+    mode = db.Column(db.String(20), primary_key=True)  # 'polling' or 'webhook'
+    updated_at = db.Column(db.DateTime, nullable=False)
+    last_poll_at = db.Column(db.DateTime, nullable=True)  # last completed getUpdates call (polling only)
+    last_update_id = db.Column(db.BigInteger, nullable=True)
+    last_update_at = db.Column(db.DateTime, nullable=True)
+    update_lag_seconds = db.Column(db.Float, nullable=True)  # receive time minus message date of the last update
+    queue_depth = db.Column(db.Integer, nullable=False, default=0)
+    in_flight = db.Column(db.Integer, nullable=False, default=0)  # synthesis calls currently running
+
+
+class MetricsSnapshot(db.Model):
+    """Model holding the latest metrics published by each bot process, served by the web process's /metrics."""
+    __tablename__ = 'metrics_snapshots'
+    process = db.Column(db.String(128), primary_key=True)  # host:pid
+    updated_at = db.Column(db.DateTime, nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # metrics.snapshot() as JSON
+
+
+class Lease(db.Model):
+    """Model naming the one process that performs a duty, such as recording the status history."""
+    __tablename__ = 'leases'
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(128), nullable=False)  # host:pid
+    expires_at = db.Column(db.DateTime, nullable=False)  # another process may take it over after this
+
+
+class TTSJob(db.Model):
+    """Model to persist accepted text-to-speech requests until they are answered."""
+    __tablename__ = 'tts_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    update_id = db.Column(db.BigInteger, nullable=False, unique=True)  # redelivered updates map to the same job
+    user_id = db.Column(db.BigInteger, nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # the update as JSON, cleared once the job is finished
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending', 'running', 'done', 'rejected' or 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    lease_until = db.Column(db.DateTime, nullable=True)  # a running job not finished by then is run again
+    owner = db.Column(db.String(128), nullable=True)  # host:pid of the process running it
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+
+class WebhookUpdate(db.Model):
+    """Model holding webhook updates from the moment they are acknowledged until their handlers have run."""
+    __tablename__ = 'webhook_updates'
+    update_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    payload = db.Column(db.Text, nullable=False)  # the update as Telegram sent it
+    owner = db.Column(db.String(128), nullable=False)  # host:pid of the process handling it
+    lease_until = db.Column(db.DateTime, nullable=False)  # renewed by the owner; another process takes it over after
+
+
+class UpdateOffset(db.Model):
+    """Model holding the newest update the polling bot has fully accepted."""
+    mode = db.Column(db.String(20), primary_key=True)
+    update_id = db.Column(db.BigInteger, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,141 @@
+import functools
+import logging
+import math
+import threading
+import time
+from telegram import Update
+from telegram.ext import CallbackContext
+from config import (
+    ADMIN_IDS,
+    RATE_LIMIT_CAPACITY,
+    RATE_LIMIT_REFILL_PER_SECOND,
+    RATE_LIMITED
+)
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+
+class CharacterRateLimiter:
+    """
+    Per-user token bucket charged by character count.
+
+    Every user starts with a full bucket of ``capacity`` characters that
+    refills at ``refill_per_second``. A message is accepted when the bucket
+    holds at least its cost (capped at ``capacity`` so long messages are
+    still possible) and may drive the bucket negative, which makes a heavy
+    user wait proportionally longer for the next one. Buckets that have
+    refilled completely carry no information and are swept, so memory stays
+    proportional to the number of recently active users.
+    """
+
+    def __init__(self, capacity: int = RATE_LIMIT_CAPACITY,
+                 refill_per_second: float = RATE_LIMIT_REFILL_PER_SECOND,
+                 exempt=ADMIN_IDS, clock=time.monotonic):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.exempt = frozenset(exempt)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}  # user_id -> (tokens, updated_at)
+        self._sweep_interval = capacity / refill_per_second
+        self._next_sweep = clock() + self._sweep_interval
+        self._stats = {'allowed': 0, 'throttled': 0, 'refunded': 0, 'swept': 0}
+
+    def _level(self, bucket, now: float) -> float:
+        tokens, updated_at = bucket
+        return min(self.capacity, tokens + (now - updated_at) * self.refill_per_second)
+
+    def consume(self, user_id, cost: int) -> float:
+        """
+        Charge ``cost`` characters to ``user_id``.
+
+        Args:
+            user_id: Telegram user id
+            cost (int): Number of characters in the message
+
+        Returns:
+            float: 0.0 if the message is allowed, otherwise seconds until it would be
+        """
+        if user_id in self.exempt:
+            return 0.0
+        with self._lock:
+            now = self._clock()
+            bucket = self._buckets.get(user_id)
+            tokens = self.capacity if bucket is None else self._level(bucket, now)
+            needed = min(cost, self.capacity)
+            if tokens < needed:
+                self._stats['throttled'] += 1
+                return (needed - tokens) / self.refill_per_second
+            self._buckets[user_id] = (tokens - cost, now)
+            self._stats['allowed'] += 1
+            if now >= self._next_sweep:
+                self._sweep(now)
+            return 0.0
+
+    def refund(self, user_id, cost: int) -> None:
+        """
+        Give back ``cost`` characters charged by :meth:`consume` for a message that was not processed.
+
+        Args:
+            user_id: Telegram user id
+            cost (int): Number of characters charged
+        """
+        if user_id in self.exempt:
+            return
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                return  # Already refilled and swept
+            now = self._clock()
+            self._buckets[user_id] = (min(self.capacity, self._level(bucket, now) + cost), now)
+            self._stats['refunded'] += 1
+
+    def _sweep(self, now: float) -> None:
+        """Drop buckets that have refilled to capacity. Called with the lock held."""
+        full = [user_id for user_id, bucket in self._buckets.items()
+                if self._level(bucket, now) >= self.capacity]
+        for user_id in full:
+            del self._buckets[user_id]
+        self._stats['swept'] += len(full)
+        self._next_sweep = now + self._sweep_interval
+
+    def stats(self) -> dict:
+        """Return allow/throttle counters and the number of tracked users."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['tracked_users'] = len(self._buckets)
+        return stats
+
+
+# Shared limiter for text-to-speech requests
+rate_limiter = CharacterRateLimiter()
+
+Gauge('rate_limiter_requests_total', 'Text messages checked by the rate limiter, by outcome.',
+      lambda: {(outcome,): rate_limiter.stats()[outcome] for outcome in ('allowed', 'throttled')},
+      labelnames=('outcome',), kind='counter')
+
+
+def rate_limited(handler):
+    """
+    Wrap a text handler so users over their character budget are told when to retry.
+
+    If the wrapped handler returns False (``durable`` does for duplicate
+    deliveries and updates the scheduler turned away) the characters are
+    refunded, so only processed messages use up the budget.
+    """
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext) -> None:
+        message = update.effective_message
+        charged = None
+        if update.effective_user and message and message.text:
+            user_id = update.effective_user.id
+            retry_after = rate_limiter.consume(user_id, len(message.text))
+            if retry_after > 0:
+                logger.info("Rate limited user %s for %.1fs", user_id, retry_after)
+                message.reply_text(RATE_LIMITED.format(math.ceil(retry_after)))
+                return
+            charged = user_id
+        if handler(update, context) is False and charged is not None:
+            rate_limiter.refund(charged, len(message.text))
+    return wrapper
@@ -0,0 +1,311 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterator, Optional
+import requests
+from config import (
+    TTS_RETRIES,
+    TTS_RETRY_BASE_DELAY,
+    TTS_RETRY_MAX_DELAY,
+    TTS_HEDGE_QUANTILE,
+    TTS_HEDGE_MIN_DELAY,
+    TTS_HEDGE_MAX_IN_FLIGHT,
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_RESET_SECONDS
+)
+from engines import TTSEngine, time_left
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+HEDGES = Counter(
+    'tts_hedged_requests_total',
+    'Hedged duplicate synthesis requests, by whether they were fired or won.',
+    ('engine', 'result')
+)
+RETRIES = Counter(
+    'tts_retries_total',
+    'Synthesis attempts retried after a transient error.',
+    ('engine',)
+)
+BREAKER_REJECTIONS = Counter(
+    'tts_breaker_rejections_total',
+    'Synthesis calls failed fast because the circuit breaker was open.',
+    ('engine',)
+)
+
+# HTTP statuses worth retrying: throttling and upstream trouble
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that the circuit breaker considers unhealthy."""
+
+
+def is_transient(error: Exception) -> bool:
+    """Return True for errors a later attempt may not hit: throttling, 5xx and network failures."""
+    from gtts import gTTSError
+    if isinstance(error, gTTSError):
+        response = getattr(error, 'rsp', None)
+        return response is None or response.status_code in TRANSIENT_STATUSES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, TimeoutError, ConnectionError))
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Return the delay requested by a Retry-After header on the error's response, if any."""
+    response = getattr(error, 'rsp', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class CircuitBreaker:
+    """
+    Stop calling an upstream after repeated failures and probe it for recovery.
+
+    ``failure_threshold`` consecutive failures open the circuit, and calls
+    are rejected for ``reset_timeout`` seconds. After that a single probe is
+    let through (half-open): its success closes the circuit again, its
+    failure re-opens it for another ``reset_timeout``.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_SECONDS, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        """'closed', 'open' or 'half_open'."""
+        with self._lock:
+            if self._state == 'open' and self._clock() - self._opened_at >= self.reset_timeout:
+                return 'half_open'
+            return self._state
+
+    def allow(self) -> bool:
+        """Return True if a call may go ahead; in half-open state only one probe at a time does."""
+        with self._lock:
+            if self._state == 'closed':
+                return True
+            if self._clock() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != 'closed':
+                logger.info("Circuit breaker closed, upstream recovered")
+            self._state = 'closed'
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._state == 'closed':
+                    logger.warning("Circuit breaker opened after %s consecutive failures", self._failures)
+                self._state = 'open'
+                self._opened_at = self._clock()
+                self._probing = False
+
+    def release_probe(self) -> None:
+        """Give up a probe slot without an outcome, e.g. when the call failed for a non-upstream reason."""
+        with self._lock:
+            self._probing = False
+
+
+class LatencyTracker:
+    """Rolling window of recent successful call latencies."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.min_samples = min_samples
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the q-quantile of the window, or None until enough samples exist."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class ResilientEngine(TTSEngine):
+    """
+    Wrap a remote engine with hedging, jittered retries and a circuit breaker.
+
+    Each attempt starts one stream; if its first part has not arrived after
+    the recent p95 time to first part, a duplicate is started and whichever
+    produces audio first wins, the other being closed. Transient errors
+    (429, 5xx, network) before the first part are retried with full-jitter
+    exponential backoff, honouring Retry-After. Once audio flows it is
+    passed through as it arrives, so a failure after that point is raised
+    rather than retried. This is the only retry layer for the engine chain:
+    chunk-level retries are skipped when it is present. Calls that still
+    fail transiently after their retries count once each towards the
+    circuit breaker; enough consecutive ones open it, after which calls fail
+    immediately with CircuitOpenError, letting a FallbackEngine switch to
+    the next engine, until a probe succeeds. No retry or hedge is started
+    once a FallbackEngine's deadline for the call has passed.
+    """
+
+    def __init__(self, engine: TTSEngine, retries: int = TTS_RETRIES,
+                 hedge_quantile: Optional[float] = TTS_HEDGE_QUANTILE,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.engine = engine
+        self.name = engine.name
+        self.format = engine.format
+        self.remote = engine.remote
+        self.retries = retries
+        self.hedge_quantile = hedge_quantile
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        self._hedges_in_flight = 0
+        self._hedge_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix=f'tts-{engine.name}')
+
+    def available(self) -> bool:
+        return self.engine.available()
+
+    def supports(self, lang: str) -> bool:
+        return self.engine.supports(lang)
+
+    def stream(self, text: str, lang: str) -> Iterator[bytes]:
+        if not self.breaker.allow():
+            BREAKER_REJECTIONS.inc(engine=self.name)
+            raise CircuitOpenError(f"{self.name} circuit is open, not calling upstream")
+        # One breaker outcome per call, whatever its retries and hedges did;
+        # None when the upstream is not to blame or the caller stopped reading
+        healthy = None
+        try:
+            first, parts = self._first_part(text, lang)
+            try:
+                if first:
+                    yield first
+                yield from parts
+            finally:
+                parts.close()
+            healthy = True
+        except Exception as e:
+            if is_transient(e):
+                healthy = False
+            raise
+        finally:
+            if healthy is True:
+                self.breaker.record_success()
+            elif healthy is False:
+                self.breaker.record_failure()
+            else:
+                self.breaker.release_probe()
+
+    def _first_part(self, text: str, lang: str) -> tuple:
+        """Start the stream, retrying transient errors until its first part arrives. Returns (first part, rest)."""
+        for attempt in range(self.retries + 1):
+            try:
+                return self._hedged(text, lang)
+            except Exception as e:
+                # Other calls may have opened the breaker meanwhile; stop adding load then
+                if not is_transient(e) or attempt == self.retries or self.breaker.state == 'open':
+                    raise
+                delay = random.uniform(0, min(TTS_RETRY_MAX_DELAY, TTS_RETRY_BASE_DELAY * 2 ** attempt))
+                delay = max(delay, min(retry_after(e) or 0, TTS_RETRY_MAX_DELAY))
+                left = time_left()
+                if left is not None and left <= delay:
+                    raise  # the caller has fallen back by the time the retry would start
+                logger.warning("Transient %s error (attempt %s), retrying in %.2fs: %s",
+                               self.name, attempt + 1, delay, e)
+                RETRIES.inc(engine=self.name)
+                time.sleep(delay)
+
+    def _open(self, text: str, lang: str) -> tuple:
+        """Start a stream and wait for its first part. Returns (first part, rest of the stream)."""
+        start = time.perf_counter()
+        parts = self.engine.stream(text, lang)
+        first = next(parts, b'')
+        self.latency.add(time.perf_counter() - start)
+        return first, parts
+
+    def _hedge_open(self, text: str, lang: str) -> tuple:
+        try:
+            return self._open(text, lang)
+        finally:
+            with self._hedge_lock:
+                self._hedges_in_flight -= 1
+
+    def _hedge_delay(self) -> Optional[float]:
+        if self.hedge_quantile is None:
+            return None
+        quantile = self.latency.quantile(self.hedge_quantile)
+        return None if quantile is None else max(TTS_HEDGE_MIN_DELAY, quantile)
+
+    def _hedged(self, text: str, lang: str) -> tuple:
+        # Attempts run in this call's context, so they see a FallbackEngine's deadline
+        primary = self._executor.submit(contextvars.copy_context().run, self._open, text, lang)
+        pending = {primary}
+        delay = self._hedge_delay()
+        left = time_left()
+        if delay is not None and left is not None and left <= delay:
+            delay = None
+        if delay is not None and not wait(pending, timeout=delay).done:
+            with self._hedge_lock:
+                # Hedges are capped so a slow upstream does not get twice the load
+                fire = self._hedges_in_flight < TTS_HEDGE_MAX_IN_FLIGHT
+                if fire:
+                    self._hedges_in_flight += 1
+            if fire:
+                HEDGES.inc(engine=self.name, result='fired')
+                pending.add(self._executor.submit(contextvars.copy_context().run, self._hedge_open, text, lang))
+
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            started = [future for future in done if future.exception() is None]
+            if started:
+                winner = primary if primary in started else started[0]
+                if winner is not primary:
+                    HEDGES.inc(engine=self.name, result='won')
+                # The losing stream, if any, is closed as soon as it has started
+                for loser in (done | pending) - {winner}:
+                    loser.add_done_callback(_close_stream)
+                return winner.result()
+            error = error or next(iter(done)).exception()
+        raise error
+
+
+def _close_stream(future) -> None:
+    if future.exception() is None:
+        future.result()[1].close()
+
+
+def _breaker_states() -> dict:
+    # Processes that never synthesize (the web service in polling mode) have no breakers to report
+    from engines import built_engine
+    engine = built_engine()
+    if engine is None:
+        return {}
+    engines = getattr(engine, 'engines', [engine])
+    states = {'closed': 0, 'half_open': 1, 'open': 2}
+    return {(e.name,): states[e.breaker.state] for e in engines if isinstance(e, ResilientEngine)}
+
+
+Gauge('tts_breaker_state', 'Circuit breaker state per engine (0 closed, 1 half-open, 2 open).',
+      _breaker_states, labelnames=('engine',))
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from config import HANDLER_WORKERS, MAX_QUEUED_UPDATES, RUNTIME, ASYNC_MAX_CONVERSATIONS, DEFAULT_LANG
+from aioruntime import runtime
+from metrics import Gauge, QUEUE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class UserScheduler:
+    """
+    Run expensive handlers on a worker pool with per-user ordering.
+
+    Each user has a serial queue, so one user's replies are delivered in the
+    order their messages arrived while different users are processed in
+    parallel. A user's queue gives up its worker after every job so a busy
+    user cannot starve everybody else. Once ``max_queued`` jobs are waiting
+    across all users, new submissions are rejected instead of queued.
+    """
+
+    def __init__(self, workers: int = HANDLER_WORKERS, max_queued: int = MAX_QUEUED_UPDATES):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._executor = self._create_executor()
+        self._lock = threading.Lock()
+        self._queues = {}  # user_id -> deque of (enqueued_at, lang, fn, args)
+        self._depth = 0
+        self._running = 0
+        self._stats = {
+            'submitted': 0,
+            'rejected': 0,
+            'completed': 0,
+            'failed': 0,
+            'wait_total_seconds': 0.0,
+            'wait_max_seconds': 0.0,
+        }
+
+    def submit(self, user_id, fn, *args, lang: str = DEFAULT_LANG) -> bool:
+        """
+        Queue ``fn(*args)`` behind any earlier jobs for the same user.
+
+        Args:
+            user_id: Key jobs are serialized on
+            fn: Callable to run on the worker pool
+            lang (str): The user's language, labelling the job's queue wait
+
+        Returns:
+            bool: False if the global queue is full and the job was rejected
+        """
+        with self._lock:
+            if self._depth >= self.max_queued:
+                self._stats['rejected'] += 1
+                return False
+            self._depth += 1
+            self._stats['submitted'] += 1
+            user_queue = self._queues.get(user_id)
+            start = user_queue is None
+            if start:
+                user_queue = self._queues[user_id] = deque()
+            user_queue.append((time.monotonic(), lang, fn, args))
+        if start:
+            self._start_user(user_id)
+        return True
+
+    def _create_executor(self) -> Optional[ThreadPoolExecutor]:
+        """Create the pool the users' queues run on."""
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='handler')
+
+    def _start_user(self, user_id) -> None:
+        """Schedule the user's queue to run its next job."""
+        self._executor.submit(self._run_next, user_id)
+
+    def _take(self, user_id) -> tuple:
+        """Pop the user's next job and count it as running."""
+        with self._lock:
+            enqueued_at, lang, fn, args = self._queues[user_id].popleft()
+            self._depth -= 1
+            self._running += 1
+            wait = time.monotonic() - enqueued_at
+            self._stats['wait_total_seconds'] += wait
+            self._stats['wait_max_seconds'] = max(self._stats['wait_max_seconds'], wait)
+        QUEUE_WAIT_SECONDS.observe(wait, lang=lang)
+        return fn, args
+
+    def _done(self, user_id, outcome: str) -> bool:
+        """Count a finished job; return True if the user has more jobs queued."""
+        with self._lock:
+            self._running -= 1
+            self._stats[outcome] += 1
+            if self._queues[user_id]:
+                return True
+            del self._queues[user_id]
+            return False
+
+    def _run_next(self, user_id) -> None:
+        fn, args = self._take(user_id)
+        try:
+            fn(*args)
+            outcome = 'completed'
+        except Exception as e:
+            logger.error("Scheduled job for user %s failed: %s", user_id, e)
+            outcome = 'failed'
+        if self._done(user_id, outcome):
+            # Go to the back of the pool's queue so other users get a turn
+            self._start_user(user_id)
+
+    def stats(self) -> dict:
+        """Return queue depth, running jobs and wait-time counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            started = stats['completed'] + stats['failed'] + self._running
+            stats.update({
+                'queue_depth': self._depth,
+                'running': self._running,
+                'active_users': len(self._queues),
+                'wait_avg_seconds': stats['wait_total_seconds'] / started if started else 0.0,
+            })
+        return stats
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Wait for every queued and running job to finish.
+
+        Args:
+            timeout (float): Seconds to wait at most
+
+        Returns:
+            bool: True if the scheduler went idle, False if the timeout expired first
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                idle = not self._depth and not self._running
+            if idle:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop accepting work and optionally wait for queued jobs to finish."""
+        self._executor.shutdown(wait=wait)
+
+
+class AsyncUserScheduler(UserScheduler):
+    """
+    UserScheduler that runs each user's queue as a coroutine on the asyncio runtime.
+
+    Jobs that are coroutine functions run on the event loop and only hand
+    their blocking calls to the runtime's blocking pool; plain functions run on
+    that pool. At most ``max_conversations`` jobs run at once, and a user
+    gives up its slot after every job, so waiting users take turns in order.
+    """
+
+    def __init__(self, max_conversations: int = ASYNC_MAX_CONVERSATIONS, max_queued: int = MAX_QUEUED_UPDATES):
+        super().__init__(workers=max_conversations, max_queued=max_queued)
+        self._slots = None  # created on the loop
+
+    def _create_executor(self) -> None:
+        # Queues run as tasks on the event loop; blocking calls use the runtime's own pool
+        return None
+
+    def _start_user(self, user_id) -> None:
+        runtime.spawn(self._serve, user_id)
+
+    async def _serve(self, user_id) -> None:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        more = True
+        while more:
+            async with self._slots:
+                fn, args = self._take(user_id)
+                try:
+                    if asyncio.iscoroutinefunction(fn):
+                        await fn(*args)
+                    else:
+                        await runtime.blocking(fn, *args)
+                    outcome = 'completed'
+                except Exception as e:
+                    logger.error("Scheduled job for user %s failed: %s", user_id, e)
+                    outcome = 'failed'
+            more = self._done(user_id, outcome)
+
+    def shutdown(self, wait: bool = True) -> None:
+        if wait:
+            self.drain(float('inf'))
+        runtime.stop()
+
+
+# Shared scheduler for the expensive handlers
+scheduler = AsyncUserScheduler() if RUNTIME == 'asyncio' else UserScheduler()
+
+Gauge('scheduler_queue_depth', 'Jobs waiting for a handler worker.',
+      lambda: scheduler.stats()['queue_depth'])
+Gauge('scheduler_running', 'Jobs currently running on handler workers.',
+      lambda: scheduler.stats()['running'])
+Gauge('scheduler_jobs_total', 'Scheduler jobs by outcome.',
+      lambda: {(outcome,): scheduler.stats()[outcome] for outcome in ('submitted', 'rejected', 'completed', 'failed')},
+      labelnames=('outcome',), kind='counter')
+
@@ -0,0 +1,342 @@
+import atexit
+import hashlib
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+from typing import Optional
+from config import SEGMENT_CACHE_MAX_BYTES, SEGMENT_CACHE_PATH
+from cache import normalize_text
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+# Hits whose last-used time is only kept in memory until the next write
+_TOUCH_BATCH = 100
+
+
+class SpliceError(ValueError):
+    """Raised when audio clips cannot be joined into one."""
+
+
+def segment_key(sentence: str, lang: str, voice: str) -> bytes:
+    """
+    Build the store key for one sentence spoken by ``voice`` in ``lang``.
+
+    Args:
+        sentence (str): Sentence text
+        lang (str): Language code
+        voice (str): Engine chain that produced the audio, so a config change does not reuse old audio
+
+    Returns:
+        bytes: 16-byte digest identifying the segment
+    """
+    payload = f"{voice}\x00{lang}\x00{normalize_text(sentence)}".encode('utf-8')
+    return hashlib.sha256(payload).digest()[:16]
+
+
+def _wav_parts(data: bytes) -> tuple[bytes, memoryview]:
+    """Return the fmt chunk body and the sample data of a RIFF/WAVE file."""
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise SpliceError("Not a WAV file")
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack_from('<4sI', data, offset)
+        body = offset + 8
+        if chunk_id == b'fmt ':
+            fmt = data[body:body + size]
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise SpliceError("WAV data chunk before fmt chunk")
+            # Streamed WAVs (espeak --stdout) declare a placeholder size; the data runs to the end
+            return fmt, memoryview(data)[body:min(body + size, len(data))]
+        offset = body + size + (size & 1)
+    raise SpliceError("WAV file has no data chunk")
+
+
+def _strip_id3(data: bytes) -> memoryview:
+    """Drop a leading ID3v2 tag so only MPEG frames remain."""
+    view = memoryview(data)
+    if data[:3] == b'ID3' and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        return view[10 + size:]
+    return view
+
+
+def splice(audio_format: str, parts: list) -> bytes:
+    """
+    Join audio clips of one format into a single clip.
+
+    MP3 is a sequence of self-contained frames, so clips are concatenated
+    (without the ID3 tags of all but the first). WAV clips must share their
+    sample format; their samples are joined under one new header.
+
+    Args:
+        audio_format (str): 'mp3' or 'wav'
+        parts (list): Complete audio files, in playing order
+
+    Returns:
+        bytes: The joined audio file
+
+    Raises:
+        SpliceError: If the format cannot be spliced or the clips do not match
+    """
+    if len(parts) == 1:
+        return parts[0]
+    if audio_format == 'mp3':
+        return b''.join([parts[0]] + [_strip_id3(part) for part in parts[1:]])
+    if audio_format == 'wav':
+        fmt = None
+        samples = []
+        for part in parts:
+            part_fmt, data = _wav_parts(part)
+            if fmt is not None and part_fmt != fmt:
+                raise SpliceError("WAV segments have different sample formats")
+            fmt = part_fmt
+            samples.append(data)
+        data_size = sum(len(data) for data in samples)
+        header = struct.pack('<4sI4s4sI', b'RIFF', 4 + 8 + len(fmt) + 8 + data_size, b'WAVE', b'fmt ', len(fmt))
+        return b''.join([header, fmt, struct.pack('<4sI', b'data', data_size)] + samples)
+    raise SpliceError(f"Cannot splice {audio_format} audio")
+
+
+class Splicer:
+    """
+    Splice clips of one format into a file object as they become available.
+
+    MP3 clips are written as soon as they are added, so the start of the
+    speech can be sent on (e.g. to the voice encoder) while later sentences
+    are still being synthesized. A WAV header carries the total size, so
+    WAV clips are held and written by :meth:`close`.
+
+    Args:
+        fp: Writable file object
+        audio_format (str): 'mp3' or 'wav'
+
+    Raises:
+        SpliceError: If the format cannot be spliced
+    """
+
+    def __init__(self, fp, audio_format: str):
+        if audio_format not in ('mp3', 'wav'):
+            raise SpliceError(f"Cannot splice {audio_format} audio")
+        self.format = audio_format
+        self._fp = fp
+        self._parts = []
+        self._count = 0
+
+    def add(self, clip: bytes) -> None:
+        """Append the next clip in playing order."""
+        if self.format == 'mp3':
+            self._fp.write(clip if not self._count else _strip_id3(clip))
+        else:
+            self._parts.append(clip)
+        self._count += 1
+
+    def close(self) -> None:
+        """Write whatever is still held."""
+        if self._parts:
+            self._fp.write(splice(self.format, self._parts))
+            self._parts = []
+
+
+class SegmentStore:
+    """
+    Persistent, size-bounded LRU store of synthesized sentences.
+
+    Segments live in a SQLite file under TEMP_DIR, keyed by a 16-byte digest
+    of the sentence, language and engine chain, with an index on last use
+    for eviction. The file survives restarts. Hits only update the last-used
+    time in memory; the times are written in batches with the next insert.
+    """
+
+    def __init__(self, path: str = SEGMENT_CACHE_PATH, max_bytes: int = SEGMENT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._bytes = 0
+        self._entries = 0
+        self._touched = {}  # key -> last used
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'bytes_saved': 0,
+            'evictions': 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the store on first use. Called with the lock held."""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', mode=0o755, exist_ok=True)
+            conn = self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            try:
+                conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS segments ('
+                    'key BLOB PRIMARY KEY, format TEXT NOT NULL, audio BLOB NOT NULL, '
+                    'size INTEGER NOT NULL, last_used REAL NOT NULL)'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS segments_last_used ON segments (last_used)')
+                conn.execute('BEGIN')
+                entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM segments').fetchone()
+                # The limit may have been lowered since the last run
+                evicted, freed = self._evict(size)
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                self._conn = None
+                conn.close()
+                raise
+            self._applied_eviction(entries, size, evicted, freed)
+            logger.info("Segment cache loaded %d segments (%d bytes) from %s", self._entries, self._bytes, self.path)
+        return self._conn
+
+    def get(self, key: bytes) -> Optional[tuple[str, bytes]]:
+        """
+        Look up a segment.
+
+        Args:
+            key (bytes): Key from :func:`segment_key`
+
+        Returns:
+            Optional[tuple[str, bytes]]: (format, audio), or None on a miss
+        """
+        with self._lock:
+            try:
+                row = self._connect().execute('SELECT format, audio FROM segments WHERE key = ?', (key,)).fetchone()
+            except (sqlite3.Error, OSError) as e:
+                logger.warning("Segment cache lookup failed: %s", e)
+                row = None
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            self._stats['bytes_saved'] += len(row[1])
+            self._touched[key] = time.time()
+            if len(self._touched) >= _TOUCH_BATCH:
+                try:
+                    self._flush_touched()
+                except sqlite3.Error as e:
+                    logger.warning("Failed to record segment use: %s", e)
+            return row[0], row[1]
+
+    def put(self, key: bytes, audio_format: str, audio: bytes) -> None:
+        """
+        Store a freshly synthesized segment, evicting the least recently used ones beyond ``max_bytes``.
+
+        Args:
+            key (bytes): Key from :func:`segment_key`
+            audio_format (str): Format of ``audio``, e.g. 'mp3'
+            audio (bytes): Complete audio file of the sentence
+        """
+        if len(audio) > self.max_bytes:
+            return
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute('BEGIN')
+                self._flush_touched()
+                previous = conn.execute('SELECT size FROM segments WHERE key = ?', (key,)).fetchone()
+                conn.execute(
+                    'INSERT OR REPLACE INTO segments (key, format, audio, size, last_used) VALUES (?, ?, ?, ?, ?)',
+                    (key, audio_format, audio, len(audio), time.time())
+                )
+                entries = self._entries + (previous is None)
+                size = self._bytes + len(audio) - (previous[0] if previous else 0)
+                evicted, freed = self._evict(size)
+                conn.execute('COMMIT')
+            except (sqlite3.Error, OSError) as e:
+                logger.warning("Failed to store segment: %s", e)
+                if self._conn is not None and self._conn.in_transaction:
+                    self._conn.execute('ROLLBACK')
+                return
+            self._applied_eviction(entries, size, evicted, freed)
+
+    def _flush_touched(self) -> None:
+        """Write batched last-used times. Called with the lock held."""
+        if self._touched:
+            self._conn.executemany('UPDATE segments SET last_used = ? WHERE key = ?',
+                                   [(used, key) for key, used in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self, size: int) -> tuple[int, int]:
+        """
+        Delete least recently used segments while the store holds more than ``max_bytes``.
+
+        Called with the lock held, inside the caller's transaction.
+
+        Returns:
+            tuple[int, int]: (segments deleted, bytes freed)
+        """
+        if size <= self.max_bytes:
+            return 0, 0
+        self._flush_touched()
+        # Evict down to 90% so a full store does not evict on every insert
+        target = self.max_bytes * 0.9
+        evicted = []
+        freed = 0
+        for key, segment_size in self._conn.execute('SELECT key, size FROM segments ORDER BY last_used'):
+            if size - freed <= target:
+                break
+            evicted.append((key,))
+            freed += segment_size
+        self._conn.executemany('DELETE FROM segments WHERE key = ?', evicted)
+        return len(evicted), freed
+
+    def _applied_eviction(self, entries: int, size: int, evicted: int, freed: int) -> None:
+        """Record the store's committed size and return evicted pages to the filesystem."""
+        self._entries = entries - evicted
+        self._bytes = size - freed
+        if evicted:
+            self._stats['evictions'] += evicted
+            logger.debug("Evicted %d segments (%d bytes) from the segment cache", evicted, freed)
+            try:
+                self._conn.execute('PRAGMA incremental_vacuum')
+            except sqlite3.Error as e:
+                logger.warning("Failed to vacuum the segment cache: %s", e)
+
+    def close(self) -> None:
+        """Write pending last-used times and close the file."""
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._flush_touched()
+                except sqlite3.Error as e:
+                    logger.warning("Failed to record segment use: %s", e)
+                finally:
+                    self._conn.close()
+                    self._conn = None
+
+    def stats(self) -> dict:
+        """Return hit/miss counters, the hit ratio, bytes saved and the store's size."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'hit_ratio': round(stats['hits'] / max(stats['hits'] + stats['misses'], 1), 4),
+                'entries': self._entries,
+                'bytes': self._bytes,
+            })
+        return stats
+
+
+# Shared segment store used by speech synthesis
+segment_store = SegmentStore()
+atexit.register(segment_store.close)
+
+
+def _segment_counters() -> dict:
+    stats = segment_store.stats()
+    return {(name,): stats[name] for name in ('hits', 'misses', 'evictions')}
+
+
+Gauge('segment_cache_events_total', 'Sentence segment cache lookups and evictions by outcome.',
+      _segment_counters, labelnames=('event',), kind='counter')
+Gauge('segment_cache_bytes_saved_total', 'Bytes of audio served from the segment cache instead of synthesized.',
+      lambda: segment_store.stats()['bytes_saved'], kind='counter')
+Gauge('segment_cache_bytes', 'Bytes of audio held by the segment cache.',
+      lambda: segment_store.stats()['bytes'])
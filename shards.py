@@ -0,0 +1,322 @@
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.connection import wait as wait_connections
+from typing import Callable, Optional
+from telegram import Update
+from telegram.ext import CallbackContext
+from config import SHARD_WORKERS, SHARD_QUEUE_SIZE, BUSY_MESSAGE
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+# A worker that stays up this long is considered healthy again, resetting its restart backoff
+_STABLE_SECONDS = 60
+
+
+class _Shard:
+    """One worker process and the updates sent to it that it has not acknowledged yet."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.outstanding = OrderedDict()  # update_id -> update JSON
+        self.started_at = 0.0
+        self.restarts = 0
+        self.failures = 0  # consecutive crashes, for the restart backoff
+        self.dead = False  # pipe closed by the worker's exit
+        self.restart_at = None
+
+
+class ShardPool:
+    """
+    Fan updates out to worker processes, sharded by user id.
+
+    The ingesting process (polling or webhook) forwards each update as JSON
+    over a pipe to worker ``user_id % workers``, so one user's updates are
+    always handled in order by the same process, next to that user's cached
+    language. Workers run the usual handlers and acknowledge each update
+    once its handlers ran (and a text job was stored).
+
+    Updates are kept until acknowledged: when a worker crashes it is
+    restarted with exponential backoff and sent its unacknowledged updates
+    again, and the jobs it was running are released for its replacement. The update id below which everything is acknowledged is passed
+    to ``on_handled``, which the polling bot uses as its committed offset.
+    """
+
+    def __init__(self, workers: int = SHARD_WORKERS, queue_size: int = SHARD_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        # Workers start from a fresh interpreter: forking would copy the parent's
+        # threads, locks and database connections in whatever state they are in
+        self._ctx = multiprocessing.get_context('spawn')
+        self._lock = threading.Condition()
+        self._shards = []
+        self._on_handled = None
+        self._forwarded_max = None
+        self._stopping = False
+
+    def start(self, on_handled: Optional[Callable[[int], None]] = None) -> None:
+        """Start the worker processes and the threads that collect acknowledgements and restart crashed workers."""
+        with self._lock:
+            self._on_handled = on_handled
+            if self._shards:
+                return
+            self._stopping = False
+            self._shards = [_Shard(index) for index in range(self.workers)]
+        for shard in self._shards:
+            self._spawn(shard)
+        threading.Thread(target=self._receive, name='shard-acks', daemon=True).start()
+        threading.Thread(target=self._supervise, name='shard-supervisor', daemon=True).start()
+        logger.info("Started %s shard workers", self.workers)
+
+    def _spawn(self, shard: _Shard) -> None:
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=run_shard, args=(shard.index, self.workers, child_conn),
+            name=f'shard-{shard.index}', daemon=True
+        )
+        process.start()
+        child_conn.close()
+        with shard.send_lock:
+            with self._lock:
+                shard.process = process
+                shard.conn = parent_conn
+                shard.started_at = time.monotonic()
+                shard.dead = False
+                shard.restart_at = None
+                backlog = list(shard.outstanding.values())
+            # Whatever the previous process had not acknowledged goes to its replacement first
+            for data in backlog:
+                parent_conn.send(data)
+        if backlog:
+            logger.info("Re-sent %s unacknowledged updates to shard %s", len(backlog), shard.index)
+
+    @staticmethod
+    def _release_jobs(pid: int) -> None:
+        """Make the jobs a crashed worker was running available to its replacement."""
+        from jobqueue import job_queue
+        try:
+            released = job_queue.release(pid)
+        except Exception as e:
+            logger.error("Failed to release jobs of crashed worker %s: %s", pid, e)
+            return
+        if released:
+            logger.info("Released %s jobs left running by crashed worker %s", released, pid)
+
+    def shard_for(self, user_id: Optional[int]) -> int:
+        """Return the index of the worker that handles ``user_id``; updates without a user go to worker 0."""
+        return (user_id or 0) % self.workers
+
+    def route(self, update: Update, context: CallbackContext) -> None:
+        """
+        Dispatcher callback that forwards ``update`` to its worker.
+
+        Waits up to 5 seconds while the worker has SHARD_QUEUE_SIZE updates
+        outstanding, which also holds back polling; after that the user
+        gets BUSY_MESSAGE instead.
+        """
+        user_id = update.effective_user.id if update.effective_user else None
+        shard = self._shards[self.shard_for(user_id)]
+        data = update.to_json()
+        with self._lock:
+            if not self._lock.wait_for(lambda: len(shard.outstanding) < self.queue_size, timeout=5):
+                logger.warning("Shard %s is full, rejecting update from user %s", shard.index, user_id)
+                if update.effective_message:
+                    update.effective_message.reply_text(BUSY_MESSAGE)
+                return
+            shard.outstanding[update.update_id] = data
+            if self._forwarded_max is None or update.update_id > self._forwarded_max:
+                self._forwarded_max = update.update_id
+            conn = shard.conn
+        with shard.send_lock:
+            if shard.conn is not conn:
+                return  # the worker was replaced meanwhile and got the update with its backlog
+            try:
+                conn.send(data)
+            except (OSError, ValueError):
+                pass  # the worker died; its replacement gets the update with its backlog
+
+    def _watermark(self) -> Optional[int]:
+        """Return the newest update id with every update up to it acknowledged. Call with the lock held."""
+        pending = [next(iter(shard.outstanding)) for shard in self._shards if shard.outstanding]
+        return min(pending) - 1 if pending else self._forwarded_max
+
+    def _acknowledge(self, shard: _Shard, update_id: int) -> None:
+        with self._lock:
+            shard.outstanding.pop(update_id, None)
+            watermark = self._watermark()
+            self._lock.notify_all()
+        if self._on_handled and watermark is not None:
+            self._on_handled(watermark)
+
+    def _receive(self) -> None:
+        while not self._stopping:
+            with self._lock:
+                conns = {shard.conn: shard for shard in self._shards if shard.conn is not None and not shard.dead}
+            if not conns:
+                time.sleep(0.1)
+                continue
+            try:
+                ready = wait_connections(list(conns), timeout=1)
+            except OSError:
+                continue  # a pipe was closed while waiting on it
+            for conn in ready:
+                shard = conns[conn]
+                try:
+                    update_id = conn.recv()
+                except (EOFError, OSError):
+                    # The worker is gone; stop polling its pipe until it is replaced
+                    shard.dead = True
+                    continue
+                self._acknowledge(shard, update_id)
+
+    def _supervise(self) -> None:
+        while not self._stopping:
+            time.sleep(1)
+            for shard in self._shards:
+                if self._stopping or shard.process.exitcode is None:
+                    continue
+                now = time.monotonic()
+                with self._lock:
+                    if shard.restart_at is None:
+                        # First time this crash is seen: schedule the restart with backoff
+                        shard.failures = 1 if now - shard.started_at > _STABLE_SECONDS else shard.failures + 1
+                        delay = min(30, 2 ** (shard.failures - 1))
+                        shard.restart_at = now + delay
+                        logger.error("Shard worker %s exited with code %s, restarting in %ss",
+                                     shard.index, shard.process.exitcode, delay)
+                    due = now >= shard.restart_at
+                if due:
+                    shard.restarts += 1
+                    shard.conn.close()
+                    self._release_jobs(shard.process.pid)
+                    self._spawn(shard)
+
+    def stop(self, timeout: float) -> None:
+        """
+        Ask every worker to finish its queued jobs and exit, waiting up to ``timeout`` seconds.
+
+        Acknowledgements sent before the workers exited are still processed,
+        so ``on_handled`` sees the final watermark.
+        """
+        if not self._shards:
+            return
+        self._stopping = True
+        for shard in self._shards:
+            with shard.send_lock:
+                try:
+                    shard.conn.send(None)
+                except (OSError, ValueError):
+                    pass
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            shard.process.join(max(0.0, deadline - time.monotonic()))
+            if shard.process.exitcode is None:
+                logger.warning("Shard worker %s did not stop in time, terminating it", shard.index)
+                shard.process.terminate()
+                shard.process.join(5)
+            try:
+                while shard.conn.poll():
+                    self._acknowledge(shard, shard.conn.recv())
+            except (EOFError, OSError):
+                pass
+            shard.conn.close()
+        self._shards = []
+
+    def backlog(self) -> int:
+        """Return the number of forwarded updates not yet acknowledged."""
+        with self._lock:
+            return sum(len(shard.outstanding) for shard in self._shards)
+
+    def stats(self) -> list:
+        """Return one dict per worker with its pid, liveness, backlog and restart count."""
+        with self._lock:
+            return [{
+                'shard': shard.index,
+                'pid': shard.process.pid if shard.process else None,
+                'alive': bool(shard.process and shard.process.exitcode is None),
+                'backlog': len(shard.outstanding),
+                'restarts': shard.restarts,
+            } for shard in self._shards]
+
+
+# Shared pool of shard workers, started only when SHARD_WORKERS > 0
+shard_pool = ShardPool()
+
+Gauge('shard_workers_alive', 'Shard worker processes currently running.',
+      lambda: sum(s['alive'] for s in shard_pool.stats()))
+Gauge('shard_backlog', 'Updates forwarded to each shard worker and not yet acknowledged.',
+      lambda: {(str(s['shard']),): s['backlog'] for s in shard_pool.stats()}, labelnames=('shard',))
+Gauge('shard_restarts_total', 'Shard worker restarts after a crash.',
+      lambda: {(str(s['shard']),): s['restarts'] for s in shard_pool.stats()}, labelnames=('shard',), kind='counter')
+
+
+def run_shard(index: int, workers: int, conn) -> None:
+    """
+    Entry point of a shard worker process.
+
+    Handles the updates received on ``conn`` with the bot's usual handlers
+    and sends back each update's id once they ran (text jobs are stored by
+    then). Exits when the parent
+    sends None or goes away, after letting queued jobs finish.
+    """
+    # The parent decides when workers stop, and tells them through the pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    from telegram import Bot
+    from telegram.ext import Dispatcher
+    from config import TELEGRAM_TOKEN, TELEGRAM_API_URL, JOB_DRAIN_SECONDS
+    from bot import register_handlers
+    from handlers import text_handler
+    from heartbeat import heartbeat
+    from httppool import http_pool
+    from jobqueue import job_queue, resume_jobs
+    from scheduler import scheduler
+    from spool import spool
+    from userstore import user_store
+    from utils import warm_up
+
+    logger.info("Shard worker %s starting", index)
+    user_store.load()
+    user_store.start()
+    spool.start()
+    bot = Bot(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL, request=http_pool.telegram_request())
+    # Updates arrive through process_update, so the dispatcher's own queue stays unused
+    dispatcher = Dispatcher(bot, queue.Queue(), use_context=True)
+    register_handlers(dispatcher)
+    heartbeat.start(f'shard-{index}')
+    warm_up()
+    resume_jobs(dispatcher, text_handler, shard=(index, workers))
+
+    while True:
+        try:
+            data = conn.recv()
+        except (EOFError, OSError):
+            logger.warning("Shard worker %s lost its parent, stopping", index)
+            break
+        if data is None:
+            break
+        update = json.loads(data)
+        try:
+            dispatcher.process_update(Update.de_json(update, bot))
+        except Exception as e:
+            logger.error("Shard worker %s failed to process update %s: %s", index, update.get('update_id'), e)
+        # Every handler has run, so the update cannot be lost any more
+        conn.send(update['update_id'])
+
+    if not scheduler.drain(JOB_DRAIN_SECONDS):
+        job_queue.release()
+    scheduler.shutdown(wait=False)
+    user_store.stop()
+    heartbeat.stop()
+    conn.close()
+    logger.info("Shard worker %s stopped", index)
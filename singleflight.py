@@ -0,0 +1,116 @@
+import logging
+import threading
+from typing import Optional
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+COALESCED = Counter(
+    'tts_singleflight_calls_total',
+    'Synthesis requests by whether they ran the engine or waited for an identical one.',
+    ('role',)
+)
+
+
+class _Call:
+    """An in-flight call and the callers waiting on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+        self.cancelled = False
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into a single execution.
+
+    The first caller for a key runs the function; callers arriving while it
+    runs wait for it and receive the same result, or the same exception.
+    The key is forgotten as soon as the call finishes, so later callers run
+    again (normally finding the result in a cache by then).
+
+    If the running call is interrupted by something other than an ordinary
+    exception (KeyboardInterrupt, SystemExit), the result is not shared:
+    waiters run the function themselves instead of failing with it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Call
+
+    def do(self, key, fn, *args, timeout: Optional[float] = None):
+        """
+        Run ``fn(*args)`` unless an identical call is already running, then share its outcome.
+
+        Args:
+            key: Identity of the call; equal keys must produce equal results
+            fn: Callable to run
+            timeout (float): Longest a waiter blocks before giving up (None waits forever)
+
+        Returns:
+            Whatever ``fn`` returned
+
+        Raises:
+            TimeoutError: If this caller waited longer than ``timeout``; the running call continues
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                else:
+                    call.waiters += 1
+
+            if leader:
+                COALESCED.inc(role='leader')
+                return self._lead(key, call, fn, args)
+
+            COALESCED.inc(role='waiter')
+            try:
+                if not call.done.wait(timeout):
+                    raise TimeoutError(f"Timed out after {timeout}s waiting for an identical request")
+            finally:
+                with self._lock:
+                    call.waiters -= 1
+            if call.cancelled:
+                logger.debug("Coalesced call was interrupted, running it again")
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    def _lead(self, key, call: _Call, fn, args):
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.cancelled = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def waiters(self) -> int:
+        """Return the number of callers currently waiting on another caller's result."""
+        with self._lock:
+            return sum(call.waiters for call in self._calls.values())
+
+    def in_flight(self) -> int:
+        """Return the number of distinct calls currently running."""
+        with self._lock:
+            return len(self._calls)
+
+
+# Shared table of in-flight synthesis calls, keyed by audio cache key
+synthesis_flight = SingleFlight()
+
+Gauge('tts_singleflight_waiters', 'Requests currently waiting on an identical in-flight synthesis.',
+      synthesis_flight.waiters)
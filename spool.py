@@ -0,0 +1,339 @@
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from config import (
+    TEMP_DIR,
+    TEMP_DIR_MAX_BYTES,
+    SPOOL_MAX_BYTES,
+    SPOOL_MAX_FILES,
+    SPOOL_ORPHAN_TTL,
+    SPOOL_SWEEP_INTERVAL
+)
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+# Spool files are named spool-<pid>-<hex>.<ext> so any process can tell whose
+# they are; <uuid>.<ext> files were written by versions without a spool
+_SPOOL_NAME = re.compile(r'^spool-(?P<pid>\d+)-[0-9a-f]{32}\.\w+$')
+_LEGACY_NAME = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.\w+$')
+
+
+class SpoolFull(OSError):
+    """Raised when a new spool file would exceed the quota and nothing can be evicted."""
+
+
+def pid_running(pid: int) -> bool:
+    """Return whether a process with this pid exists, so files named after it are still in use."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Spool:
+    """
+    Owner of the transient audio files in TEMP_DIR.
+
+    Every speech file is created through :meth:`create` and carries a
+    reference count; it is deleted as soon as the last reference is released,
+    whichever path the request took. Files nobody holds a reference to are
+    orphans, left by requests that failed before releasing them or by a
+    crashed process. A background sweeper deletes orphans older than
+    ``orphan_ttl`` every ``sweep_interval`` seconds and once at startup, and
+    when a new file would take the spool over ``max_bytes`` or ``max_files``
+    the oldest orphans are evicted first.
+
+    Several processes (shard workers) share TEMP_DIR; the owner's pid in each
+    file name keeps one process from removing files another is still using.
+    The quota is checked as files are created, and disk usage is rescanned
+    on every sweep and estimated in between. Directory scans run outside the
+    lock, so creating a file never waits on one.
+    Anonymous temporary files (spilled buffers) are counted through
+    :meth:`charge`. The audio cache and segment store in TEMP_DIR keep to
+    their own limits; each sweep also measures them and warns when TEMP_DIR
+    as a whole is over ``dir_max_bytes``, the sum of the three limits.
+    """
+
+    def __init__(self, root: str = TEMP_DIR, max_bytes: int = SPOOL_MAX_BYTES, max_files: int = SPOOL_MAX_FILES,
+                 orphan_ttl: float = SPOOL_ORPHAN_TTL, sweep_interval: float = SPOOL_SWEEP_INTERVAL,
+                 dir_max_bytes: int = TEMP_DIR_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.dir_max_bytes = dir_max_bytes
+        self.max_files = max_files
+        self.orphan_ttl = orphan_ttl
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._evicting = threading.Lock()  # one eviction scan at a time, without holding _lock
+        self._refs = {}  # path -> reference count, for this process's live files
+        self._sizes = {}  # path -> bytes, for this process's live files
+        self._bytes = 0  # all spool files on disk, plus charged anonymous bytes
+        self._files = 0
+        self._anonymous = 0
+        self._other_bytes = 0  # everything else in TEMP_DIR at the last sweep: audio cache, segment store
+        self._stats = {'created': 0, 'released': 0, 'evicted': 0, 'swept': 0, 'sweeps': 0, 'full': 0}
+        self._last_sweep = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def create(self, extension: str = 'mp3') -> str:
+        """
+        Reserve a new file path in the spool, holding one reference to it.
+
+        Returns:
+            str: Path to write the audio to; release it when done
+
+        Raises:
+            SpoolFull: If the spool is at its quota and has no orphans to evict
+        """
+        os.makedirs(self.root, mode=0o755, exist_ok=True)
+        path = os.path.join(self.root, f"spool-{os.getpid()}-{uuid.uuid4().hex}.{extension}")
+        with self._lock:
+            full = self._full()
+        if full:
+            with self._evicting:
+                self._evict()
+        with self._lock:
+            if self._full():
+                self._stats['full'] += 1
+                raise SpoolFull(f"Spool {self.root} is full ({self._files} files, {self._bytes} bytes)")
+            self._refs[path] = 1
+            self._sizes[path] = 0
+            self._files += 1
+            self._stats['created'] += 1
+        return path
+
+    def written(self, path: str) -> None:
+        """Record the size of a file once it has been written."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            if path in self._sizes:
+                self._bytes += size - self._sizes[path]
+                self._sizes[path] = size
+
+    def rename(self, path: str, new_path: str) -> None:
+        """Move a live file, keeping its references."""
+        with self._lock:
+            os.replace(path, new_path)
+            self._refs[new_path] = self._refs.pop(path)
+            self._sizes[new_path] = self._sizes.pop(path)
+
+    def acquire(self, path: str) -> None:
+        """Take another reference to a live file."""
+        with self._lock:
+            self._refs[path] += 1
+
+    def release(self, path: str) -> None:
+        """Drop a reference; the file is deleted with the last one."""
+        with self._lock:
+            refs = self._refs.get(path)
+            if refs is None:
+                logger.warning("Released a file the spool does not hold: %s", path)
+                return
+            if refs > 1:
+                self._refs[path] = refs - 1
+                return
+            del self._refs[path]
+            size = self._sizes.pop(path)
+            # Removed under the lock, so the file count never runs ahead of the disk
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # Still on disk and counted; the sweeper finds it unreferenced
+                logger.error("Error removing spool file %s: %s", path, e)
+                return
+            self._bytes -= size
+            self._files -= 1
+            self._stats['released'] += 1
+
+    def has_room(self, size: int) -> bool:
+        """Return whether ``size`` more bytes fit in the quota, for writers that can stay in memory instead."""
+        with self._lock:
+            return self._bytes + size <= self.max_bytes
+
+    def charge(self, size: int) -> None:
+        """Count (or, with a negative size, stop counting) bytes of anonymous temporary files in TEMP_DIR."""
+        with self._lock:
+            self._anonymous += size
+            self._bytes += size
+
+    def _full(self) -> bool:
+        return self._bytes >= self.max_bytes or self._files >= self.max_files
+
+    def _scan(self) -> tuple:
+        """
+        List the audio files in the spool directory and measure everything else in it.
+
+        Returns:
+            tuple: ([(mtime, path, size, foreign)], other_bytes), where foreign
+            files belong to another running process
+        """
+        files = []
+        other = 0
+        pid = os.getpid()
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return files, other
+        for entry in entries:
+            try:
+                match = _SPOOL_NAME.match(entry.name)
+                if match or _LEGACY_NAME.match(entry.name):
+                    owner = int(match.group('pid')) if match else pid
+                    stat = entry.stat()
+                    foreign = owner != pid and pid_running(owner)
+                    files.append((stat.st_mtime, entry.path, stat.st_size, foreign))
+                elif entry.is_dir(follow_symlinks=False):
+                    # The audio cache, with one subdirectory per process
+                    for directory, _, names in os.walk(entry.path):
+                        for name in names:
+                            try:
+                                other += os.path.getsize(os.path.join(directory, name))
+                            except FileNotFoundError:
+                                continue
+                elif entry.is_file(follow_symlinks=False):
+                    # The segment store and its journal
+                    other += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+        return files, other
+
+    def _orphans(self, files: list, min_age: float) -> list:
+        """Return (mtime, path, size) of unreferenced files older than ``min_age``, oldest first. Called with the lock held."""
+        now = time.time()
+        orphans = [
+            (mtime, path, size) for mtime, path, size, foreign in files
+            # Another process's files are its own to clean up
+            if not foreign and path not in self._refs and now - mtime >= min_age
+        ]
+        orphans.sort()
+        return orphans
+
+    def _remove(self, path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.error("Error removing orphaned spool file %s: %s", path, e)
+            return False
+
+    def _evict(self) -> None:
+        """Remove the oldest orphans until the spool is under quota."""
+        files, _ = self._scan()
+        with self._lock:
+            bytes_, count = self._bytes, self._files
+            victims = []
+            for _, path, size in self._orphans(files, 0):
+                if bytes_ < self.max_bytes and count < self.max_files:
+                    break
+                victims.append((path, size))
+                bytes_ -= size
+                count -= 1
+        # Orphans are never handed out again, so they can be removed without the lock
+        for path, size in victims:
+            if self._remove(path):
+                with self._lock:
+                    self._bytes -= size
+                    self._files -= 1
+                    self._stats['evicted'] += 1
+
+    def sweep(self) -> int:
+        """
+        Delete orphans older than the TTL and recount disk usage.
+
+        Returns:
+            int: Number of files removed
+        """
+        files, other = self._scan()
+        with self._lock:
+            orphans = self._orphans(files, self.orphan_ttl)
+        removed = {path for _, path, _ in orphans if self._remove(path)}
+        with self._lock:
+            # Live files are counted from this process's own records, the rest from the scan
+            count = len(self._sizes)
+            total = sum(self._sizes.values())
+            for _, path, size, _ in files:
+                if path not in removed and path not in self._sizes:
+                    count += 1
+                    total += size
+            self._files = count
+            self._bytes = total + self._anonymous
+            self._other_bytes = other
+            self._stats['swept'] += len(removed)
+            self._stats['sweeps'] += 1
+            self._last_sweep = time.time()
+            dir_bytes = self._bytes + other
+        if removed:
+            logger.info("Spool sweep removed %d orphaned files from %s", len(removed), self.root)
+        if dir_bytes > self.dir_max_bytes:
+            logger.warning("%s holds %d bytes, over its combined limit of %d", self.root, dir_bytes, self.dir_max_bytes)
+        return len(removed)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error("Spool sweep failed: %s", e)
+            if self._stop.wait(self.sweep_interval):
+                return
+
+    def start(self) -> None:
+        """Sweep now and then every ``sweep_interval`` seconds on a background thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='spool-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background sweeper."""
+        self._stop.set()
+
+    def stats(self) -> dict:
+        """Return disk usage, live files and sweep counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'files': self._files,
+                'bytes': self._bytes,
+                'dir_bytes': self._bytes + self._other_bytes,
+                'live_files': len(self._refs),
+                'last_sweep_age': None if self._last_sweep is None else round(time.time() - self._last_sweep, 1),
+            })
+        return stats
+
+
+# Shared spool for TEMP_DIR
+spool = Spool()
+
+
+def _spool_counters() -> dict:
+    stats = spool.stats()
+    return {(name,): stats[name] for name in ('released', 'evicted', 'swept')}
+
+
+Gauge('spool_files_removed_total', 'Spool files removed, by whether they were released, evicted or swept as orphans.',
+      _spool_counters, labelnames=('reason',), kind='counter')
+Gauge('spool_sweeps_total', 'Orphan sweeps of TEMP_DIR.', lambda: spool.stats()['sweeps'], kind='counter')
+Gauge('spool_full_total', 'Spool files refused because the quota was reached.',
+      lambda: spool.stats()['full'], kind='counter')
+Gauge('spool_bytes', 'Bytes of audio in TEMP_DIR, estimated between sweeps.', lambda: spool.stats()['bytes'])
+Gauge('temp_dir_bytes', 'Bytes in TEMP_DIR including the audio cache and segment store, as of the last sweep.',
+      lambda: spool.stats()['dir_bytes'])
+Gauge('spool_files', 'Audio files in TEMP_DIR, estimated between sweeps.', lambda: spool.stats()['files'])
+Gauge('spool_live_files', 'Spool files held by requests in this process.', lambda: spool.stats()['live_files'])
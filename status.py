@@ -0,0 +1,373 @@
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import delete, insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from app import app, db
+from models import BotStatus, Lease, MetricsSnapshot
+from heartbeat import heartbeat
+from metrics import STAGE_SECONDS, bucket_quantile, process_name, snapshot
+from config import (
+    HEARTBEAT_STALE_SECONDS,
+    STATUS_FLUSH_INTERVAL,
+    STATUS_BUFFER_SIZE,
+    STATUS_MINUTE_RETENTION_HOURS,
+    STATUS_HOUR_RETENTION_DAYS,
+    STATUS_DAY_RETENTION_DAYS
+)
+
+logger = logging.getLogger(__name__)
+
+# Start of the bucket a time falls in, for each resolution
+_TRUNCATE = {
+    'minute': lambda moment: moment.replace(second=0, microsecond=0),
+    'hour': lambda moment: moment.replace(minute=0, second=0, microsecond=0),
+    'day': lambda moment: moment.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+# Seconds between rollups; minute rows only become eligible an hour at a time
+_ROLLUP_INTERVAL = 3600
+
+# Name of the lease held by the process that records the history
+_LEASE = 'status-recorder'
+
+
+def _reading(data: dict) -> tuple:
+    """
+    Extract the counters the status history is built from out of a metrics snapshot.
+
+    Args:
+        data (dict): metrics.snapshot() of one process
+
+    Returns:
+        tuple: Updates received, synthesis counts per bucket and queue depth
+    """
+    def total(name: str) -> float:
+        return sum(value for _, value in data.get(name, {}).get('series', []))
+
+    counts = [0] * (len(STAGE_SECONDS.buckets) + 1)
+    histogram = data.get(STAGE_SECONDS.name)
+    if histogram:
+        stage = histogram['labels'].index('stage')
+        for key, values in histogram['series']:
+            if key[stage] == 'synthesis':
+                counts = [count + value for count, value in zip(counts, values)]
+    return total('bot_updates_received_total'), counts, int(total('bot_queue_depth'))
+
+
+def combine(rows: list, timestamp: datetime, resolution: str) -> dict:
+    """
+    Merge status rows into one row for a coarser bucket.
+
+    Rates and the median are averaged weighted by samples; p95, p99 and the
+    queue depth keep the worst value, so a bad minute stays visible in the
+    hour and the day.
+
+    Args:
+        rows (list): BotStatus rows in the bucket
+        timestamp (datetime): Start of the bucket
+        resolution (str): 'hour' or 'day'
+
+    Returns:
+        dict: Column values for the merged row
+    """
+    samples = sum(row.samples for row in rows)
+    healthy = sum(row.healthy_samples for row in rows)
+    timed = [row for row in rows if row.synthesis_p50 is not None]
+    timed_samples = sum(row.samples for row in timed)
+    return {
+        'timestamp': timestamp,
+        'resolution': resolution,
+        'status': 'healthy' if healthy == samples else 'unhealthy',
+        'last_health_check': max(row.last_health_check for row in rows),
+        'samples': samples,
+        'healthy_samples': healthy,
+        'updates_per_second': sum(row.updates_per_second * row.samples for row in rows) / samples,
+        'synthesis_p50': sum(row.synthesis_p50 * row.samples for row in timed) / timed_samples if timed else None,
+        'synthesis_p95': max((row.synthesis_p95 for row in timed), default=None),
+        'synthesis_p99': max((row.synthesis_p99 for row in timed), default=None),
+        'queue_depth': max(row.queue_depth for row in rows),
+    }
+
+
+class StatusRecorder:
+    """
+    Record the bot's vitals as a time series in the bot_status_history table.
+
+    Every bot process starts a recorder, but only the one holding the
+    ``status-recorder`` lease samples and rolls up; the others stand by and
+    take the lease over once it has not been renewed for three sample
+    intervals. The leader adds up the counters of every live process from the
+    metrics snapshots they publish with their heartbeat.
+
+    Once a minute the leader takes a sample: whether the bot is healthy,
+    updates per second and synthesis latency percentiles over the past
+    minute, and the queue depth. Samples go into a bounded ring buffer,
+    written out in one batched insert every ``flush_interval`` seconds, so
+    neither handlers nor the sampler wait on the database; if it is down the
+    oldest samples are dropped first. Once an hour, minute rows past their
+    retention are rolled up into hour rows, hour rows into day rows, and
+    expired day rows are deleted.
+    """
+
+    def __init__(self, sample_interval: float = 60, flush_interval: float = STATUS_FLUSH_INTERVAL,
+                 buffer_size: int = STATUS_BUFFER_SIZE,
+                 minute_retention: timedelta = timedelta(hours=STATUS_MINUTE_RETENTION_HOURS),
+                 hour_retention: timedelta = timedelta(days=STATUS_HOUR_RETENTION_DAYS),
+                 day_retention: timedelta = timedelta(days=STATUS_DAY_RETENTION_DAYS)):
+        self.sample_interval = sample_interval
+        self.flush_interval = flush_interval
+        self.minute_retention = minute_retention
+        self.hour_retention = hour_retention
+        self.day_retention = day_retention
+        self._lock = threading.Lock()
+        self._buffer = deque(maxlen=buffer_size)
+        self.owner = process_name()
+        self._leading = False
+        self._last_time = None
+        self._last = {}  # process -> (updates, synthesis counts) at the previous sample
+        self._stats = {'samples': 0, 'flushed': 0, 'dropped': 0, 'rolled_up': 0, 'expired': 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def lead(self) -> bool:
+        """
+        Take or renew the recorder lease.
+
+        If the database cannot be reached the current role is kept: no other
+        process can take the lease over meanwhile, and samples stay buffered.
+
+        Returns:
+            bool: Whether this process should sample and roll up
+        """
+        now = datetime.utcnow()
+        values = {'owner': self.owner, 'expires_at': now + timedelta(seconds=3 * self.sample_interval)}
+        try:
+            with app.app_context():
+                taken = db.session.execute(update(Lease).where(
+                    Lease.name == _LEASE, or_(Lease.owner == self.owner, Lease.expires_at < now)
+                ).values(**values)).rowcount
+                if not taken:
+                    insert_ = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+                    taken = db.session.execute(
+                        insert_(Lease).values(name=_LEASE, **values).on_conflict_do_nothing(index_elements=[Lease.name])
+                    ).rowcount
+                db.session.commit()
+        except Exception as e:
+            logger.error("Failed to renew the status recorder lease: %s", e)
+            return self._leading
+        return bool(taken)
+
+    def _readings(self) -> dict:
+        """Return (updates, synthesis counts, queue depth) for this process and every other live bot process."""
+        readings = {}
+        try:
+            with app.app_context():
+                rows = db.session.execute(select(MetricsSnapshot).where(
+                    MetricsSnapshot.updated_at >= datetime.utcnow() - timedelta(seconds=HEARTBEAT_STALE_SECONDS),
+                    MetricsSnapshot.process != self.owner
+                )).scalars().all()
+            for row in rows:
+                readings[row.process] = _reading(json.loads(row.payload))
+        except Exception as e:
+            logger.warning("Failed to read other processes' metrics, sampling this process only: %s", e)
+        readings[self.owner] = _reading(snapshot())
+        return readings
+
+    def _baseline(self) -> None:
+        self._last_time = time.monotonic()
+        self._last = {process: reading[:2] for process, reading in self._readings().items()}
+
+    def sample(self) -> dict:
+        """Measure the vitals since the previous sample and append them to the buffer."""
+        if self._last_time is None:
+            self._baseline()
+        now = time.monotonic()
+        readings = self._readings()
+        elapsed = max(now - self._last_time, 1e-9)
+        updates = 0
+        delta = [0] * (len(STAGE_SECONDS.buckets) + 1)
+        for process, (count, counts, _) in readings.items():
+            # A process seen for the first time only sets its baseline; one
+            # that restarted under the same name counts from zero again
+            previous = self._last.get(process)
+            if previous is None:
+                continue
+            updates += max(0, count - previous[0])
+            delta = [total + max(0, current - before) for total, current, before in zip(delta, counts, previous[1])]
+        rate = updates / elapsed
+        self._last_time = now
+        self._last = {process: reading[:2] for process, reading in readings.items()}
+
+        healthy = heartbeat.healthy()
+        at = datetime.utcnow()
+        percentiles = [bucket_quantile(STAGE_SECONDS.buckets, delta, q) for q in (0.5, 0.95, 0.99)]
+        row = {
+            'timestamp': _TRUNCATE['minute'](at),
+            'resolution': 'minute',
+            'status': 'healthy' if healthy else 'unhealthy',
+            'last_health_check': at,
+            'samples': 1,
+            'healthy_samples': int(healthy),
+            'updates_per_second': rate,
+            'synthesis_p50': percentiles[0],
+            'synthesis_p95': percentiles[1],
+            'synthesis_p99': percentiles[2],
+            'queue_depth': sum(reading[2] for reading in readings.values()),
+        }
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self._stats['dropped'] += 1
+            self._buffer.append(row)
+            self._stats['samples'] += 1
+        return row
+
+    def flush(self) -> int:
+        """
+        Write buffered samples to the database in one batch.
+
+        Returns:
+            int: Number of rows written
+        """
+        with self._lock:
+            rows = list(self._buffer)
+            self._buffer.clear()
+        if not rows:
+            return 0
+        try:
+            with app.app_context():
+                db.session.execute(insert(BotStatus), rows)
+                db.session.commit()
+        except Exception:
+            with self._lock:
+                # Put them back ahead of newer samples; the oldest go first if the buffer overflows
+                merged = rows + list(self._buffer)
+                self._stats['dropped'] += max(0, len(merged) - self._buffer.maxlen)
+                self._buffer = deque(merged, maxlen=self._buffer.maxlen)
+            raise
+        with self._lock:
+            self._stats['flushed'] += len(rows)
+        return len(rows)
+
+    def rollup(self, now: Optional[datetime] = None) -> dict:
+        """
+        Roll expired minute rows into hours and hour rows into days, and delete expired days.
+
+        Only whole buckets are rolled up; rows flushed late into a bucket that
+        was already rolled up are merged into it.
+
+        Args:
+            now (datetime): Current UTC time, for tests and benchmarks
+
+        Returns:
+            dict: Rows rolled up per source resolution and day rows deleted
+        """
+        now = now or datetime.utcnow()
+        result = {}
+        with app.app_context():
+            for source, target, retention in (('minute', 'hour', self.minute_retention),
+                                              ('hour', 'day', self.hour_retention)):
+                cutoff = _TRUNCATE[target](now - retention)
+                rows = db.session.execute(
+                    select(BotStatus).where(BotStatus.resolution == source, BotStatus.timestamp < cutoff)
+                ).scalars().all()
+                if not rows:
+                    result[source] = 0
+                    continue
+                buckets = {}
+                for row in rows:
+                    buckets.setdefault(_TRUNCATE[target](row.timestamp), []).append(row)
+                existing = db.session.execute(
+                    select(BotStatus).where(BotStatus.resolution == target, BotStatus.timestamp.in_(list(buckets)))
+                ).scalars().all()
+                for row in existing:
+                    buckets[row.timestamp].append(row)
+                merged = [combine(bucket, timestamp, target) for timestamp, bucket in sorted(buckets.items())]
+                db.session.execute(delete(BotStatus).where(BotStatus.id.in_([row.id for row in existing])))
+                db.session.execute(delete(BotStatus).where(BotStatus.resolution == source,
+                                                           BotStatus.timestamp < cutoff))
+                db.session.execute(insert(BotStatus), merged)
+                result[source] = len(rows)
+            expired = db.session.execute(delete(BotStatus).where(
+                BotStatus.resolution == 'day', BotStatus.timestamp < now - self.day_retention
+            )).rowcount
+            db.session.commit()
+        result['expired'] = expired
+        with self._lock:
+            self._stats['rolled_up'] += result['minute'] + result['hour']
+            self._stats['expired'] += expired
+        return result
+
+    def _run(self) -> None:
+        next_flush = time.monotonic() + self.flush_interval
+        next_rollup = time.monotonic()
+        while not self._stop.wait(self.sample_interval):
+            leading = self.lead()
+            if leading != self._leading:
+                logger.info("%s recording the status history", "Started" if leading else "Stopped")
+            try:
+                if leading and not self._leading:
+                    # Counters that grew while another process led belong to its samples
+                    self._baseline()
+                elif leading:
+                    self.sample()
+            except Exception as e:
+                logger.error("Failed to sample bot status: %s", e)
+            self._leading = leading
+            # Samples taken before losing the lease are still written out
+            if time.monotonic() >= next_flush:
+                next_flush = time.monotonic() + self.flush_interval
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error("Failed to write bot status history: %s", e)
+            if leading and time.monotonic() >= next_rollup:
+                next_rollup = time.monotonic() + _ROLLUP_INTERVAL
+                try:
+                    self.rollup()
+                except Exception as e:
+                    logger.error("Failed to roll up bot status history: %s", e)
+
+    def start(self) -> None:
+        """Start competing for the recorder lease if this process is not already doing so."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='status-recorder', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling, write out the buffered samples and hand the lease to the next process."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error("Failed to write bot status history: %s", e)
+        if self._leading:
+            self._leading = False
+            try:
+                with app.app_context():
+                    db.session.execute(delete(Lease).where(Lease.name == _LEASE, Lease.owner == self.owner))
+                    db.session.commit()
+            except Exception as e:
+                logger.error("Failed to release the status recorder lease: %s", e)
+
+    def stats(self) -> dict:
+        """Return sample, flush and rollup counters, the buffered sample count and whether this process leads."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['buffered'] = len(self._buffer)
+        stats['leading'] = self._leading
+        return stats
+
+
+# Shared status recorder; samples still buffered are written at exit
+status_recorder = StatusRecorder()
+atexit.register(status_recorder.stop)
@@ -0,0 +1,232 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Iterator
+from sqlalchemy import delete, func, insert as insert_rows, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from app import app, db
+from models import LanguageChange, User
+from config import DEFAULT_LANG, USER_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Rows per upsert statement and per broadcast page
+BATCH_SIZE = 500
+
+# How long language changes stay in the feed other processes read them from
+_CHANGE_RETENTION = timedelta(hours=1)
+# Recent changes are read again: a transaction can commit after one with a higher id
+_CHANGE_OVERLAP = timedelta(minutes=1)
+
+
+class UserStore:
+    """
+    In-process view of the users table with write-behind persistence.
+
+    Reads are served from memory: non-default languages are loaded once at
+    startup. Writes only touch memory and a pending-changes map, which a
+    background thread flushes as batched upserts every ``flush_interval``
+    seconds, so handlers never wait on the database. A language change wakes
+    the thread at once and is also logged to the language_changes table;
+    every process reads the changes logged since its last read after each
+    flush, so a /lang handled by one gunicorn worker or shard reaches the
+    others within ``flush_interval`` seconds.
+    """
+
+    def __init__(self, flush_interval: float = USER_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._languages = {}  # user_id -> language, only for non-default languages
+        self._pending = {}  # user_id -> {column: value} not yet written
+        self._seen = 0  # id of the last language change read
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def load(self) -> None:
+        """Load stored language preferences into memory."""
+        try:
+            with app.app_context():
+                # Changes logged from here on are read by refresh(), even if already loaded
+                self._seen = db.session.scalar(select(func.max(LanguageChange.id))) or 0
+                rows = db.session.execute(
+                    select(User.id, User.language).where(User.language != DEFAULT_LANG)
+                ).all()
+            with self._lock:
+                for user_id, language in rows:
+                    self._languages.setdefault(user_id, language)
+            logger.info("Loaded language preferences for %s users", len(rows))
+        except Exception as e:
+            logger.error("Failed to load user preferences: %s", e)
+
+    def get_language(self, user_id: int) -> str:
+        """Return the user's language without touching the database."""
+        return self._languages.get(user_id, DEFAULT_LANG)
+
+    def _queue(self, user_id: int, **fields) -> None:
+        with self._lock:
+            self._pending.setdefault(user_id, {}).update(fields)
+
+    def set_language(self, user_id: int, language: str) -> None:
+        """Change the user's language; persisted on the next flush."""
+        with self._lock:
+            if language == DEFAULT_LANG:
+                self._languages.pop(user_id, None)
+            else:
+                self._languages[user_id] = language
+        self._queue(user_id, language=language, active=True, last_seen=datetime.utcnow())
+        # Other processes only see the change once it is written
+        self._wake.set()
+
+    def touch(self, user_id: int) -> None:
+        """Record that the user interacted with the bot and can receive broadcasts."""
+        self._queue(user_id, active=True, last_seen=datetime.utcnow())
+
+    def deactivate(self, user_ids) -> None:
+        """Remove unreachable users from the broadcast audience."""
+        for user_id in user_ids:
+            self._queue(user_id, active=False)
+
+    def flush(self) -> int:
+        """
+        Write all pending changes as batched upserts.
+
+        Returns:
+            int: Number of users written
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            try:
+                with app.app_context():
+                    self._upsert(pending)
+                logger.debug("Flushed %s user updates", len(pending))
+                return len(pending)
+            except Exception as e:
+                logger.error("Failed to flush %s user updates: %s", len(pending), e)
+                # Put the changes back unless newer ones arrived meanwhile
+                with self._lock:
+                    for user_id, fields in pending.items():
+                        self._pending[user_id] = {**fields, **self._pending.get(user_id, {})}
+                return 0
+
+    def _upsert(self, pending: dict) -> None:
+        dialect = db.engine.dialect.name
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        now = datetime.utcnow()
+
+        # One statement per set of changed columns, so a row only overwrites what changed
+        groups = {}
+        for user_id, fields in pending.items():
+            groups.setdefault(frozenset(fields), []).append({
+                'id': user_id,
+                'language': DEFAULT_LANG,
+                'active': True,
+                'last_seen': now,
+                **fields
+            })
+        for columns, rows in groups.items():
+            for start in range(0, len(rows), BATCH_SIZE):
+                stmt = insert(User).values(rows[start:start + BATCH_SIZE])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[User.id],
+                    set_={column: stmt.excluded[column] for column in columns}
+                )
+                db.session.execute(stmt)
+        changes = [{'user_id': user_id, 'language': fields['language'], 'changed_at': now}
+                   for user_id, fields in pending.items() if 'language' in fields]
+        if changes:
+            db.session.execute(insert_rows(LanguageChange), changes)
+            db.session.execute(delete(LanguageChange).where(LanguageChange.changed_at < now - _CHANGE_RETENTION))
+        db.session.commit()
+
+    def refresh(self) -> int:
+        """
+        Apply the language changes other processes logged since the last refresh.
+
+        Changes are applied in the order of their ids, re-reading the last
+        minute's; a change this process has not written yet takes precedence.
+
+        Returns:
+            int: Number of changes read
+        """
+        try:
+            with app.app_context():
+                rows = db.session.execute(
+                    select(LanguageChange.id, LanguageChange.user_id, LanguageChange.language)
+                    .where(or_(LanguageChange.id > self._seen,
+                               LanguageChange.changed_at >= datetime.utcnow() - _CHANGE_OVERLAP))
+                    .order_by(LanguageChange.id)
+                ).all()
+        except Exception as e:
+            logger.error("Failed to read language changes: %s", e)
+            return 0
+        with self._lock:
+            for change_id, user_id, language in rows:
+                self._seen = max(self._seen, change_id)
+                if 'language' in self._pending.get(user_id, {}):
+                    continue
+                if language == DEFAULT_LANG:
+                    self._languages.pop(user_id, None)
+                else:
+                    self._languages[user_id] = language
+        return len(rows)
+
+    def count_active(self) -> int:
+        """Return the number of users a broadcast would reach."""
+        with app.app_context():
+            return db.session.scalar(select(func.count()).select_from(User).where(User.active.is_(True)))
+
+    def iter_active_pages(self, after_id: int = 0, page_size: int = BATCH_SIZE) -> Iterator[list]:
+        """
+        Stream active user ids in ascending order, one page per query.
+
+        Args:
+            after_id (int): Only return ids greater than this (keyset cursor)
+            page_size (int): Ids per page
+
+        Yields:
+            list: Up to page_size user ids
+        """
+        while True:
+            with app.app_context():
+                page = db.session.scalars(
+                    select(User.id)
+                    .where(User.active.is_(True), User.id > after_id)
+                    .order_by(User.id)
+                    .limit(page_size)
+                ).all()
+            if not page:
+                return
+            yield page
+            after_id = page[-1]
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            self.flush()
+            self.refresh()
+
+    def start(self) -> None:
+        """Start the background flush thread if it is not already running."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='user-store-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the flush thread and write out anything still pending."""
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+
+
+# Shared user store
+user_store = UserStore()
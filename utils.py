@@ -1,11 +1,443 @@
+import contextvars
+import io
+import logging
 import os
-import uuid
-from gtts import gTTS
-from config import TEMP_DIR, logger
+import queue
+import re
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+from config import (
+    TEMP_DIR,
+    AUDIO_BUFFER_MODE,
+    AUDIO_SPILL_THRESHOLD,
+    AUDIO_BUFFER_POOL_SIZE,
+    CHUNK_MAX_CHARS,
+    SYNTHESIS_WORKERS,
+    CHUNK_RETRIES,
+    SEGMENT_CACHE
+)
+from metrics import Gauge, STAGE_SECONDS
+from engines import get_engine, record_fallbacks
+from encoding import get_encoder
+from segments import SpliceError, Splicer, segment_key, segment_store
+from spool import spool
+
+logger = logging.getLogger(__name__)
+
+# Sentence ends: Latin punctuation followed by whitespace, or CJK/Devanagari
+# full stops which are not followed by spaces
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+|(?<=[\u3002\uff01\uff1f\u0964])\s*')
+_CLAUSE_END = re.compile(r'(?<=[,;:\u3001\uff0c])\s*')
+
+# Thread pool for synthesizing chunks of long texts
+_synthesis_executor = ThreadPoolExecutor(max_workers=SYNTHESIS_WORKERS, thread_name_prefix='synthesis')
+
+# Thread pool for synthesizing the uncached sentences of one text
+_segment_executor = ThreadPoolExecutor(max_workers=SYNTHESIS_WORKERS, thread_name_prefix='segment')
+
+
+class BufferPool:
+    """
+    Bounded pool of reusable byte buffers.
+
+    Buffers keep their capacity between uses, so steady-state synthesis does
+    not allocate a fresh multi-megabyte object per request.
+    """
+
+    def __init__(self, size: int = AUDIO_BUFFER_POOL_SIZE):
+        self._pool = queue.LifoQueue(maxsize=size)
+
+    def acquire(self) -> bytearray:
+        """Take a buffer from the pool, allocating one if the pool is empty."""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return bytearray()
+
+    def release(self, buf: bytearray) -> None:
+        """Return a buffer to the pool; surplus buffers are left to the garbage collector."""
+        try:
+            self._pool.put_nowait(buf)
+        except queue.Full:
+            pass
+
+
+_buffer_pool = BufferPool()
+
+
+class _TimedWriter:
+    """Forward writes to ``fp`` and add up the time spent in them and the bytes written."""
+
+    def __init__(self, fp):
+        self._fp = fp
+        self.seconds = 0.0
+        self.written = 0
+
+    def write(self, data) -> int:
+        start = time.perf_counter()
+        try:
+            return self._fp.write(data)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.written += len(data)
+
+
+class _InFlight:
+    """Thread-safe count of synthesis calls currently running."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def __enter__(self) -> None:
+        with self._lock:
+            self.count += 1
+
+    def __exit__(self, *exc_info) -> None:
+        with self._lock:
+            self.count -= 1
+
+
+_in_flight = _InFlight()
+Gauge('tts_synthesis_in_flight', 'Speech synthesis calls currently running.', lambda: _in_flight.count)
+
+
+def warm_up() -> None:
+    """
+    Build the speech engine and voice encoder on a background thread.
+
+    Started once the bot is polling, so loading gTTS and probing for local
+    tools overlaps the first getUpdates call instead of delaying the first reply.
+    """
+    def load():
+        try:
+            engine = get_engine()
+            if any(e.name == 'gtts' for e in getattr(engine, 'engines', [engine])):
+                import gtts  # noqa: F401
+            get_encoder()
+        except Exception as e:
+            logger.warning("Speech engine warm-up failed: %s", e)
+
+    threading.Thread(target=load, name='warm-up', daemon=True).start()
+
+
+def in_flight_synthesis() -> int:
+    """Return the number of synthesis calls currently running in this process."""
+    return _in_flight.count
+
+
+def _write_speech(text: str, lang: str, fp) -> str:
+    """
+    Write the speech for ``text`` into ``fp``, encoded as a voice message when an encoder is configured.
+
+    The audio is fed to the encoder as the engine produces it; the time
+    spent waiting for the encoder after synthesis is the encode stage.
+
+    Returns:
+        str: Format of the audio written, e.g. 'ogg'
+    """
+    encoder = get_encoder()
+    if encoder is None:
+        return _write_audio(text, lang, fp)
+    sink = encoder.open(fp)
+    try:
+        _write_audio(text, lang, sink)
+    except BaseException:
+        sink.abort()
+        raise
+    start = time.perf_counter()
+    sink.close()
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage='encode', lang=lang)
+    return encoder.format
+
+
+def _write_audio(text: str, lang: str, fp) -> str:
+    """
+    Write the engine's audio for ``text`` into ``fp``, from cached sentence segments where possible.
+
+    Returns:
+        str: Format of the audio written, e.g. 'mp3'
+    """
+    if SEGMENT_CACHE:
+        sentences = [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+        if sentences:
+            writer = _TimedWriter(fp)
+            try:
+                return _write_segmented(sentences, lang, writer)
+            except SpliceError as e:
+                if writer.written:
+                    raise  # The start of the clip is already out; it cannot be redone
+                # Segments from different fallback engines cannot be joined
+                logger.debug("Segments could not be spliced (%s), synthesizing the whole text", e)
+    return _write_engine(text, lang, fp)
+
+
+def _synthesize_segment(sentence: str, lang: str) -> tuple[str, bytes, bool]:
+    buffer = io.BytesIO()
+    with record_fallbacks() as fallbacks:
+        audio_format = _write_engine(sentence, lang, buffer)
+    return audio_format, buffer.getvalue(), not fallbacks
+
+
+def _write_segmented(sentences: list[str], lang: str, fp) -> str:
+    """
+    Speak ``sentences`` by splicing cached segments with freshly synthesized ones.
+
+    Sentences missing from the segment store are synthesized concurrently and
+    stored, unless a fallback engine produced them. Segments are written in order as soon as each one and
+    those before it are ready, so the start of the clip does not wait for
+    the last sentence.
+
+    Raises:
+        SpliceError: If the segments cannot be spliced into one clip; part of it may have been written then
+    """
+    engine = get_engine()
+    voice = ','.join(e.name for e in getattr(engine, 'engines', [engine]))
+    keys = [segment_key(sentence, lang, voice) for sentence in sentences]
+    audio = {}
+    missing = {}
+    for sentence, key in zip(sentences, keys):
+        if key in audio or key in missing:
+            continue
+        cached = segment_store.get(key)
+        if cached is None:
+            missing[key] = sentence
+        else:
+            audio[key] = cached
+
+    # Each task runs in a copy of this context, so its logs carry the request id
+    futures = {
+        key: _segment_executor.submit(contextvars.copy_context().run, _synthesize_segment, sentence, lang)
+        for key, sentence in missing.items()
+    }
+    splicer = None
+    try:
+        for key in keys:
+            if key not in audio:
+                audio_format, data, storable = futures[key].result()
+                if storable:
+                    segment_store.put(key, audio_format, data)
+                audio[key] = (audio_format, data)
+            audio_format, data = audio[key]
+            if splicer is None:
+                splicer = Splicer(fp, audio_format)
+            elif audio_format != splicer.format:
+                raise SpliceError(f"mixed formats {splicer.format} and {audio_format}")
+            splicer.add(data)
+        splicer.close()
+    finally:
+        # After a failure, sentences not started yet are dropped and running ones are not waited for
+        for future in futures.values():
+            future.cancel()
+    logger.debug("Spoke %d sentences, %d synthesized", len(sentences), len(missing))
+    return splicer.format
+
+
+def _write_engine(text: str, lang: str, fp) -> str:
+    """
+    Run the configured TTS engine into ``fp``, recording synthesis and write time separately.
+
+    Engines interleave producing audio and writing it, so the time spent
+    inside ``fp.write`` is the file_write stage and the rest is synthesis.
+
+    Returns:
+        str: Format of the audio written, e.g. 'mp3'
+    """
+    writer = _TimedWriter(fp)
+    start = time.perf_counter()
+    logger.debug("Initializing TTS engine with text length: %d", len(text))
+    with _in_flight:
+        audio_format = get_engine().write_to_fp(text, lang, writer)
+    STAGE_SECONDS.observe(time.perf_counter() - start - writer.seconds, stage='synthesis', lang=lang)
+    STAGE_SECONDS.observe(writer.seconds, stage='file_write', lang=lang)
+    return audio_format
+
+
+class SpillBuffer(io.RawIOBase):
+    """
+    Write-once, read-many audio buffer backed by a pooled bytearray.
+
+    Once more than ``threshold`` bytes are written the contents move to an
+    anonymous temporary file in TEMP_DIR, which the OS reclaims even if the
+    process dies before :meth:`close` runs. Its bytes count towards the spool
+    quota; when the spool is full at that point the buffer stays in memory.
+    """
+
+    name = 'voice.mp3'
+
+    def __init__(self, threshold: int = AUDIO_SPILL_THRESHOLD, pool: BufferPool = _buffer_pool):
+        super().__init__()
+        self.threshold = threshold
+        self._pool = pool
+        self._buf = pool.acquire()
+        self._size = 0
+        self._pos = 0
+        self._file = None
+        self._charged = 0
+
+    @property
+    def spilled(self) -> bool:
+        """Whether the buffer has moved to disk."""
+        return self._file is not None
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if (self._file is None and self._size + len(data) > self.threshold
+                and spool.has_room(self._size + len(data))):
+            self._spill()
+        if self._file is not None:
+            self._file.seek(0, io.SEEK_END)
+            written = self._file.write(data)
+            spool.charge(written)
+            self._charged += written
+            return written
+        end = self._size + len(data)
+        self._buf[self._size:end] = data
+        self._size = end
+        return len(data)
+
+    def _spill(self) -> None:
+        logger.debug("Audio buffer exceeded %d bytes, spilling to disk", self.threshold)
+        os.makedirs(TEMP_DIR, mode=0o755, exist_ok=True)
+        self._file = tempfile.TemporaryFile(dir=TEMP_DIR)
+        self._file.write(memoryview(self._buf)[:self._size])
+        spool.charge(self._size)
+        self._charged += self._size
+        self._file.seek(self._pos)
+        self._release_buffer()
+
+    def read(self, size: int = -1) -> bytes:
+        if self._file is not None:
+            return self._file.read(size)
+        end = self._size if size is None or size < 0 else min(self._size, self._pos + size)
+        data = bytes(self._buf[self._pos:end])
+        self._pos = end
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self._file is not None:
+            return self._file.seek(offset, whence)
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, min(offset, self._size))
+        return self._pos
+
+    def tell(self) -> int:
+        if self._file is not None:
+            return self._file.tell()
+        return self._pos
+
+    def getvalue(self) -> bytes:
+        """Return the full buffer contents without disturbing the read position."""
+        if self._file is not None:
+            pos = self._file.tell()
+            self._file.seek(0)
+            data = self._file.read()
+            self._file.seek(pos)
+            return data
+        return bytes(self._buf[:self._size])
+
+    def _release_buffer(self) -> None:
+        if self._buf is not None:
+            self._pool.release(self._buf)
+            self._buf = None
+
+    def close(self) -> None:
+        if not self.closed:
+            if self._file is not None:
+                self._file.close()
+                spool.charge(-self._charged)
+                self._charged = 0
+            self._release_buffer()
+        super().close()
+
+
+class AudioFile(io.FileIO):
+    """Read handle on a spooled audio file that releases the file when closed."""
+
+    def getvalue(self) -> bytes:
+        """Return the full file contents without disturbing the read position."""
+        pos = self.tell()
+        self.seek(0)
+        data = self.readall()
+        self.seek(pos)
+        return data
+
+    def close(self) -> None:
+        if not self.closed:
+            super().close()
+            spool.release(self.name)
+
+
+def synthesize(text: str, lang: str = 'en') -> tuple[bool, object]:
+    """
+    Generate speech and return it as a readable, closeable audio object.
+
+    Uses pooled in-memory buffers when AUDIO_BUFFER_MODE is 'memory' and the
+    TEMP_DIR file path otherwise. Closing the result releases the buffer or
+    removes the file.
+
+    Args:
+        text (str): Text to convert to speech
+        lang (str): Language code (default: 'en')
+
+    Returns:
+        tuple[bool, object]: (success, audio object or error_message)
+    """
+    if AUDIO_BUFFER_MODE == 'memory':
+        return generate_speech_buffer(text, lang)
+
+    success, result = generate_speech(text, lang)
+    if not success:
+        return False, result
+    try:
+        return True, AudioFile(result, 'rb')
+    except Exception as e:
+        spool.release(result)
+        logger.error("Error opening speech file %s: %s", result, e)
+        return False, str(e)
+
+
+def generate_speech_buffer(text: str, lang: str = 'en') -> tuple[bool, object]:
+    """
+    Generate speech from text with the configured engine straight into a pooled buffer.
+
+    Args:
+        text (str): Text to convert to speech
+        lang (str): Language code (default: 'en')
+
+    Returns:
+        tuple[bool, object]: (success, SpillBuffer or error_message)
+    """
+    buffer = SpillBuffer()
+    try:
+        # Telegram infers the upload's type from its file name
+        buffer.name = f"voice.{_write_speech(text, lang, buffer)}"
+        buffer.seek(0)
+        logger.debug("Speech synthesized into %s buffer", 'disk-spilled' if buffer.spilled else 'memory')
+        return True, buffer
+    except Exception as e:
+        buffer.close()
+        logger.error("Error generating speech: %s", e)
+        return False, str(e)
 
 def generate_speech(text: str, lang: str = 'en') -> tuple[bool, str]:
     """
-    Generate speech from text using gTTS.
+    Generate speech from text with the configured engine.
 
     Args:
         text (str): Text to convert to speech
@@ -13,43 +445,127 @@ def generate_speech(text: str, lang: str = 'en') -> tuple[bool, str]:
 
     Returns:
         tuple[bool, str]: (success, file_path or error_message)
+
+    The file belongs to the spool; the caller releases it with ``spool.release``.
     """
+    filepath = None
     try:
-        # Ensure temp directory exists with proper permissions
-        os.makedirs(TEMP_DIR, mode=0o755, exist_ok=True)
-        logger.debug(f"Temporary directory {TEMP_DIR} verified")
-
-        # Generate unique filename
-        filename = f"{uuid.uuid4()}.mp3"
-        filepath = os.path.join(TEMP_DIR, filename)
-        logger.debug(f"Generated filepath: {filepath}")
+        # Reserve a file in TEMP_DIR within the spool's quota
+        filepath = spool.create('mp3')
+        logger.debug("Generated filepath: %s", filepath)
 
         # Generate speech
-        logger.info("Initializing gTTS with text length: %d", len(text))
-        tts = gTTS(text=text, lang=lang)
-
-        logger.info("Saving speech to file")
-        tts.save(filepath)
-        logger.info(f"Speech file saved successfully at: {filepath}")
+        logger.debug("Saving speech to file")
+        with open(filepath, 'wb') as f:
+            audio_format = _write_speech(text, lang, f)
+        if audio_format != 'mp3':
+            # Fallback engines may produce another format; keep the extension truthful
+            renamed = f"{os.path.splitext(filepath)[0]}.{audio_format}"
+            spool.rename(filepath, renamed)
+            filepath = renamed
+        spool.written(filepath)
+        logger.debug("Speech file saved successfully at: %s", filepath)
 
         return True, filepath
     except Exception as e:
-        logger.error(f"Error generating speech: {str(e)}")
+        if filepath is not None:
+            # Drop the partial file rather than leaving it for the sweeper
+            spool.release(filepath)
+        logger.error("Error generating speech: %s", e)
         return False, str(e)
 
-def cleanup_file(filepath: str) -> None:
+def _split_oversized(piece: str, max_chars: int) -> list[str]:
+    """Break a piece longer than max_chars at clauses, then words, then hard cuts."""
+    if len(piece) <= max_chars:
+        return [piece]
+    for pattern in (_CLAUSE_END, re.compile(r'\s+')):
+        parts = [p for p in pattern.split(piece) if p]
+        if len(parts) > 1:
+            return [sub for part in parts for sub in _split_oversized(part, max_chars)]
+    return [piece[i:i + max_chars] for i in range(0, len(piece), max_chars)]
+
+
+def split_text(text: str, max_chars: int = CHUNK_MAX_CHARS) -> list[str]:
     """
-    Remove temporary audio or image file.
+    Split text into chunks of at most max_chars, preferring sentence boundaries.
 
     Args:
-        filepath (str): Path to file to remove
+        text (str): Text to split
+        max_chars (int): Maximum chunk length in characters
+
+    Returns:
+        list[str]: Non-empty chunks in original order
     """
+    chunks = []
+    current = ''
+    for sentence in _SENTENCE_END.split(text):
+        for piece in _split_oversized(sentence.strip(), max_chars):
+            if not piece:
+                continue
+            if current and len(current) + 1 + len(piece) > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _chunk_retries() -> int:
+    """Return CHUNK_RETRIES, or 0 when the engine chain already retries its remote calls."""
+    engine = get_engine()
+    if any(getattr(e, 'retries', 0) for e in getattr(engine, 'engines', [engine])):
+        return 0
+    return CHUNK_RETRIES
+
+
+def _synthesize_with_retry(text: str, lang: str) -> tuple[bool, object]:
+    """Synthesize one chunk, retrying failures with exponential backoff unless the engine retries itself."""
+    retries = _chunk_retries()
+    for attempt in range(retries + 1):
+        success, result = synthesize(text, lang)
+        if success:
+            return success, result
+        if attempt < retries:
+            logger.warning("Chunk synthesis failed (attempt %d), retrying: %s", attempt + 1, result)
+            time.sleep(0.5 * 2 ** attempt)
+    return False, result
+
+
+def _close_result(future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        success, result = future.result()
+        if success:
+            result.close()
+
+
+def synthesize_chunks(chunks: list[str], lang: str = 'en') -> Iterator[tuple[bool, object]]:
+    """
+    Synthesize the chunks of a long text on the synthesis thread pool.
+
+    Chunks are synthesized concurrently, with at most twice the pool size in
+    flight so buffered audio stays bounded, and yielded in text order as soon
+    as each one is ready. Callers must close every successful result.
+
+    Args:
+        chunks (list[str]): Chunks from :func:`split_text`
+        lang (str): Language code (default: 'en')
+
+    Yields:
+        tuple[bool, object]: (success, audio object or error_message) per chunk
+    """
+    window = SYNTHESIS_WORKERS * 2
+    pending = deque()
+    next_index = 0
     try:
-        if os.path.exists(filepath):
-            logger.debug(f"Cleaning up file: {filepath}")
-            os.remove(filepath)
-            logger.info(f"Successfully removed file: {filepath}")
-        else:
-            logger.warning(f"File not found for cleanup: {filepath}")
-    except Exception as e:
-        logger.error(f"Error cleaning up file {filepath}: {str(e)}")
\ No newline at end of file
+        while pending or next_index < len(chunks):
+            while next_index < len(chunks) and len(pending) < window:
+                pending.append(_synthesis_executor.submit(_synthesize_with_retry, chunks[next_index], lang))
+                next_index += 1
+            yield pending.popleft().result()
+    finally:
+        # Release audio for chunks the caller never consumed
+        for future in pending:
+            if not future.cancel():
+                future.add_done_callback(_close_result)
@@ -0,0 +1,32 @@
+"""
+Web service entry point, run with ``gunicorn web:app``.
+
+Serves /health and /metrics. In polling mode nothing from the bot stack
+(python-telegram-bot, gTTS) is imported; in webhook mode this process also
+runs the bot.
+"""
+import logging
+from app import app, init_db
+from config import BOT_MODE, TELEGRAM_TOKEN
+
+logger = logging.getLogger(__name__)
+
+
+def start() -> None:
+    """Start the bot in this process when updates are pushed to it by webhook."""
+    if BOT_MODE != 'webhook':
+        return
+    if not TELEGRAM_TOKEN:
+        logger.error("TELEGRAM_TOKEN not set, serving the health check without the bot")
+        return
+    from webhook import start_webhook
+    start_webhook()
+
+
+# Flask-SQLAlchemy has to be registered before the first request is served
+init_db()
+
+# Imported by gunicorn as web:app. Shard worker processes re-import the entry
+# script under another name and skip this
+if __name__ == 'web':
+    start()
@@ -0,0 +1,223 @@
+import hmac
+import logging
+import queue
+import threading
+from datetime import datetime
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+from config import (
+    TELEGRAM_TOKEN,
+    TELEGRAM_API_URL,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_QUEUE_SIZE,
+    SHARD_WORKERS,
+    STATUS_HISTORY
+)
+from metrics import Gauge
+from httppool import http_pool
+
+logger = logging.getLogger(__name__)
+
+# Raw updates accepted by the webhook endpoint, waiting to be dispatched
+_updates = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+_bot = None
+_dispatcher = None
+_start_lock = threading.Lock()
+# Updates forwarded to shard workers whose stored copy is deleted once they acknowledge them
+_forwarded = set()
+_forwarded_lock = threading.Lock()
+
+
+def accept_update(secret: str, header_token: str, data) -> int:
+    """
+    Validate an incoming webhook call, store the update and queue it for processing.
+
+    The update is stored in the database before the call is answered, so an
+    acknowledged update survives a crash or deploy; it is parsed and
+    dispatched by the processing thread. If it cannot be stored the call is
+    answered with 503 and Telegram delivers it again later.
+
+    Args:
+        secret (str): Secret path segment the call arrived on
+        header_token (str): X-Telegram-Bot-Api-Secret-Token header, if any
+        data: Decoded JSON body
+
+    Returns:
+        int: HTTP status to answer with
+    """
+    from jobqueue import job_queue
+
+    if not WEBHOOK_SECRET or not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return 404
+    # The webhook is always registered with the secret token, so Telegram always sends it
+    if header_token is None or not hmac.compare_digest(header_token, WEBHOOK_SECRET):
+        return 403
+    if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+        return 400
+    if _updates.full():
+        # Telegram retries undelivered updates, which is the backpressure we want
+        logger.warning("Webhook queue full, deferring update %s", data['update_id'])
+        return 503
+    try:
+        if not job_queue.store_update(data):
+            # Stored by an earlier delivery, which is being handled
+            return 200
+    except Exception as e:
+        logger.error("Failed to store webhook update %s: %s", data['update_id'], e)
+        return 503
+    try:
+        _updates.put_nowait(data)
+    except queue.Full:
+        logger.warning("Webhook queue full, deferring update %s", data['update_id'])
+        try:
+            job_queue.forget_updates([data['update_id']])
+        except Exception as e:
+            # Taken over by another process once its lease expires
+            logger.error("Failed to delete deferred webhook update %s: %s", data['update_id'], e)
+        return 503
+    return 200
+
+
+def queue_depth() -> int:
+    """Return the number of accepted updates not yet dispatched."""
+    return _updates.qsize()
+
+
+Gauge('webhook_queue_depth', 'Webhook updates accepted but not yet dispatched.', queue_depth)
+
+
+def _process_updates() -> None:
+    from jobqueue import job_queue
+
+    while True:
+        data = _updates.get()
+        try:
+            _dispatcher.process_update(Update.de_json(data, _bot))
+        except Exception as e:
+            logger.error("Error processing webhook update %s: %s", data.get('update_id'), e)
+        if SHARD_WORKERS:
+            # The stored copy is kept until the shard worker has handled it
+            with _forwarded_lock:
+                _forwarded.add(data['update_id'])
+            continue
+        try:
+            job_queue.forget_updates([data['update_id']])
+        except Exception as e:
+            logger.error("Failed to delete handled webhook update %s: %s", data['update_id'], e)
+
+
+def _shards_handled(watermark: int) -> None:
+    """Delete the stored copies of forwarded updates that every shard worker has acknowledged up to."""
+    from jobqueue import job_queue
+
+    with _forwarded_lock:
+        done = [update_id for update_id in _forwarded if update_id <= watermark]
+        _forwarded.difference_update(done)
+    if not done:
+        return
+    try:
+        job_queue.forget_updates(done)
+    except Exception as e:
+        logger.error("Failed to delete %d handled webhook updates: %s", len(done), e)
+
+
+def resume_updates() -> None:
+    """
+    Queue the webhook updates stored by a process that stopped before handling them.
+
+    Updates whose lease has not expired yet, because their process may still
+    be handling them, are checked again once it would have; with none left
+    the check repeats once per lease, in case another process dies.
+    """
+    from jobqueue import job_queue
+
+    try:
+        stored = job_queue.stored_updates()
+    except Exception as e:
+        logger.error("Failed to load stored webhook updates: %s", e)
+        return
+    now = datetime.utcnow()
+    next_check = None
+    resumed = 0
+    for update_id, lease_until in stored:
+        if job_queue.holds_update(update_id):
+            continue
+        if lease_until > now:
+            next_check = min(next_check or lease_until, lease_until)
+            continue
+        if _updates.full():
+            next_check = now
+            break
+        data = job_queue.claim_update(update_id)
+        if data is not None:
+            _updates.put_nowait(data)
+            resumed += 1
+    if resumed:
+        logger.info("Resumed %d webhook updates left by another process", resumed)
+    # Another process may die at any time, so look again at least once per lease
+    delay = job_queue.lease_seconds if next_check is None else (next_check - now).total_seconds() + 5
+    timer = threading.Timer(delay, resume_updates)
+    timer.daemon = True
+    timer.start()
+
+
+def start_webhook() -> None:
+    """
+    Set up update processing for this process and register the webhook with Telegram.
+
+    Safe to call more than once; only the first call has any effect.
+    """
+    global _bot, _dispatcher
+    with _start_lock:
+        if _dispatcher is not None:
+            return
+        if not TELEGRAM_TOKEN or not WEBHOOK_SECRET:
+            raise RuntimeError("Webhook mode needs TELEGRAM_TOKEN to derive the webhook secret from")
+
+        from app import init_db
+        from bot import register_handlers, register_routing
+        from broadcast import resume_broadcasts
+        from handlers import text_handler
+        from jobqueue import resume_jobs
+        from userstore import user_store
+        from heartbeat import heartbeat
+        from shards import shard_pool
+        from utils import warm_up
+        from spool import spool
+        from status import status_recorder
+
+        logger.info("Initializing bot in webhook mode...")
+        init_db()
+        user_store.load()
+        user_store.start()
+        spool.start()
+
+        _bot = Bot(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL, request=http_pool.telegram_request())
+        # Updates reach the dispatcher through process_update, so its own queue stays unused
+        _dispatcher = Dispatcher(_bot, queue.Queue(), use_context=True)
+        if SHARD_WORKERS:
+            shard_pool.start(on_handled=_shards_handled)
+            register_routing(_dispatcher)
+            heartbeat.start('webhook', backlog=lambda: queue_depth() + shard_pool.backlog())
+        else:
+            register_handlers(_dispatcher)
+            heartbeat.start('webhook', backlog=queue_depth)
+            warm_up()
+        if STATUS_HISTORY:
+            status_recorder.start()
+        threading.Thread(target=_process_updates, name='webhook-dispatch', daemon=True).start()
+        resume_updates()
+
+        if not WEBHOOK_URL:
+            logger.error("BOT_MODE is webhook but neither WEBHOOK_URL nor RENDER_EXTERNAL_URL is set")
+        else:
+            _bot.set_webhook(
+                url=f"{WEBHOOK_URL}/webhook/{WEBHOOK_SECRET}",
+                api_kwargs={'secret_token': WEBHOOK_SECRET}
+            )
+            logger.info("Webhook registered at %s/webhook/...", WEBHOOK_URL)
+
+        if not SHARD_WORKERS:
+            resume_jobs(_dispatcher, text_handler)
+        resume_broadcasts(_bot)
@@ -0,0 +1,44 @@
+"""
+Worker entry point, run with ``python worker.py``.
+
+Runs the polling bot and nothing else: the Flask server is not started and
+the bot stack is only imported once the configuration says it will run.
+"""
+import logging
+import sys
+import time
+from config import TELEGRAM_TOKEN, BOT_MODE
+
+logger = logging.getLogger(__name__)
+
+
+def run() -> None:
+    """Run the polling bot, restarting it after unexpected errors."""
+    from bot import run_bot
+
+    logger.info("Starting Text-to-Speech Bot...")
+    while True:  # Continuous operation loop
+        try:
+            run_bot()
+        except KeyboardInterrupt:
+            logger.info("Bot stopped by user")
+            break
+        except Exception as e:
+            logger.error("Unexpected error in main loop: %s", e)
+            logger.info("Restarting bot in 10 seconds...")
+            time.sleep(10)
+
+
+def main() -> None:
+    """Main entry point for the worker process."""
+    if not TELEGRAM_TOKEN:
+        logger.error("TELEGRAM_TOKEN not set. Please set it in environment variables.")
+        sys.exit(1)
+    if BOT_MODE == 'webhook':
+        logger.info("Webhook mode: updates are handled by the web service, nothing to do in the worker")
+        return
+    run()
+
+
+if __name__ == "__main__":
+    main()